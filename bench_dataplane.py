@@ -0,0 +1,252 @@
+#!/usr/bin/python3
+# Dataplane microbenchmark. Drives the forwarding code of switch.py
+# (parse_ethernet_header(), CAM learning, forward_frame() and the whole
+# process_frame()) with synthetic frame mixes, on a switch set up in this
+# process whose send_to_link()/send_to_links() are replaced by a Recorder, so
+# no link is needed (only dlink.so, loaded by wrapper.py: run make first).
+#
+# Every case is a frame mix on a switch with a number of access ports, trunk
+# ports and VLANs. It reports the frames per second of process_frame() and the
+# nanoseconds per frame of each stage, and --json saves the results so that a
+# later run can be compared against them with --compare:
+#   python3 bench_dataplane.py --json=before.json
+#   python3 bench_dataplane.py --compare=before.json
+# With --batch=N the frames go through process_batch() N at a time instead,
+# and the parse stage is the header classification of the batches (see
+# classify.py, --classify picks the classifier). --counters counts the frames
+# as --counters does in the switch (see counters.py), into a local buffer.
+import argparse
+import json
+import platform
+import random
+import struct
+import sys
+import time
+
+import switch
+import switch_log
+from data_structs import interface, CAM_table, VLAN_table, Egress_table
+from classify import get_classifier
+from counters import Counter_block, block_size
+
+BCAST = b'\xff' * 6
+# Share of known unicast, unknown unicast and broadcast frames
+MIXES = {
+    "unicast": (1.0, 0.0, 0.0),
+    "mixed": (0.8, 0.1, 0.1),
+    "flood": (0.0, 0.5, 0.5),
+}
+# (mix, access ports, trunk ports, VLANs)
+CASES = [
+    ("unicast", 4, 2, 1),
+    ("mixed", 4, 2, 2),
+    ("flood", 4, 2, 2),
+    ("unicast", 46, 2, 16),
+    ("mixed", 46, 2, 16),
+    ("flood", 46, 2, 16),
+]
+
+# Stand-in for the link layer, counts the frames and bytes sent per port
+class Recorder:
+    def __init__(self):
+        self.frames = {}
+        self.bytes = 0
+
+    def send_to_link(self, interface_id, length, data):
+        self.frames[interface_id] = self.frames.get(interface_id, 0) + 1
+        self.bytes += length
+
+    def send_to_links(self, interface_ids, data):
+        for interface_id in interface_ids:
+            self.send_to_link(interface_id, len(data), data)
+
+    def total(self):
+        return sum(self.frames.values())
+
+def host_mac(n: int):
+    return bytes([0x02, 0, 0]) + n.to_bytes(3, "big")
+
+def make_frame(dest_mac, src_mac, vlan_id=-1, payload=b'x' * 46):
+    if vlan_id == -1:
+        return dest_mac + src_mac + b'\x08\x00' + payload
+    return dest_mac + src_mac + struct.pack('!HH', 0x8200, vlan_id) + b'\x08\x00' + payload
+
+# Sets up switch.py with access_ports access ports spread over the VLANs
+# followed by trunk_ports trunk ports, with fresh tables (and counters)
+def setup_switch(access_ports: int, trunk_ports: int, vlans: int, recorder: Recorder, counters=False):
+    switch.interfaces.clear()
+    for i in range(access_ports):
+        switch.interfaces[i] = interface(f"r-{i}", "A", i % vlans + 1, i, "DESIGNATED")
+    for i in range(access_ports, access_ports + trunk_ports):
+        switch.interfaces[i] = interface(f"rr-0-{i}", "T", 0, i, "DESIGNATED")
+    switch.cam = CAM_table()
+    switch.vlans = VLAN_table()
+    switch.egress = Egress_table()
+    switch.tables_version = -1
+    switch.trace = None
+    ports = access_ports + trunk_ports
+    switch.counts = Counter_block(memoryview(bytearray(block_size(ports))), ports) if counters else None
+    switch.send_to_link = recorder.send_to_link
+    switch.send_to_links = recorder.send_to_links
+    switch.switch_priority = 1
+    switch.init_stp()
+    switch.update_forwarding_tables()
+
+# Returns the frames of the mix as (ingress port, frame) pairs. Every port has
+# hosts_per_port hosts, the ones behind a trunk send tagged frames. Known
+# destinations are in the same VLAN as the source, and are learned by
+# warm_up() before the measurements.
+def make_frames(mix, access_ports, trunk_ports, vlans, count, hosts_per_port=4, seed=0):
+    rng = random.Random(seed)
+    known, unknown, _ = MIXES[mix]
+    ports = access_ports + trunk_ports
+    # (port, mac, vlan) of every host; trunk hosts are spread over the VLANs
+    hosts = []
+    for port in range(ports):
+        for h in range(hosts_per_port):
+            vlan = port % vlans + 1 if port < access_ports else h % vlans + 1
+            hosts.append((port, host_mac(port * hosts_per_port + h), vlan))
+    by_vlan = {}
+    for host in hosts:
+        by_vlan.setdefault(host[2], []).append(host)
+
+    frames = []
+    for n in range(count):
+        port, src_mac, vlan = rng.choice(hosts)
+        pick = rng.random()
+        if pick < known:
+            peers = [h for h in by_vlan[vlan] if h[0] != port] or by_vlan[vlan]
+            dest_mac = rng.choice(peers)[1]
+        elif pick < known + unknown:
+            dest_mac = host_mac(0x800000 + n)
+        else:
+            dest_mac = BCAST
+        tag = vlan if port >= access_ports else -1
+        frames.append((port, make_frame(dest_mac, src_mac, tag)))
+    return frames, hosts
+
+def warm_up(hosts, access_ports):
+    for port, mac, vlan in hosts:
+        tag = vlan if port >= access_ports else -1
+        switch.process_frame(port, make_frame(BCAST, mac, tag), 60)
+
+# Best of repeats, in nanoseconds per frame
+def measure(run, count, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter_ns()
+        run()
+        elapsed = time.perf_counter_ns() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / count
+
+def run_case(mix, access_ports, trunk_ports, vlans, count, repeats, batch=0, counters=False):
+    recorder = Recorder()
+    setup_switch(access_ports, trunk_ports, vlans, recorder, counters)
+    frames, hosts = make_frames(mix, access_ports, trunk_ports, vlans, count)
+    warm_up(hosts, access_ports)
+
+    parse_ethernet_header = switch.parse_ethernet_header
+    forward_frame = switch.forward_frame
+    process_frame = switch.process_frame
+    cam = switch.cam
+    interfaces = switch.interfaces
+    parsed = []
+    for port, data in frames:
+        dest_mac, src_mac, _, recv_vlan_id = parse_ethernet_header(data)
+        vlan_id = recv_vlan_id if recv_vlan_id != -1 else interfaces[port].vlan
+        parsed.append((port, data, len(data), dest_mac, src_mac, recv_vlan_id, vlan_id))
+
+    batches = [frames[i:i + batch] for i in range(0, count, batch)] if batch else []
+    classify_batch = switch.classify_batch
+    process_batch = switch.process_batch
+
+    def parse():
+        for port, data in frames:
+            parse_ethernet_header(data)
+
+    def classify():
+        for frames_batch in batches:
+            classify_batch([data for _, data in frames_batch])
+
+    def learn():
+        for port, data, length, dest_mac, src_mac, recv_vlan_id, vlan_id in parsed:
+            cam.learn(vlan_id, src_mac, interfaces[port])
+
+    def forward():
+        for port, data, length, dest_mac, src_mac, recv_vlan_id, vlan_id in parsed:
+            forward_frame(port, data, length, dest_mac, recv_vlan_id)
+
+    def process():
+        for port, data in frames:
+            process_frame(port, data, len(data))
+
+    def process_batches():
+        for frames_batch in batches:
+            process_batch(frames_batch)
+
+    stages = {name: measure(run, count, repeats)
+              for name, run in (("parse", classify if batch else parse), ("learn", learn),
+                                ("forward", forward))}
+    recorder.frames.clear()
+    total = measure(process_batches if batch else process, count, repeats)
+    return {
+        "mix": mix, "access_ports": access_ports, "trunk_ports": trunk_ports, "vlans": vlans,
+        "frames": count, "batch": batch, "counters": counters,
+        "fps": 1e9 / total,
+        "ns_per_frame": total,
+        "stages_ns": stages,
+        "sent_per_frame": recorder.total() / (count * repeats),
+    }
+
+def case_name(result):
+    name = f"{result['mix']}/{result['access_ports']}a+{result['trunk_ports']}t/{result['vlans']}v"
+    if result.get("batch"):
+        name += f"/b{result['batch']}"
+    return name + "/counters" if result.get("counters") else name
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the switch dataplane")
+    parser.add_argument("--frames", type=int, default=20000, help="frames per case")
+    parser.add_argument("--repeats", type=int, default=5, help="runs per measurement, the best is kept")
+    parser.add_argument("--case", action="append", default=[],
+                        help="MIX:ACCESS:TRUNK:VLANS, e.g. mixed:8:2:4 (default: the built-in cases)")
+    parser.add_argument("--batch", type=int, default=0,
+                        help="frames per process_batch() call, 0 for process_frame() per frame")
+    parser.add_argument("--classify", default="auto", help="batch classifier, auto, numpy or python")
+    parser.add_argument("--counters", action="store_true", help="count the frames as --counters does")
+    parser.add_argument("--json", help="save the results to this file")
+    parser.add_argument("--compare", help="results file of an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    switch_log.setup("off")
+    switch.classify_batch = get_classifier(args.classify)
+    cases = [(mix, int(a), int(t), int(v)) for mix, a, t, v in
+             (case.split(":") for case in args.case)] or CASES
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = {case_name(r): r for r in json.load(file)["results"]}
+
+    results = []
+    print(f"{'case':<26} {'fps':>10} {'ns/frame':>9} {'parse':>7} {'learn':>7} {'forward':>8} {'sends':>6}")
+    for mix, access_ports, trunk_ports, vlans in cases:
+        result = run_case(mix, access_ports, trunk_ports, vlans, args.frames, args.repeats, args.batch,
+                          args.counters)
+        results.append(result)
+        name = case_name(result)
+        stages = result["stages_ns"]
+        line = (f"{name:<26} {result['fps']:>10.0f} {result['ns_per_frame']:>9.0f} "
+                f"{stages['parse']:>7.0f} {stages['learn']:>7.0f} {stages['forward']:>8.0f} "
+                f"{result['sent_per_frame']:>6.2f}")
+        if name in baseline:
+            line += f"  {result['fps'] / baseline[name]['fps']:.2f}x"
+        print(line)
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(),
+                       "time": time.time(), "results": results}, file, indent=2)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,76 @@
+# Header classification of a whole batch of received frames. The first 16
+# bytes of the frames (both MACs, the TPID and the VLAN tag) are packed into
+# one buffer viewed as an array of header records, and the destination and
+# source MACs as 48-bit integer keys (the CAM keys) and the VLAN IDs (-1 for
+# untagged frames) of all the frames come out of a few array operations
+# instead of a parse per frame.
+#
+# NumPy is optional: without it, or with --classify=python, the same results
+# are computed frame by frame. The array operations have a fixed cost per
+# call, so "auto" only uses them for batches of at least NUMPY_MIN_BATCH frames.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HEADER_LEN = 16
+TPID = 0x8200
+NUMPY_MIN_BATCH = 32
+
+if numpy is not None:
+    # The MACs are split in a 16-bit and a 32-bit big-endian field
+    HEADER = numpy.dtype([("dest_high", ">u2"), ("dest_low", ">u4"),
+                          ("src_high", ">u2"), ("src_low", ">u4"),
+                          ("ether_type", ">u2"), ("tci", ">u2")])
+
+def mac_key(mac: bytes):
+    return int.from_bytes(mac, "big")
+
+def key_mac(key: int):
+    return key.to_bytes(6, "big")
+
+# Returns the lists (destination MAC keys, source MAC keys, VLAN IDs) of the
+# frames
+def classify_numpy(frames):
+    count = len(frames)
+    headers = b"".join([frame[:HEADER_LEN] for frame in frames])
+    if len(headers) != count * HEADER_LEN:
+        # Some frame is shorter than a tagged header
+        headers = b"".join([bytes(frame[:HEADER_LEN]).ljust(HEADER_LEN, b"\0") for frame in frames])
+    fields = numpy.frombuffer(headers, dtype=HEADER)
+
+    dest = (fields["dest_high"].astype(numpy.int64) << 32) | fields["dest_low"]
+    src = (fields["src_high"].astype(numpy.int64) << 32) | fields["src_low"]
+    vlan_ids = numpy.where(fields["ether_type"] == TPID,
+                           fields["tci"].astype(numpy.int32) & 0x0FFF, -1)
+    return dest.tolist(), src.tolist(), vlan_ids.tolist()
+
+def classify_python(frames):
+    dest_keys = []
+    src_keys = []
+    vlan_ids = []
+    for frame in frames:
+        dest_keys.append(int.from_bytes(frame[0:6], "big"))
+        src_keys.append(int.from_bytes(frame[6:12], "big"))
+        if len(frame) >= HEADER_LEN and (frame[12] << 8) + frame[13] == TPID:
+            vlan_ids.append(((frame[14] & 0x0F) << 8) + frame[15])
+        else:
+            vlan_ids.append(-1)
+    return dest_keys, src_keys, vlan_ids
+
+def classify_auto(frames):
+    if len(frames) >= NUMPY_MIN_BATCH:
+        return classify_numpy(frames)
+    return classify_python(frames)
+
+CLASSIFIERS = {"numpy": classify_numpy, "python": classify_python, "auto": classify_auto}
+
+# "numpy", "python" or "auto" for NumPy on large batches when it is installed
+def get_classifier(name="auto"):
+    if name == "auto" and numpy is None:
+        name = "python"
+    if name == "numpy" and numpy is None:
+        raise ValueError("the numpy classifier needs NumPy installed")
+    if name not in CLASSIFIERS:
+        raise ValueError(f"unknown classifier {name!r}")
+    return CLASSIFIERS[name]
@@ -0,0 +1,338 @@
+#!/usr/bin/python3
+# Compact CAM table (--cam=compact) for switches that learn many MACs. The
+# CAM_table of data_structs.py costs a dict entry, a key tuple and a list per
+# MAC; here the entries live in an open-addressing hash table made of four
+# parallel arrays (MAC, VLAN, port id and last seen time of every slot), about
+# 20 bytes per slot. Slots are found the same way as in shared_cam.py: linear
+# probing over a bounded window, no deletions, and a full window reuses its
+# least recently seen slot.
+#
+# lookup_many() and learn_many() take whole batches of keys. With NumPy and
+# batches of at least BULK_MIN keys, the keys are hashed and their probe
+# windows searched with array operations on views of the same buffers: every
+# key's whole window is compared at once, which is cheaper than probing slot
+# by slot as the windows are short. Smaller batches are handled one key at a
+# time, the fixed cost of the array operations would outweigh the saving.
+#
+# Running this file compares its memory per entry and lookup throughput with
+# the dict version:
+#   python3 compact_cam.py --entries=50000
+import argparse
+import random
+import sys
+import time
+import tracemalloc
+from array import array
+
+from shared_cam import make_key, home_slot, MAX_PROBES, EXPIRED
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+EMPTY = -1
+# Smallest batch handled with array operations, see lookup_many()
+BULK_MIN = 48
+
+if numpy is not None:
+    VLAN_MASK = numpy.uint64(0xFFF)
+    KEY_TOP_BIT = numpy.uint64(1 << 63)
+    SHIFT_17 = numpy.uint64(17)
+    SHIFT_48 = numpy.uint64(48)
+    PROBE_OFFSETS = numpy.arange(MAX_PROBES)
+
+class Compact_CAM_table:
+    def __init__(self, capacity: int = 8192, aging_time: float = 300.0):
+        slots = 1
+        while slots < 2 * capacity:
+            slots <<= 1
+        self.slots = slots
+        self.mask = slots - 1
+        self.capacity = capacity
+        self.aging_time = aging_time
+        self.macs = array('Q', bytes(8 * slots))
+        self.vlans = array('H', bytes(2 * slots))
+        self.ports = array('h', [EMPTY]) * slots
+        self.last_seen = array('d', bytes(8 * slots))
+        if numpy is not None:
+            # Views sharing the arrays' memory, for the bulk operations
+            self.mac_view = numpy.frombuffer(self.macs, dtype=numpy.uint64)
+            self.vlan_view = numpy.frombuffer(self.vlans, dtype=numpy.uint16)
+            self.port_view = numpy.frombuffer(self.ports, dtype=numpy.int16)
+            self.seen_view = numpy.frombuffer(self.last_seen, dtype=numpy.float64)
+        self.now = time.monotonic()
+        # Port id -> interface, set by the switch
+        self.interfaces = {}
+        self.evicted = 0
+        self.aged = 0
+
+    # Aging is checked by lookup() and old entries are overwritten by
+    # learn(), so there is nothing to sweep
+    def tick(self, now: float):
+        self.now = now
+
+    # Returns whether the MAC moved, as CAM_table.learn()
+    def learn(self, vlan: int, mac: int, interface):
+        index = home_slot(make_key(vlan, mac), self.mask)
+        macs, vlans, ports, last_seen = self.macs, self.vlans, self.ports, self.last_seen
+        oldest = -1
+        moved = False
+        for _ in range(MAX_PROBES):
+            if ports[index] == EMPTY:
+                break
+            if macs[index] == mac and vlans[index] == vlan:
+                moved = ports[index] != interface.id and self.now - last_seen[index] <= self.aging_time
+                break
+            if oldest == -1 or last_seen[index] < last_seen[oldest]:
+                oldest = index
+            index = (index + 1) & self.mask
+        else:
+            # The probe window is full, reuse its least recently seen slot
+            index = oldest
+            if self.now - last_seen[index] > self.aging_time:
+                self.aged += 1
+            else:
+                self.evicted += 1
+        macs[index] = mac
+        vlans[index] = vlan
+        ports[index] = interface.id
+        last_seen[index] = self.now
+        return moved
+
+    # Learns the (vlan, mac, interface) of a batch, returns whether each MAC
+    # moved. The MACs already in the table are updated with array operations,
+    # the new ones are inserted by learn().
+    def learn_many(self, vlans, macs, interfaces):
+        if numpy is None or len(macs) < BULK_MIN:
+            return [self.learn(vlan, mac, interface)
+                    for vlan, mac, interface in zip(vlans, macs, interfaces)]
+        vlans = numpy.array(vlans, dtype=numpy.uint64)
+        macs = numpy.array(macs, dtype=numpy.uint64)
+        port_ids = numpy.array([interface.id for interface in interfaces], dtype=numpy.int16)
+        slots = self.find_many(vlans, macs)
+
+        known = slots != EMPTY
+        found = slots[known]
+        moved = numpy.zeros(len(macs), dtype=bool)
+        moved[known] = ((self.port_view[found] != port_ids[known])
+                        & (self.now - self.seen_view[found] <= self.aging_time))
+        self.port_view[found] = port_ids[known]
+        self.seen_view[found] = self.now
+        moved = moved.tolist()
+        for row in numpy.flatnonzero(~known).tolist():
+            moved[row] = self.learn(int(vlans[row]), int(macs[row]), interfaces[row])
+        return moved
+
+    def lookup(self, vlan: int, mac: int):
+        # home_slot(make_key(vlan, mac)) inlined, this is the forwarding path
+        key = (1 << 63) | ((vlan & 0xFFF) << 48) | mac
+        index = (key ^ (key >> 17) ^ (key >> 48)) & self.mask
+        macs, vlans, ports = self.macs, self.vlans, self.ports
+        for _ in range(MAX_PROBES):
+            port = ports[index]
+            if port == EMPTY:
+                return None
+            if macs[index] == mac and vlans[index] == vlan:
+                if self.now - self.last_seen[index] > self.aging_time:
+                    return None
+                return self.interfaces.get(port)
+            index = (index + 1) & self.mask
+        return None
+
+    # Returns the slot of every (vlan, mac) of the arrays, EMPTY for the
+    # keys not in the table. A key is only
+    # ever in the window of MAX_PROBES slots from its home slot, and at most
+    # once, as learn() stops at the key or at the first empty slot and only
+    # reuses a slot of a full window.
+    def find_many(self, vlans, macs):
+        keys = (vlans & VLAN_MASK) << SHIFT_48 | macs | KEY_TOP_BIT
+        homes = ((keys ^ (keys >> SHIFT_17) ^ (keys >> SHIFT_48)) & numpy.uint64(self.mask)).astype(numpy.intp)
+        windows = (homes[:, None] + PROBE_OFFSETS) & self.mask
+        hits = ((self.mac_view[windows] == macs[:, None]) & (self.vlan_view[windows] == vlans[:, None])
+                & (self.port_view[windows] != EMPTY))
+        rows = numpy.arange(len(keys))
+        columns = hits.argmax(1)
+        return numpy.where(hits[rows, columns], windows[rows, columns], EMPTY)
+
+    # Returns the interfaces of the (vlan, mac) pairs, None for the unknown or
+    # expired ones
+    def lookup_many(self, vlans, macs):
+        if numpy is None or len(macs) < BULK_MIN:
+            return [self.lookup(vlan, mac) for vlan, mac in zip(vlans, macs)]
+        slots = self.find_many(numpy.array(vlans, dtype=numpy.uint64),
+                                  numpy.array(macs, dtype=numpy.uint64))
+        known = slots != EMPTY
+        found = numpy.where(known, slots, 0)
+        fresh = known & (self.now - self.seen_view[found] <= self.aging_time)
+        ports = numpy.where(fresh, self.port_view[found], EMPTY).tolist()
+        get = self.interfaces.get
+        return [get(port) for port in ports]
+
+    # (vlan, mac, port id, last seen) of the entries that have not expired
+    def export(self):
+        oldest = self.now - self.aging_time
+        return [(self.vlans[index], self.macs[index], self.ports[index], self.last_seen[index])
+                for index in range(self.slots)
+                if self.ports[index] != EMPTY and self.last_seen[index] >= oldest]
+
+    # Expires the entries learned on the ports, e.g. after their VLAN changed.
+    # Slots are never emptied, a later learn() of the key reuses the slot.
+    def forget_ports(self, port_ids):
+        forgotten = 0
+        for index in range(self.slots):
+            if self.ports[index] in port_ids and self.last_seen[index] != EXPIRED:
+                self.last_seen[index] = EXPIRED
+                forgotten += 1
+        return forgotten
+
+    def add_entry(self, vlan: int, mac: int, interface):
+        self.learn(vlan, mac, interface)
+
+    def entry_exists(self, vlan: int, mac: int):
+        return self.lookup(vlan, mac) is not None
+
+    def entries(self):
+        if numpy is not None:
+            return int(numpy.count_nonzero(self.port_view != EMPTY))
+        return sum(1 for port in self.ports if port != EMPTY)
+
+    def memory(self):
+        return sum(buffer.itemsize * len(buffer)
+                   for buffer in (self.macs, self.vlans, self.ports, self.last_seen))
+
+    def stats(self):
+        return {"entries": self.entries(), "capacity": self.capacity,
+                "evicted": self.evicted, "aged": self.aged}
+
+    def __repr__(self):
+        lines = []
+        for index in range(self.slots):
+            if self.ports[index] != EMPTY:
+                lines.append(f"VLAN: {self.vlans[index]}, MAC: {self.macs[index].to_bytes(6, 'big').hex(':')}, "
+                             f"Interface: {self.interfaces.get(self.ports[index])}, "
+                             f"Age: {self.now - self.last_seen[index]:.1f}s")
+        return "\n".join(lines)
+
+# Fills a table with entries (vlan, mac, interface) and returns the bytes it
+# allocated doing so
+def fill(table, entries):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for vlan, mac, interface in entries:
+        table.learn(vlan, mac, interface)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used
+
+# Best of repeats, in lookups per second
+def lookup_rate(run, count, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return count / best
+
+def main(argv):
+    from data_structs import interface, CAM_table
+
+    parser = argparse.ArgumentParser(description="Compare the compact CAM table with the dict one")
+    parser.add_argument("--entries", type=int, default=50000, help="MACs learned")
+    parser.add_argument("--lookups", type=int, default=200000, help="lookups per measurement")
+    parser.add_argument("--batch", type=int, default=64, help="keys per lookup_many() call")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(0)
+    interfaces = {i: interface(f"r-{i}", "A", 1, i, "DESIGNATED") for i in range(48)}
+    entries = [(rng.randrange(1, 17), rng.getrandbits(48), interfaces[rng.randrange(48)])
+               for _ in range(args.entries)]
+    # Nine known keys for every unknown one
+    keys = [entries[rng.randrange(len(entries))][:2] if rng.random() < 0.9
+            else (1, rng.getrandbits(48)) for _ in range(args.lookups)]
+    vlans = [vlan for vlan, _ in keys]
+    macs = [mac for _, mac in keys]
+
+    dict_cam = CAM_table(args.entries)
+    compact = Compact_CAM_table(args.entries)
+    compact.interfaces = interfaces
+    # The arrays are allocated up front, by the constructor
+    dict_memory = fill(dict_cam, entries)
+    fill(compact, entries)
+    compact_memory = compact.memory()
+
+    def dict_lookups():
+        lookup = dict_cam.lookup
+        for vlan, mac in keys:
+            lookup(vlan, mac)
+
+    def compact_lookups():
+        lookup = compact.lookup
+        for vlan, mac in keys:
+            lookup(vlan, mac)
+
+    def compact_bulk_lookups():
+        for i in range(0, len(keys), args.batch):
+            compact.lookup_many(vlans[i:i + args.batch], macs[i:i + args.batch])
+
+    # The switch's steady state: the sources are known and only refreshed
+    relearned = entries[:len(keys)]
+    relearn_vlans = [vlan for vlan, _, _ in relearned]
+    relearn_macs = [mac for _, mac, _ in relearned]
+    relearn_interfaces = [interface for _, _, interface in relearned]
+
+    def compact_learns():
+        learn = compact.learn
+        for vlan, mac, interface in relearned:
+            learn(vlan, mac, interface)
+
+    def compact_bulk_learns():
+        for i in range(0, len(relearned), args.batch):
+            compact.learn_many(relearn_vlans[i:i + args.batch], relearn_macs[i:i + args.batch],
+                               relearn_interfaces[i:i + args.batch])
+
+    # The compact table may have evicted a few MACs (full probe windows),
+    # which it then does not find; any other difference is a bug
+    missing = set()
+    for i in range(0, len(keys), args.batch):
+        found = compact.lookup_many(vlans[i:i + args.batch], macs[i:i + args.batch])
+        for (vlan, mac), found_interface in zip(keys[i:i + args.batch], found):
+            expected = dict_cam.lookup(vlan, mac)
+            if found_interface is expected:
+                continue
+            if found_interface is not None:
+                print(f"lookup mismatch for VLAN {vlan} MAC {mac:012x}: {found_interface} "
+                      f"instead of {expected}")
+                return 1
+            missing.add((vlan, mac))
+    if len(missing) > compact.evicted:
+        print(f"{len(missing)} MACs missing from the compact table, only {compact.evicted} were evicted")
+        return 1
+    # Filling a table by batches gives the same slots as one MAC at a time
+    bulk = Compact_CAM_table(args.entries)
+    bulk.now = compact.now
+    for i in range(0, len(entries), args.batch):
+        batch = entries[i:i + args.batch]
+        bulk.learn_many([e[0] for e in batch], [e[1] for e in batch], [e[2] for e in batch])
+    if (bulk.macs, bulk.vlans, bulk.ports) != (compact.macs, compact.vlans, compact.ports):
+        print("learn_many() filled the table differently from learn()")
+        return 1
+
+    entries_count = len(dict_cam.table)
+    print(f"{args.entries} MACs learned ({entries_count} in the dict table, "
+          f"{compact.entries()} in the compact one, {compact.evicted} evicted)")
+    print(f"{'table':<24} {'bytes/entry':>12} {'lookups/s':>12} {'relearns/s':>12}")
+    print(f"{'dict':<24} {dict_memory / entries_count:>12.1f} "
+          f"{lookup_rate(dict_lookups, len(keys), args.repeats):>12.0f}")
+    print(f"{'compact':<24} {compact_memory / compact.entries():>12.1f} "
+          f"{lookup_rate(compact_lookups, len(keys), args.repeats):>12.0f} "
+          f"{lookup_rate(compact_learns, len(relearned), args.repeats):>12.0f}")
+    name = f"compact, batches of {args.batch}" + ("" if numpy is not None else " (no NumPy)")
+    print(f"{name:<24} {'':>12} {lookup_rate(compact_bulk_lookups, len(keys), args.repeats):>12.0f} "
+          f"{lookup_rate(compact_bulk_learns, len(relearned), args.repeats):>12.0f}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
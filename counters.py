@@ -0,0 +1,324 @@
+#!/usr/bin/python3
+# Switch counters (--counters). Per-port and per-VLAN counters of the frames
+# the switch handles, kept in a shared memory segment named
+# switch<SWITCH_ID>-counters so they can be read from outside the switch at
+# any time: reading only maps the segment, the forwarding loop is never asked
+# for anything.
+#
+# Every thread that counts (the forwarding thread of each process and the
+# BPDU thread) has a block of counters of its own and readers add up the
+# blocks. Counting is a plain increment of a list item, without any lock;
+# a publisher thread of each process copies the lists into the segment every
+# PUBLISH_INTERVAL seconds, so the counters read lag by about that much.
+# Counters are 64-bit and only reset when the switch restarts.
+#
+# Running this file prints the counters of a running switch, or exports them
+# in the Prometheus text format, once or over HTTP:
+#   python3 counters.py 0
+#   python3 counters.py 0 --prometheus
+#   python3 counters.py 0 --serve=9100
+import argparse
+import mmap
+from array import array
+import os
+import struct
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import shared_memory
+
+MAGIC = b"SWCOUNT1"
+# magic, ports, VLANs, blocks
+HEADER = struct.Struct("<8sIII")
+# Interface name of every port
+NAME = struct.Struct("16s")
+VLANS = 4096
+# Seconds between two copies of a thread's counters into the segment
+PUBLISH_INTERVAL = 0.5
+
+# (name, help) of the counters of every port and of every VLAN. Data frames
+# and BPDUs are counted separately, rx_*/tx_* only count data frames.
+PORT_FIELDS = (
+    ("rx_frames", "Data frames received on the port"),
+    ("rx_bytes", "Bytes of the data frames received on the port"),
+    ("tx_frames", "Data frames sent on the port"),
+    ("tx_bytes", "Bytes of the data frames sent on the port"),
+    ("bpdus_in", "BPDUs received on the port"),
+    ("bpdus_out", "BPDUs sent on the port"),
+    ("drops_blocking", "Frames dropped because STP blocks the port"),
+    ("drops_vlan", "Frames received on the port and dropped because their destination is outside their VLAN"),
+)
+VLAN_FIELDS = (
+    ("rx_frames", "Data frames received in the VLAN"),
+    ("rx_bytes", "Bytes of the data frames received in the VLAN"),
+    ("floods", "Frames flooded, to an unknown or a group destination"),
+    ("cam_hits", "Destination lookups that found the MAC"),
+    ("cam_misses", "Unicast destination lookups that did not find the MAC"),
+    ("learn_moves", "Source MACs learned on another port than before"),
+    ("drops_vlan", "Frames dropped because their destination is outside their VLAN"),
+)
+(PORT_RX_FRAMES, PORT_RX_BYTES, PORT_TX_FRAMES, PORT_TX_BYTES, PORT_BPDUS_IN, PORT_BPDUS_OUT,
+ PORT_DROPS_BLOCKING, PORT_DROPS_VLAN) = range(len(PORT_FIELDS))
+(VLAN_RX_FRAMES, VLAN_RX_BYTES, VLAN_FLOODS, VLAN_CAM_HITS, VLAN_CAM_MISSES, VLAN_LEARN_MOVES,
+ VLAN_DROPS_VLAN) = range(len(VLAN_FIELDS))
+PORT_STRIDE = len(PORT_FIELDS)
+VLAN_STRIDE = len(VLAN_FIELDS)
+
+def segment_name(switch_id):
+    return f"switch{switch_id}-counters"
+
+def segment_size(ports: int, blocks: int):
+    return counters_offset(ports) + blocks * block_size(ports)
+
+def counters_offset(ports: int):
+    return (HEADER.size + ports * NAME.size + 7) // 8 * 8
+
+# Counters of one block, in 64-bit words
+def block_size(ports: int):
+    return 8 * (ports * PORT_STRIDE + VLANS * VLAN_STRIDE)
+
+# The counters of one thread, in lists published to its block of the segment
+# (buffer) by publish(). The other methods are called on the forwarding path,
+# each is a few list increments.
+class Counter_block:
+    __slots__ = ("ports", "vlans", "port_words", "vlan_words")
+
+    def __init__(self, buffer, ports: int):
+        words = buffer.cast("Q")
+        self.port_words = words[:ports * PORT_STRIDE]
+        self.vlan_words = words[ports * PORT_STRIDE:]
+        self.ports = self.port_words.tolist()
+        self.vlans = self.vlan_words.tolist()
+
+    def publish(self):
+        self.port_words[:] = array("Q", self.ports)
+        self.vlan_words[:] = array("Q", self.vlans)
+
+    # A data frame received on port_id in the VLAN, moved if its source MAC
+    # was learned on another port before
+    def received(self, port_id: int, vlan: int, length: int, moved: bool):
+        ports = self.ports
+        vlans = self.vlans
+        port = port_id * PORT_STRIDE
+        ports[port + PORT_RX_FRAMES] += 1
+        ports[port + PORT_RX_BYTES] += length
+        vlan *= VLAN_STRIDE
+        vlans[vlan + VLAN_RX_FRAMES] += 1
+        vlans[vlan + VLAN_RX_BYTES] += length
+        if moved:
+            vlans[vlan + VLAN_LEARN_MOVES] += 1
+
+    def dropped_blocked(self, port_id: int, length: int):
+        ports = self.ports
+        port = port_id * PORT_STRIDE
+        ports[port + PORT_RX_FRAMES] += 1
+        ports[port + PORT_RX_BYTES] += length
+        ports[port + PORT_DROPS_BLOCKING] += 1
+
+    # A known destination, the frame is sent on port_id
+    def forwarded(self, vlan: int, port_id: int, length: int):
+        vlans = self.vlans
+        ports = self.ports
+        vlans[vlan * VLAN_STRIDE + VLAN_CAM_HITS] += 1
+        port = port_id * PORT_STRIDE
+        ports[port + PORT_TX_FRAMES] += 1
+        ports[port + PORT_TX_BYTES] += length
+
+    # A known destination learned on a port outside the VLAN of the frame
+    # received on port_id
+    def dropped_vlan(self, port_id: int, vlan: int):
+        vlans = self.vlans
+        vlan *= VLAN_STRIDE
+        vlans[vlan + VLAN_CAM_HITS] += 1
+        vlans[vlan + VLAN_DROPS_VLAN] += 1
+        self.ports[port_id * PORT_STRIDE + PORT_DROPS_VLAN] += 1
+
+    # An unknown or group destination (unicast is False for the group MACs,
+    # which are never learned)
+    def flooded(self, vlan: int, unicast: bool):
+        vlans = self.vlans
+        vlan *= VLAN_STRIDE
+        vlans[vlan + VLAN_FLOODS] += 1
+        if unicast:
+            vlans[vlan + VLAN_CAM_MISSES] += 1
+
+    def sent_many(self, port_ids, length: int):
+        ports = self.ports
+        for port_id in port_ids:
+            port = port_id * PORT_STRIDE
+            ports[port + PORT_TX_FRAMES] += 1
+            ports[port + PORT_TX_BYTES] += length
+
+    def bpdu_in(self, port_id: int):
+        self.ports[port_id * PORT_STRIDE + PORT_BPDUS_IN] += 1
+
+    def bpdu_out(self, port_id: int):
+        self.ports[port_id * PORT_STRIDE + PORT_BPDUS_OUT] += 1
+
+# The segment, created by the switch before it forks its workers (so they
+# inherit the mapping) or opened read-only by a reader
+class Counters:
+    def __init__(self, buffer, shm=None):
+        self.buffer = buffer
+        self.shm = shm
+        magic, self.ports, vlans, self.blocks = HEADER.unpack_from(buffer)
+        if magic != MAGIC or vlans != VLANS:
+            raise ValueError("not a switch counters segment")
+        self.names = [NAME.unpack_from(buffer, HEADER.size + i * NAME.size)[0].rstrip(b"\0").decode()
+                      for i in range(self.ports)]
+        self.local = threading.local()
+        # Blocks bound in this process, published by publish()
+        self.bound = []
+
+    # A switch with one block per counting thread
+    @classmethod
+    def create(cls, name: str, port_names, blocks: int):
+        size = segment_size(len(port_names), blocks)
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # Left behind by a switch that could not clean up
+            shared_memory.SharedMemory(name=name).unlink()
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        HEADER.pack_into(shm.buf, 0, MAGIC, len(port_names), VLANS, blocks)
+        for i, port_name in enumerate(port_names):
+            NAME.pack_into(shm.buf, HEADER.size + i * NAME.size, port_name.encode())
+        return cls(shm.buf, shm)
+
+    # Readers map the segment's file directly: a SharedMemory attached to
+    # it would be unlinked by the resource tracker when the reader exits
+    @classmethod
+    def open(cls, name: str):
+        with open(os.path.join("/dev/shm", name), "rb") as file:
+            return cls(mmap.mmap(file.fileno(), 0, prot=mmap.PROT_READ))
+
+    def block(self, index: int):
+        offset = counters_offset(self.ports) + index * block_size(self.ports)
+        return Counter_block(self.buffer[offset:offset + block_size(self.ports)], self.ports)
+
+    # Makes block index the calling thread's block, see current(). Blocks
+    # are bound after the workers are forked, each process binds its own.
+    def bind(self, index: int):
+        self.local.block = self.block(index)
+        self.bound.append(self.local.block)
+        return self.local.block
+
+    # The block of the calling thread, for the code that runs in several
+    # threads; block 0 for the threads that never called bind()
+    def current(self):
+        block = getattr(self.local, "block", None)
+        return block if block is not None else self.bind(0)
+
+    def publish(self):
+        for block in self.bound:
+            block.publish()
+
+    # Publishes the blocks of this process every PUBLISH_INTERVAL seconds
+    # from a daemon thread
+    def start_publisher(self):
+        def run():
+            while True:
+                time.sleep(PUBLISH_INTERVAL)
+                self.publish()
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    # Sums of the blocks: ({port name: {field: value}}, {vlan: {field: value}}),
+    # without the VLANs that never saw a frame
+    def totals(self):
+        words = memoryview(self.buffer)[counters_offset(self.ports):].cast("Q")
+        size = block_size(self.ports) // 8
+        sums = [0] * size
+        for index in range(self.blocks):
+            for i, value in enumerate(words[index * size:(index + 1) * size]):
+                if value:
+                    sums[i] += value
+        words.release()
+
+        port_words = self.ports * PORT_STRIDE
+        ports = {name: dict(zip((field for field, _ in PORT_FIELDS),
+                                sums[i * PORT_STRIDE:(i + 1) * PORT_STRIDE]))
+                 for i, name in enumerate(self.names)}
+        vlans = {}
+        for vlan in range(VLANS):
+            values = sums[port_words + vlan * VLAN_STRIDE:port_words + (vlan + 1) * VLAN_STRIDE]
+            if any(values):
+                vlans[vlan] = dict(zip((field for field, _ in VLAN_FIELDS), values))
+        return ports, vlans
+
+    # Removes the segment's name, the switch's mapping stays valid until it
+    # exits (the blocks handed out still point into it)
+    def unlink(self):
+        self.shm.unlink()
+
+def format_table(ports, vlans):
+    lines = []
+    fields = [field for field, _ in PORT_FIELDS]
+    lines.append(f"{'port':<12}" + "".join(f"{field:>15}" for field in fields))
+    for name, values in ports.items():
+        lines.append(f"{name:<12}" + "".join(f"{values[field]:>15}" for field in fields))
+    fields = [field for field, _ in VLAN_FIELDS]
+    lines.append("")
+    lines.append(f"{'vlan':<12}" + "".join(f"{field:>15}" for field in fields))
+    for vlan, values in vlans.items():
+        lines.append(f"{vlan:<12}" + "".join(f"{values[field]:>15}" for field in fields))
+    return "\n".join(lines)
+
+# The drops_<reason> fields are exported as one metric with a reason label
+def metric_name(kind, field):
+    if field.startswith("drops_"):
+        return f"switch_{kind}_drops_total", f',reason="{field[len("drops_"):]}"'
+    return f"switch_{kind}_{field}_total", ""
+
+def format_prometheus(switch_id, ports, vlans):
+    lines = []
+    for kind, fields, rows, label in (("port", PORT_FIELDS, ports, "port"),
+                                      ("vlan", VLAN_FIELDS, vlans, "vlan")):
+        described = set()
+        for field, help in fields:
+            metric, reason = metric_name(kind, field)
+            if metric not in described:
+                described.add(metric)
+                lines.append(f"# HELP {metric} {'Frames dropped, by reason' if reason else help}")
+                lines.append(f"# TYPE {metric} counter")
+            for key, values in rows.items():
+                lines.append(f'{metric}{{switch="{switch_id}",{label}="{key}"{reason}}} {values[field]}')
+    return "\n".join(lines) + "\n"
+
+def serve(switch_id, counters, port):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = format_prometheus(switch_id, *counters.totals()).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    ThreadingHTTPServer(("", port), Handler).serve_forever()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Read the counters of a running switch")
+    parser.add_argument("switch_id")
+    parser.add_argument("--prometheus", action="store_true", help="print them in the Prometheus text format")
+    parser.add_argument("--serve", type=int, metavar="PORT", help="serve them to Prometheus on PORT at /metrics")
+    args = parser.parse_args(argv)
+
+    counters = Counters.open(segment_name(args.switch_id))
+    if args.serve:
+        serve(args.switch_id, counters, args.serve)
+    elif args.prometheus:
+        print(format_prometheus(args.switch_id, *counters.totals()), end="")
+    else:
+        print(format_table(*counters.totals()))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
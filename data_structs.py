@@ -1,31 +1,293 @@
+import struct
+import time
+from collections import OrderedDict
+from enum import IntEnum
+
+class Port_type(IntEnum):
+    ACCESS = 0
+    TRUNK = 1
+
+    def __str__(self):
+        return self.name
+
+# STP port states. ALTERNATE is only a port role of the rapid mode, the state
+# of an alternate port is BLOCKING.
+class Port_state(IntEnum):
+    DESIGNATED = 0
+    ROOT = 1
+    BLOCKING = 2
+    ALTERNATE = 3
+
+    def __str__(self):
+        return self.name
+
 # a VLAN ID of 0 is always associated with a trunk port since 
 # there is no support of native VLANs in this project
 class interface:
-    def __init__(self, name: str, type: str, vlan: int, id: int, state: str):
+    __slots__ = ("id", "name", "vlan", "type", "is_trunk", "_state", "is_forwarding")
+
+    # state is a Port_state or its name; type is derived from the VLAN
+    def __init__(self, name: str, type: str, vlan: int, id: int, state):
         self.id = id
         self.name = name
-        self.vlan = vlan
-        if vlan != 0:
-            self.type = "A"
-        else:
-            self.type = "T"
+        self.set_vlan(vlan)
         self.state = state
+
+    # Changes the VLAN, and the type with it (VLAN 0 is a trunk)
+    def set_vlan(self, vlan: int):
+        self.vlan = vlan
+        self.type = Port_type.ACCESS if vlan != 0 else Port_type.TRUNK
+        self.is_trunk = self.type == Port_type.TRUNK
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        self._state = Port_state[state] if isinstance(state, str) else Port_state(state)
+        self.is_forwarding = self._state != Port_state.BLOCKING
+
     def __repr__(self):
-        return f"interface(name = {self.name!r}, type = {self.type!r}, vlan = {self.vlan!r},id = {self.id!r}, state = {self.state!r})"
-    
+        return f"interface(name = {self.name!r}, type = {self.type}, vlan = {self.vlan!r},id = {self.id!r}, state = {self.state})"
+
+# Array-of-structs view of the ports of a switch: one packed (type, state,
+# vlan) record per port id in a single buffer, so the whole switch can be
+# scanned or copied without touching the interface objects
+PORT = struct.Struct("<BBH")
+
+class Port_array:
+    def __init__(self, interfaces: dict, port_states=None):
+        self.count = len(interfaces)
+        self.buffer = bytearray(self.count * PORT.size)
+        for i in interfaces.values():
+            state = i.state if port_states is None else port_states[i.id]
+            PORT.pack_into(self.buffer, i.id * PORT.size, i.type, state, i.vlan)
+
+    def set_state(self, port_id: int, state):
+        self.buffer[port_id * PORT.size + 1] = state
+
+    def __getitem__(self, port_id: int):
+        type, state, vlan = PORT.unpack_from(self.buffer, port_id * PORT.size)
+        return Port_type(type), Port_state(state), vlan
+
+    # (port id, type, state, vlan) of every port, as plain integers
+    def records(self):
+        return [(port_id, *record) for port_id, record in enumerate(PORT.iter_unpack(self.buffer))]
+
+    # Ids of the ports of the type (or any type) in the state (or any state)
+    def select(self, type=None, state=None):
+        return [port_id for port_id, port_type, port_state, _ in self.records()
+                if (type is None or port_type == type) and (state is None or port_state == state)]
+
+# Entries are keyed by (vlan, mac), so the same MAC can live in several VLANs.
+# MACs are 48-bit integers (see parse_ethernet_header() in switch.py).
+# They are kept ordered from the least to the most recently seen, so both
+# the LRU eviction and the aging sweep only ever look at the front of the table
 class CAM_table:
+    def __init__(self, capacity: int = 8192, aging_time: float = 300.0, sweep_budget: int = 4):
+        # (vlan, mac) -> [interface, last_seen]
+        self.table = OrderedDict()
+        self.capacity = capacity
+        self.aging_time = aging_time
+        # Maximum number of expired entries removed per tick()
+        self.sweep_budget = sweep_budget
+        self.now = time.monotonic()
+        # Entries removed because the table was full / because they expired
+        self.evicted = 0
+        self.aged = 0
+
+    # Sets the time used by the following learn() and lookup() calls and
+    # removes a few expired entries. Called once per frame or batch.
+    def tick(self, now: float):
+        self.now = now
+        table = self.table
+        budget = self.sweep_budget
+        while budget and table:
+            key, entry = next(iter(table.items()))
+            if now - entry[1] <= self.aging_time:
+                break
+            del table[key]
+            self.aged += 1
+            budget -= 1
+
+    # Returns whether the MAC moved, i.e. its entry had not expired and was
+    # learned on another port
+    def learn(self, vlan: int, mac: int, interface):
+        table = self.table
+        key = (vlan, mac)
+        entry = table.get(key)
+        if entry is not None:
+            moved = entry[0] is not interface and self.now - entry[1] <= self.aging_time
+            entry[0] = interface
+            entry[1] = self.now
+            table.move_to_end(key)
+            return moved
+
+        if len(table) >= self.capacity:
+            table.popitem(last=False)
+            self.evicted += 1
+        table[key] = [interface, self.now]
+        return False
+
+    # Returns the interface the MAC was learned on in the VLAN, or None if it
+    # is unknown there or its entry has expired
+    def lookup(self, vlan: int, mac: int):
+        key = (vlan, mac)
+        entry = self.table.get(key)
+        if entry is None:
+            return None
+        if self.now - entry[1] > self.aging_time:
+            del self.table[key]
+            self.aged += 1
+            return None
+        return entry[0]
+
+    # (vlan, mac, port id, last seen) of the entries that have not expired
+    def export(self):
+        return [(vlan, mac, interface.id, last_seen)
+                for (vlan, mac), (interface, last_seen) in self.table.items()
+                if self.now - last_seen <= self.aging_time]
+
+    # Removes the entries learned on the ports, e.g. after their VLAN changed
+    def forget_ports(self, port_ids):
+        stale = [key for key, (interface, _) in self.table.items() if interface.id in port_ids]
+        for key in stale:
+            del self.table[key]
+        return len(stale)
+
+    def add_entry(self, vlan: int, mac: int, interface):
+        self.learn(vlan, mac, interface)
+
+    def entry_exists(self, vlan: int, mac: int):
+        return self.lookup(vlan, mac) is not None
+
+    def stats(self):
+        return {"entries": len(self.table), "capacity": self.capacity,
+                "evicted": self.evicted, "aged": self.aged}
+
+    def __repr__(self):
+        lines = []
+        for (vlan, mac), (interface, last_seen) in self.table.items():
+            lines.append(f"VLAN: {vlan}, MAC: {mac.to_bytes(6, 'big').hex(':')}, Interface: {interface}, Age: {self.now - last_seen:.1f}s")
+        return "\n".join(lines)
+
+# Per VLAN lists of the ports a frame is flooded on: the member access ports
+# (sent untagged) and the forwarding trunk ports (sent tagged, trunks carry
+# every VLAN). Rebuilt only when the configuration or the STP port states
+# change, so flooding never has to look at the ports of other VLANs.
+class VLAN_table:
     def __init__(self):
-        self.table = {}
-
-    def add_entry(self, mac: bytes, interface_id: int):
-        self.table[mac] = interface_id
-    
-    def entry_exists(self, mac: bytes):
-        if mac in self.table:
-            return True
-        else:
+        # vlan -> (access port ids, trunk port ids)
+        self.flood_lists = {}
+        self.trunk_ports = []
+        # Trunk ports blocked by STP, frames received on them are dropped
+        self.blocked_ports = frozenset()
+        # Ports (a Port_array) the lists were built from, and its buffer
+        self.ports = None
+        self.states = None
+
+    # port_states[id] is the STP state of port id
+    def rebuild(self, interfaces: dict, port_states):
+        ports = Port_array(interfaces, port_states)
+        if ports.buffer == self.states:
             return False
 
-    def __repr__(self):
-        for mac, interface in self.table.items():
-            print(f"MAC: {mac.hex(':')}, Interface: {interface}")
\ No newline at end of file
+        records = ports.records()
+        trunk_ports = [port_id for port_id, type, state, _ in records
+                       if type == Port_type.TRUNK and state != Port_state.BLOCKING]
+        access_ports = {}
+        for port_id, type, _, vlan in records:
+            if type == Port_type.ACCESS:
+                access_ports.setdefault(vlan, []).append(port_id)
+
+        self.flood_lists = {vlan: (ids, trunk_ports) for vlan, ids in access_ports.items()}
+        self.trunk_ports = trunk_ports
+        self.blocked_ports = frozenset(ports.select(Port_type.TRUNK, Port_state.BLOCKING))
+        self.ports = ports
+        self.states = ports.buffer
+        return True
+
+    # Returns the (access port ids, trunk port ids) a frame of the VLAN
+    # received on port exclude_id is flooded on
+    def flood_ports(self, vlan: int, exclude_id: int):
+        access_ports, trunk_ports = self.flood_lists.get(vlan, ((), self.trunk_ports))
+        return ([i for i in access_ports if i != exclude_id],
+                [i for i in trunk_ports if i != exclude_id])
+
+# Tag actions applied to a frame before it is sent on an egress port
+TAG_KEEP = 0    # send the frame as it was received
+TAG_PUSH = 1    # untagged frame going out on a trunk, add the 802.1q header
+TAG_POP = 2     # tagged frame going out on an access port, remove it
+
+# Forwarding decisions compiled per (ingress port, VLAN, tagged ingress frame):
+# - flood: (tag action, egress port ids) groups for unknown destinations
+# - unicast: egress port id -> tag action, for the ports a known destination
+#   may be reached on; a port missing from it means the frame is dropped
+# Built from a VLAN_table and swapped in as a whole, so the forwarding path
+# only ever sees a complete set of tables. An entry only depends on the flood
+# lists of its VLAN, so only the VLANs whose lists changed since the last
+# compile are recompiled, the entries of the others are carried over.
+class Egress_table:
+    def __init__(self):
+        self.entries = {}
+        self.vlans = None
+        # The flood lists and trunk ports the entries were compiled from
+        self.flood_lists = {}
+        self.trunk_ports = None
+        # VLANs recompiled by the last compile(), None for all of them
+        self.recompiled = None
+
+    def compile(self, interfaces: dict, vlans: VLAN_table):
+        entries = {}
+        if self.trunk_ports is None:
+            changed = None
+        else:
+            changed = {vlan for vlan in self.flood_lists.keys() | vlans.flood_lists.keys()
+                       if self.flood_lists.get(vlan) != vlans.flood_lists.get(vlan)}
+            trunks_changed = self.trunk_ports != vlans.trunk_ports
+            for key, entry in self.entries.items():
+                recv_interface_id, vlan, _ = key
+                if vlan in changed or recv_interface_id not in interfaces:
+                    continue
+                # The VLANs without access ports here are flooded on the trunks
+                if trunks_changed and vlan not in vlans.flood_lists:
+                    continue
+                entries[key] = entry
+
+        for recv_interface in interfaces.values():
+            for vlan in vlans.flood_lists:
+                for tagged in (False, True):
+                    key = (recv_interface.id, vlan, tagged)
+                    if key not in entries:
+                        entries[key] = self.compile_entry(vlans, *key)
+        self.flood_lists = dict(vlans.flood_lists)
+        self.trunk_ports = list(vlans.trunk_ports)
+        self.recompiled = changed
+        self.vlans = vlans
+        self.entries = entries
+
+    def compile_entry(self, vlans: VLAN_table, recv_interface_id: int, vlan: int, tagged: bool):
+        access_ports, trunk_ports = vlans.flood_ports(vlan, recv_interface_id)
+        access_action = TAG_POP if tagged else TAG_KEEP
+        trunk_action = TAG_KEEP if tagged else TAG_PUSH
+
+        flood = []
+        if access_ports:
+            flood.append((access_action, tuple(access_ports)))
+        if trunk_ports:
+            flood.append((trunk_action, tuple(trunk_ports)))
+
+        unicast = dict.fromkeys(access_ports, access_action)
+        unicast.update(dict.fromkeys(trunk_ports, trunk_action))
+        return flood, unicast
+
+    # Returns the (flood, unicast) entry of a frame; VLANs with no access port
+    # on this switch are compiled the first time a frame of theirs shows up
+    def lookup(self, recv_interface_id: int, vlan: int, tagged: bool):
+        key = (recv_interface_id, vlan, tagged)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.compile_entry(self.vlans, *key)
+            self.entries[key] = entry
+        return entry
@@ -7,10 +7,58 @@
 #include <stdlib.h>
 
 #define MAX_PACKET_LEN 1600
-#define SWITCH_NUM_INTERFACES 4
+#define MAX_BATCH 64
+/* Frames read from one port before moving on to the next ready one */
+#define RX_QUOTA 16
+
+/* Sockets of the interfaces set up by init(), indexed by interface */
+extern int *interfaces;
+extern int num_interfaces;
+
+/*
+ * @brief Returns the next port with frames to read, in round-robin order.
+ * The port is removed from the ready queue, requeue_interface() puts it back
+ * at the end if it may still have frames.
+ *
+ * @param timeout - epoll_wait() timeout in ms, -1 to block
+ * Returns: the interface index, or -1 if the timeout expired or the wait was
+ * interrupted by a signal.
+ */
+int next_ready_interface(int timeout);
+void requeue_interface(int intidx);
+
+/* Returns the socket of an interface, to wait on it from an event loop */
+int get_interface_fd(int intidx);
+
+/*
+ * @brief Receives up to max_frames packets from one interface, without
+ * blocking.
+ *
+ * @param frames - array of max_frames buffers of MAX_PACKET_LEN bytes
+ * @param lengths - will be set to the length of each received packet
+ * Returns: the number of packets received, 0 if there was none.
+ */
+int recv_batch_from(int intidx, char **frames, size_t *lengths, int max_frames);
+
+/*
+ * @brief Restricts the interfaces the receive functions of this process read
+ * from to the count interfaces in intidxs. Sending is not affected.
+ * Returns: 0 on success, -1 on failure (errno is set).
+ */
+int rx_select(int *intidxs, int count);
+
+/* Same as next_ready_interface(), but never waits nor checks the epoll set */
+int next_queued_interface(void);
 
 int send_to_link(int interface, char *frame_data, size_t length);
 
+/*
+ * @brief Sends the same frame on each of the count interfaces in intidxs.
+ * The entries of the interfaces whose TX ring was full are set to -1.
+ * Returns: the number of interfaces the frame was dropped on.
+ */
+int send_to_links(int *intidxs, int count, char *frame_data, size_t length);
+
 /*
  * @brief Receives a packet. Blocking function, blocks if there is no packet to
  * be received.
@@ -18,10 +66,25 @@ int send_to_link(int interface, char *frame_data, size_t length);
  * @param frame_data - region of memory in which the data will be copied; should
  *        have at least MAX_PACKET_LEN bytes allocated 
  * @param length - will be set to the total number of bytes received.
- * Returns: the interface it has been received from.
+ * Returns: the interface it has been received from, or -1 if interrupted by
+ * a signal.
  */
 int recv_from_any_link(char *frame_data, size_t *length);
 
+/*
+ * @brief Receives up to max_frames packets from all the ready interfaces,
+ * taking at most RX_QUOTA packets from a port before moving to the next one.
+ * Blocking function, blocks until at least one packet is available.
+ *
+ * @param frames - array of max_frames buffers, each of at least
+ *        MAX_PACKET_LEN bytes
+ * @param lengths - will be set to the length of each received packet
+ * @param ifaces - will be set to the interface each packet came from
+ * @param max_frames - capacity of the arrays above, capped at MAX_BATCH
+ * Returns: the number of packets received, 0 if interrupted by a signal.
+ */
+int recv_batch(char **frames, size_t *lengths, int *ifaces, int max_frames);
+
 
 /* Returns the name of an itnerface */
 char *get_interface_name(int interface);
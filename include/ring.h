@@ -0,0 +1,57 @@
+#ifndef _RING_H_
+#define _RING_H_
+
+#include <stddef.h>
+
+/*
+ * Optional PACKET_MMAP (TPACKET_V3) I/O for the interfaces opened by init().
+ * Each interface gets an RX ring of blocks filled by the kernel and a TX ring
+ * of fixed-size frames, both mapped in the process. Once an interface has its
+ * rings set up, send_to_link() and send_to_links() queue frames in its TX ring
+ * and nothing is sent until ring_flush() is called.
+ */
+
+/*
+ * @brief Sets up the RX and TX rings of an interface.
+ *
+ * @param block_size - size of a ring block, a multiple of the page size
+ * @param block_nr - number of blocks in each of the two rings
+ * @param frame_size - size of a TX frame slot, block_size must be a multiple of it
+ * @param block_timeout - ms after which a partially filled RX block is handed over
+ * Returns: 0 on success, -1 on failure (errno is set).
+ */
+int ring_setup(int intidx, unsigned int block_size, unsigned int block_nr,
+	       unsigned int frame_size, unsigned int block_timeout);
+
+/* Returns the address of the RX ring and sets its block size and count */
+void *ring_rx_map(int intidx, unsigned int *block_size, unsigned int *block_nr);
+
+/*
+ * Returns the index of the next unread RX block if the kernel handed it over
+ * and moves past it, -1 otherwise. The block stays ours until released.
+ */
+int ring_rx_next(int intidx);
+
+/* Gives the oldest block returned by ring_rx_next() back to the kernel */
+void ring_rx_release(int intidx);
+
+/*
+ * @brief Waits for an interface with an RX block ready to be read. Interfaces
+ * are checked round-robin, starting after the last one returned.
+ *
+ * @param timeout - timeout in ms, -1 to block, 0 to only check
+ * Returns: the interface index, or -1 if the timeout expired or the wait was
+ * interrupted by a signal.
+ */
+int ring_wait(int timeout);
+
+/* Queues a frame in the TX ring of an interface. Returns 0, or -1 if it is full */
+int ring_send(int intidx, char *frame_data, size_t len);
+
+/* Returns whether the interface has its rings set up */
+int ring_enabled(int intidx);
+
+/* Kicks the transmission of every TX ring with queued frames */
+int ring_flush(void);
+
+#endif /* _RING_H_ */
@@ -0,0 +1,244 @@
+#!/usr/bin/python3
+# Per-stage latency histograms (--latency). The stages of the forwarding path
+# (the receive functions, parse_ethernet_header() or the batch classifier,
+# CAM learn() and lookup(), the 802.1q tag push/pop and every send) are
+# wrapped with timers by install_latency_hooks() of switch.py. The wrappers
+# are installed in place of the functions, so without --latency the
+# forwarding path runs exactly as it would without this module.
+#
+# Durations are measured with perf_counter_ns() and recorded per traffic
+# class (known unicast, flood, BPDU) and stage into log-linear histograms in
+# the style of HdrHistogram: 2^SUB_BITS linear buckets per power of two, so
+# any value is recorded with a relative error of at most 1/2^SUB_BITS (3%).
+# "total" is the time from the return of the receive call to the end of the
+# handling of the frame; for a batch it includes the frames before it.
+#
+# kill -USR1 dumps the histograms of the switch to latency-<SWITCH_ID>.bin
+# (latency-<SWITCH_ID>-<worker>.bin for the workers), printed with:
+#   python3 latency.py latency-0.bin [latency-0-1.bin ...]
+import argparse
+import struct
+import sys
+import threading
+from array import array
+from time import perf_counter_ns
+
+from data_structs import TAG_KEEP
+
+CLASSES = ("unicast", "flood", "bpdu")
+CLASS_UNICAST, CLASS_FLOOD, CLASS_BPDU = range(len(CLASSES))
+STAGES = ("parse", "learn", "lookup", "tag", "send", "stp", "total")
+STAGE_PARSE, STAGE_LEARN, STAGE_LOOKUP, STAGE_TAG, STAGE_SEND, STAGE_STP, STAGE_TOTAL = range(len(STAGES))
+
+SUB_BITS = 5
+# Values of 2^MAX_BITS ns (about 18 minutes) and more go to the last bucket
+MAX_BITS = 40
+BUCKETS = ((MAX_BITS - SUB_BITS - 1) << SUB_BITS) + (2 << SUB_BITS)
+LINEAR = 2 << SUB_BITS
+
+MAGIC = b"SWLT"
+# magic, classes, stages, buckets
+HEADER = struct.Struct("<4sHHH")
+
+def bucket_index(value: int):
+    if value < LINEAR:
+        return max(value, 0)
+    shift = value.bit_length() - SUB_BITS - 1
+    return min((shift << SUB_BITS) + (value >> shift), BUCKETS - 1)
+
+# Highest value recorded in the bucket
+def bucket_value(index: int):
+    if index < LINEAR:
+        return index
+    shift = (index >> SUB_BITS) - 1
+    return ((index - (shift << SUB_BITS) + 1) << shift) - 1
+
+class Histogram:
+    def __init__(self, counts=None):
+        self.counts = [0] * BUCKETS if counts is None else counts
+
+    # bucket_index() inlined, this runs for every stage of every frame
+    def record(self, value: int):
+        if value < LINEAR:
+            self.counts[max(value, 0)] += 1
+            return
+        shift = value.bit_length() - SUB_BITS - 1
+        self.counts[min((shift << SUB_BITS) + (value >> shift), BUCKETS - 1)] += 1
+
+    def count(self):
+        return sum(self.counts)
+
+    # The value q (0 to 1) of the recorded values are at most, 0 if empty
+    def percentile(self, q: float):
+        total = self.count()
+        if not total:
+            return 0
+        rank = max(1, int(q * total + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return bucket_value(index)
+        return bucket_value(BUCKETS - 1)
+
+    def max(self):
+        for index in range(BUCKETS - 1, -1, -1):
+            if self.counts[index]:
+                return bucket_value(index)
+        return 0
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+
+# The histograms of one forwarding process and the wrappers that feed them.
+# The durations of the stages of a frame are kept aside until the frame has
+# been handled and its class is known.
+class Latency_recorder:
+    def __init__(self):
+        # histograms[class][stage]
+        self.histograms = [[Histogram() for _ in STAGES] for _ in CLASSES]
+        # (stage, duration) of the frame being handled
+        self.pending = []
+        # When the last receive call returned, and the share of the batch
+        # classification of each of its frames (None for process_frame())
+        self.received_at = 0
+        self.parse_share = None
+        # Whether the lookup of the frame found its destination
+        self.hit = None
+        # The thread handling a frame, the BPDU thread's sends are not timed
+        self.frame_thread = None
+
+    def received(self, function):
+        def timed(*args):
+            result = function(*args)
+            self.received_at = perf_counter_ns()
+            self.parse_share = None
+            return result
+        return timed
+
+    def timed(self, function, stage):
+        pending = self.pending
+        def timed(*args):
+            start = perf_counter_ns()
+            result = function(*args)
+            pending.append((stage, perf_counter_ns() - start))
+            return result
+        return timed
+
+    # The classification of a batch is shared by its frames
+    def timed_classify(self, function):
+        def timed(frames):
+            start = perf_counter_ns()
+            result = function(frames)
+            if frames:
+                self.parse_share = (perf_counter_ns() - start) // len(frames)
+            return result
+        return timed
+
+    def timed_lookup(self, function):
+        pending = self.pending
+        def timed(vlan, mac):
+            start = perf_counter_ns()
+            result = function(vlan, mac)
+            pending.append((STAGE_LOOKUP, perf_counter_ns() - start))
+            self.hit = result is not None
+            return result
+        return timed
+
+    # Only the actions that change the frame are timed
+    def timed_tag(self, function):
+        pending = self.pending
+        def timed(action, data, vlan_id):
+            if action == TAG_KEEP:
+                return data
+            start = perf_counter_ns()
+            result = function(action, data, vlan_id)
+            pending.append((STAGE_TAG, perf_counter_ns() - start))
+            return result
+        return timed
+
+    def timed_send(self, function):
+        pending = self.pending
+        get_ident = threading.get_ident
+        def timed(*args):
+            if self.frame_thread != get_ident():
+                return function(*args)
+            start = perf_counter_ns()
+            result = function(*args)
+            pending.append((STAGE_SEND, perf_counter_ns() - start))
+            return result
+        return timed
+
+    # Wraps handle_frame() of switch.py, which gets the frame's destination
+    # as its fourth argument, and records the frame's stages under its class.
+    # Frames dropped before the lookup (on blocked ports) are not recorded.
+    def frame(self, function, multicast_mac: int):
+        pending = self.pending
+        histograms = self.histograms
+        get_ident = threading.get_ident
+        def timed(interface_id, data, length, dest_mac, *args):
+            self.hit = None
+            self.frame_thread = get_ident()
+            function(interface_id, data, length, dest_mac, *args)
+            end = perf_counter_ns()
+            self.frame_thread = None
+
+            if dest_mac == multicast_mac:
+                stages = histograms[CLASS_BPDU]
+            elif self.hit is None:
+                pending.clear()
+                return
+            else:
+                stages = histograms[CLASS_UNICAST if self.hit else CLASS_FLOOD]
+            if self.parse_share is not None:
+                stages[STAGE_PARSE].record(self.parse_share)
+            for stage, duration in pending:
+                stages[stage].record(duration)
+            pending.clear()
+            if self.received_at:
+                stages[STAGE_TOTAL].record(end - self.received_at)
+        return timed
+
+    def dump(self, path: str):
+        with open(path, "wb") as file:
+            file.write(HEADER.pack(MAGIC, len(CLASSES), len(STAGES), BUCKETS))
+            for stages in self.histograms:
+                for histogram in stages:
+                    array("Q", histogram.counts).tofile(file)
+
+# Returns the histograms[class][stage] of a dump
+def load(path: str):
+    with open(path, "rb") as file:
+        data = file.read()
+    magic, classes, stages, buckets = HEADER.unpack_from(data)
+    if magic != MAGIC or (classes, stages, buckets) != (len(CLASSES), len(STAGES), BUCKETS):
+        raise ValueError(f"{path} is not a latency histogram dump")
+    counts = array("Q", data[HEADER.size:])
+    return [[Histogram(counts[(c * stages + s) * buckets:(c * stages + s + 1) * buckets].tolist())
+             for s in range(stages)] for c in range(classes)]
+
+def format_histograms(histograms):
+    lines = [f"{'class':<8} {'stage':<7} {'count':>9} {'p50 ns':>9} {'p99 ns':>9} {'p999 ns':>9} {'max ns':>9}"]
+    for name, stages in zip(CLASSES, histograms):
+        for stage, histogram in zip(STAGES, stages):
+            count = histogram.count()
+            if count:
+                lines.append(f"{name:<8} {stage:<7} {count:>9} {histogram.percentile(0.5):>9} "
+                             f"{histogram.percentile(0.99):>9} {histogram.percentile(0.999):>9} "
+                             f"{histogram.max():>9}")
+    return "\n".join(lines)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Print the latency percentiles of switch histogram dumps")
+    parser.add_argument("dumps", nargs="+", help="latency-<SWITCH_ID>*.bin files, merged")
+    args = parser.parse_args(argv)
+
+    histograms = load(args.dumps[0])
+    for path in args.dumps[1:]:
+        for stages, other in zip(histograms, load(path)):
+            for histogram, other_histogram in zip(stages, other):
+                histogram.merge(other_histogram)
+    print(format_histograms(histograms))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,4 +1,6 @@
+#define _GNU_SOURCE
 #include "lib.h"
+#include "ring.h"
 
 #include <sys/ioctl.h>
 #include <net/if.h>
@@ -16,9 +18,61 @@
 #include <sys/socket.h>
 #include <netinet/in.h>
 #include <arpa/inet.h>
+#include <errno.h>
+#include <sys/epoll.h>
 
 
-int interfaces[SWITCH_NUM_INTERFACES];
+int *interfaces;
+int num_interfaces;
+
+/*
+ * All the sockets are registered in one epoll set. Ports reported ready are
+ * kept in a FIFO and serviced round-robin: a port goes back to the end of the
+ * queue after each visit, until it has nothing more to read.
+ */
+static int epoll_fd;
+static int *ready;
+static int ready_head, ready_count;
+
+void requeue_interface(int intidx)
+{
+	ready[(ready_head + ready_count) % num_interfaces] = intidx;
+	ready_count++;
+}
+
+int next_queued_interface(void)
+{
+	int intidx;
+
+	if (ready_count == 0)
+		return -1;
+
+	intidx = ready[ready_head];
+	ready_head = (ready_head + 1) % num_interfaces;
+	ready_count--;
+	return intidx;
+}
+
+int next_ready_interface(int timeout)
+{
+	struct epoll_event events[MAX_BATCH];
+	int res;
+
+	while (ready_count == 0) {
+		res = epoll_wait(epoll_fd, events, MAX_BATCH, timeout);
+		/* Go back to Python, so that it can run its signal handlers */
+		if (res == -1 && errno == EINTR)
+			return -1;
+		DIE(res == -1, "epoll_wait");
+		if (res == 0)
+			return -1;
+
+		for (int i = 0; i < res; i++)
+			requeue_interface(events[i].data.u32);
+	}
+
+	return next_queued_interface();
+}
 
 int get_sock(const char *if_name)
 {
@@ -48,15 +102,40 @@ int send_to_link(int intidx, char *frame_data, size_t len)
 	 * interface, eg 1500 bytes 
 	 */
 	int ret;
+	if (ring_enabled(intidx))
+		return ring_send(intidx, frame_data, len);
+
 	ret = write(interfaces[intidx], frame_data, len);
 	DIE(ret == -1, "write");
 	return ret;
 }
 
+int send_to_links(int *intidxs, int count, char *frame_data, size_t len)
+{
+	/*
+	 * sendmmsg() batches messages for a single socket, while each of our
+	 * ports has its own socket, so the frame is written to each of them here
+	 * to keep it to one crossing from Python
+	 */
+	int ret, dropped = 0;
+	for (int i = 0; i < count; i++) {
+		if (ring_enabled(intidxs[i])) {
+			if (ring_send(intidxs[i], frame_data, len) == -1) {
+				intidxs[i] = -1;
+				dropped++;
+			}
+			continue;
+		}
+		ret = write(interfaces[intidxs[i]], frame_data, len);
+		DIE(ret == -1, "write");
+	}
+	return dropped;
+}
+
 ssize_t receive_from_link(int intidx, char *frame_data)
 {
 	ssize_t ret;
-  ret = read(interfaces[intidx], frame_data, MAX_PACKET_LEN);
+  ret = recv(interfaces[intidx], frame_data, MAX_PACKET_LEN, MSG_DONTWAIT);
 	return ret;
 }
 
@@ -72,31 +151,121 @@ int socket_receive_message(int sockfd, char *frame_data, size_t *len)
 	return 0;
 }
 
-int recv_from_any_link(char *frame_data, size_t *length) {
-	int res;
-	fd_set set;
+int get_interface_fd(int intidx)
+{
+	return interfaces[intidx];
+}
 
-	FD_ZERO(&set);
+int recv_batch_from(int intidx, char **frames, size_t *lengths, int max_frames)
+{
+	struct mmsghdr msgs[MAX_BATCH];
+	struct iovec iovs[MAX_BATCH];
+
+	if (max_frames > MAX_BATCH)
+		max_frames = MAX_BATCH;
+
+	for (int j = 0; j < max_frames; j++) {
+		iovs[j].iov_base = frames[j];
+		iovs[j].iov_len = MAX_PACKET_LEN;
+		memset(&msgs[j].msg_hdr, 0, sizeof(msgs[j].msg_hdr));
+		msgs[j].msg_hdr.msg_iov = &iovs[j];
+		msgs[j].msg_hdr.msg_iovlen = 1;
+	}
+
+	int ret = recvmmsg(interfaces[intidx], msgs, max_frames, MSG_DONTWAIT, NULL);
+	if (ret < 0)
+		return 0;
+
+	for (int j = 0; j < ret; j++)
+		lengths[j] = msgs[j].msg_len;
+	return ret;
+}
+
+int rx_select(int *intidxs, int count)
+{
+	/*
+	 * A new epoll instance: the one created by init() may be shared with
+	 * other processes forked after it, and changing it would change theirs
+	 */
+	int fd = epoll_create1(0);
+	if (fd == -1)
+		return -1;
+
+	for (int i = 0; i < count; i++) {
+		struct epoll_event ev = { .events = EPOLLIN, .data.u32 = intidxs[i] };
+		if (epoll_ctl(fd, EPOLL_CTL_ADD, interfaces[intidxs[i]], &ev) == -1) {
+			close(fd);
+			return -1;
+		}
+	}
+
+	epoll_fd = fd;
+	ready_head = 0;
+	ready_count = 0;
+	return 0;
+}
+
+int recv_from_any_link(char *frame_data, size_t *length) {
 	while (1) {
-		for (int i = 0; i < SWITCH_NUM_INTERFACES; i++) {
-			FD_SET(interfaces[i], &set);
+		int i = next_ready_interface(-1);
+		if (i == -1)
+			return -1;
+
+		ssize_t ret = receive_from_link(i, frame_data);
+		if (ret < 0)
+			continue;	/* drained, epoll reports it again when needed */
+
+		requeue_interface(i);
+		*length = ret;
+		return i;
+	}
+
+	return -1;
+}
+
+int recv_batch(char **frames, size_t *lengths, int *ifaces, int max_frames)
+{
+	struct mmsghdr msgs[MAX_BATCH];
+	struct iovec iovs[MAX_BATCH];
+	int count = 0;
+
+	if (max_frames > MAX_BATCH)
+		max_frames = MAX_BATCH;
+
+	while (count < max_frames) {
+		/* Only block while the batch is still empty */
+		int i = next_ready_interface(count == 0 ? -1 : 0);
+		if (i == -1)
+			break;
+
+		/* Read at most RX_QUOTA frames per visit so busy ports take turns */
+		int n = max_frames - count;
+		if (n > RX_QUOTA)
+			n = RX_QUOTA;
+		for (int j = 0; j < n; j++) {
+			iovs[j].iov_base = frames[count + j];
+			iovs[j].iov_len = MAX_PACKET_LEN;
+			memset(&msgs[j].msg_hdr, 0, sizeof(msgs[j].msg_hdr));
+			msgs[j].msg_hdr.msg_iov = &iovs[j];
+			msgs[j].msg_hdr.msg_iovlen = 1;
 		}
 
-		res = select(interfaces[SWITCH_NUM_INTERFACES - 1] + 1, &set, NULL, NULL, NULL);
-		DIE(res == -1, "select");
+		int ret = recvmmsg(interfaces[i], msgs, n, MSG_DONTWAIT, NULL);
+		if (ret <= 0)
+			continue;
 
-		for (int i = 0; i < SWITCH_NUM_INTERFACES; i++) {
-			if (FD_ISSET(interfaces[i], &set)) {
-				ssize_t ret = receive_from_link(i, frame_data);
-        if (ret < 0)
-          continue;
-				*length = ret;
-				return i;
-			}
+		for (int j = 0; j < ret; j++) {
+			lengths[count + j] = msgs[j].msg_len;
+			ifaces[count + j] = i;
 		}
+		count += ret;
+
+		/* A full quota means there may be more waiting on this port */
+		if (ret == n)
+			requeue_interface(i);
 	}
 
-	return -1;
+	return count;
 }
 
 char *get_interface_ip(int interface)
@@ -190,9 +359,20 @@ int hwaddr_aton(const char *txt, uint8_t *addr)
 
 int init(int argc, char *argv[])
 {
+	interfaces = malloc(argc * sizeof(*interfaces));
+	ready = malloc(argc * sizeof(*ready));
+	DIE(interfaces == NULL || ready == NULL, "malloc");
+	num_interfaces = argc;
+
+	epoll_fd = epoll_create1(0);
+	DIE(epoll_fd == -1, "epoll_create1");
+
   for (int i = 0; i < argc; ++i) {
 		printf("Setting up interface: %s\n", argv[i]);
 		interfaces[i] = get_sock(argv[i]);
+
+		struct epoll_event ev = { .events = EPOLLIN, .data.u32 = i };
+		DIE(epoll_ctl(epoll_fd, EPOLL_CTL_ADD, interfaces[i], &ev) == -1, "epoll_ctl");
 	}
 
   return argc;
@@ -0,0 +1,223 @@
+#include "lib.h"
+#include "ring.h"
+
+#include <errno.h>
+#include <string.h>
+#include <sys/mman.h>
+#include <sys/socket.h>
+#include <linux/if_packet.h>
+
+struct ring {
+	uint8_t *map;
+	size_t map_len;
+
+	/* RX ring: block_nr blocks of block_size bytes */
+	unsigned int block_size;
+	unsigned int block_nr;
+	unsigned int rx_next;		/* next block to read */
+	unsigned int rx_release;	/* oldest block read and not released */
+	unsigned int rx_held;		/* blocks read and not released */
+
+	/* TX ring, mapped right after the RX ring: frame_nr frames */
+	uint8_t *tx;
+	unsigned int frame_size;
+	unsigned int frame_nr;
+	unsigned int tx_next;
+	int tx_pending;
+
+	/* The BPDU thread and the main loop may both send on the same port */
+	int tx_lock;
+};
+
+static struct ring *rings;
+
+static void ring_lock(struct ring *r)
+{
+	while (__atomic_exchange_n(&r->tx_lock, 1, __ATOMIC_ACQUIRE))
+		;
+}
+
+static void ring_unlock(struct ring *r)
+{
+	__atomic_store_n(&r->tx_lock, 0, __ATOMIC_RELEASE);
+}
+
+int ring_setup(int intidx, unsigned int block_size, unsigned int block_nr,
+	       unsigned int frame_size, unsigned int block_timeout)
+{
+	struct tpacket_req3 req;
+	struct ring *r;
+	int fd = interfaces[intidx];
+	int version = TPACKET_V3;
+	int res;
+
+	if (!rings) {
+		rings = calloc(num_interfaces, sizeof(*rings));
+		DIE(rings == NULL, "calloc");
+	}
+	r = &rings[intidx];
+
+	res = setsockopt(fd, SOL_PACKET, PACKET_VERSION, &version, sizeof(version));
+	if (res == -1)
+		return -1;
+
+	memset(&req, 0, sizeof(req));
+	req.tp_block_size = block_size;
+	req.tp_block_nr = block_nr;
+	req.tp_frame_size = frame_size;
+	req.tp_frame_nr = (block_size / frame_size) * block_nr;
+	req.tp_retire_blk_tov = block_timeout;
+	res = setsockopt(fd, SOL_PACKET, PACKET_RX_RING, &req, sizeof(req));
+	if (res == -1)
+		return -1;
+
+	/* The TX ring does not support the block timeout */
+	req.tp_retire_blk_tov = 0;
+	res = setsockopt(fd, SOL_PACKET, PACKET_TX_RING, &req, sizeof(req));
+	if (res == -1)
+		return -1;
+
+	r->map_len = 2 * (size_t)block_size * block_nr;
+	r->map = mmap(NULL, r->map_len, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+	if (r->map == MAP_FAILED) {
+		r->map = NULL;
+		return -1;
+	}
+
+	r->block_size = block_size;
+	r->block_nr = block_nr;
+	r->rx_next = 0;
+	r->rx_release = 0;
+	r->rx_held = 0;
+	r->tx = r->map + (size_t)block_size * block_nr;
+	r->frame_size = frame_size;
+	r->frame_nr = req.tp_frame_nr;
+	r->tx_next = 0;
+	r->tx_pending = 0;
+	r->tx_lock = 0;
+	return 0;
+}
+
+int ring_enabled(int intidx)
+{
+	return rings && rings[intidx].map;
+}
+
+void *ring_rx_map(int intidx, unsigned int *block_size, unsigned int *block_nr)
+{
+	struct ring *r = &rings[intidx];
+
+	*block_size = r->block_size;
+	*block_nr = r->block_nr;
+	return r->map;
+}
+
+static struct tpacket_block_desc *rx_block(struct ring *r, unsigned int idx)
+{
+	return (struct tpacket_block_desc *)(r->map + (size_t)idx * r->block_size);
+}
+
+static int rx_ready(struct ring *r)
+{
+	struct tpacket_block_desc *block = rx_block(r, r->rx_next);
+
+	/* Every block is being read, rx_next wrapped around to a held block */
+	if (r->rx_held == r->block_nr)
+		return 0;
+	return __atomic_load_n(&block->hdr.bh1.block_status, __ATOMIC_ACQUIRE) & TP_STATUS_USER;
+}
+
+int ring_rx_next(int intidx)
+{
+	struct ring *r = &rings[intidx];
+	int idx = r->rx_next;
+
+	if (!rx_ready(r))
+		return -1;
+	r->rx_next = (r->rx_next + 1) % r->block_nr;
+	r->rx_held++;
+	return idx;
+}
+
+void ring_rx_release(int intidx)
+{
+	struct ring *r = &rings[intidx];
+	struct tpacket_block_desc *block = rx_block(r, r->rx_release);
+
+	__atomic_store_n(&block->hdr.bh1.block_status, TP_STATUS_KERNEL, __ATOMIC_RELEASE);
+	r->rx_release = (r->rx_release + 1) % r->block_nr;
+	r->rx_held--;
+}
+
+int ring_wait(int timeout)
+{
+	/*
+	 * Ports come from the shared epoll ready queue. POLLIN is also reported
+	 * while we hold blocks of a port, so a port without a new block is
+	 * simply dropped from the queue. For the same reason, checking without
+	 * a timeout only goes through the ports already queued.
+	 */
+	while (1) {
+		int i = timeout == 0 ? next_queued_interface() : next_ready_interface(timeout);
+		if (i == -1)
+			return -1;
+
+		if (ring_enabled(i) && rx_ready(&rings[i])) {
+			/* Its next block may be ready too, check again on its next turn */
+			requeue_interface(i);
+			return i;
+		}
+	}
+}
+
+int ring_send(int intidx, char *frame_data, size_t len)
+{
+	struct ring *r = &rings[intidx];
+	struct tpacket3_hdr *hdr;
+
+	if (len > r->frame_size - TPACKET3_HDRLEN)
+		return -1;
+
+	ring_lock(r);
+	hdr = (struct tpacket3_hdr *)(r->tx + (size_t)r->tx_next * r->frame_size);
+	if (__atomic_load_n(&hdr->tp_status, __ATOMIC_ACQUIRE) != TP_STATUS_AVAILABLE) {
+		/* The ring is full, push out what is queued and try once more */
+		send(interfaces[intidx], NULL, 0, 0);
+		r->tx_pending = 0;
+		if (__atomic_load_n(&hdr->tp_status, __ATOMIC_ACQUIRE) != TP_STATUS_AVAILABLE) {
+			ring_unlock(r);
+			return -1;
+		}
+	}
+
+	memcpy((uint8_t *)hdr + TPACKET3_HDRLEN - sizeof(struct sockaddr_ll), frame_data, len);
+	hdr->tp_len = len;
+	hdr->tp_snaplen = len;
+	hdr->tp_next_offset = 0;
+	__atomic_store_n(&hdr->tp_status, TP_STATUS_SEND_REQUEST, __ATOMIC_RELEASE);
+
+	r->tx_next = (r->tx_next + 1) % r->frame_nr;
+	r->tx_pending = 1;
+	ring_unlock(r);
+	return 0;
+}
+
+int ring_flush(void)
+{
+	int kicked = 0;
+
+	if (!rings)
+		return 0;
+
+	for (int i = 0; i < num_interfaces; i++) {
+		struct ring *r = &rings[i];
+		if (!r->map || !__atomic_load_n(&r->tx_pending, __ATOMIC_ACQUIRE))
+			continue;
+
+		r->tx_pending = 0;
+		if (send(interfaces[i], NULL, 0, MSG_DONTWAIT) == -1 && errno != EAGAIN)
+			DIE(1, "send");
+		kicked++;
+	}
+	return kicked;
+}
@@ -0,0 +1,340 @@
+#!/usr/bin/python3
+# Loopback link backend (--backend=loopback). Every link is a pair of
+# connected Unix datagram sockets (socketpair()) instead of an AF_PACKET socket
+# on a mininet interface, so switches and hosts can be wired together on any
+# Linux box, without mininet or root. A switch started with this backend gets
+# its interfaces as "name:fd" arguments, fd being its end of the link, which
+# the Loopback_network below creates and passes to the switch processes.
+#
+# Running this file starts the switches of configs/ wired like the mininet
+# topology of checker/topo.py and load-tests them from the hosts:
+#   python3 loopback.py --frames=20000 -- --batch=32
+import argparse
+import os
+import random
+import select
+import socket
+import struct
+import subprocess
+import sys
+import time
+from collections import deque
+
+import switch_log
+
+MAX_PACKET_LEN = 1600   # same as MAX_PACKET_LEN in wrapper.py
+MAX_BATCH = 64          # same as MAX_BATCH in lib.h
+RX_QUOTA = 16           # same as RX_QUOTA in lib.h
+
+# "name:fd" -> (name, fd)
+def parse_interface(arg: str):
+    name, _, fd = arg.rpartition(":")
+    if not name or not fd.isdigit():
+        raise ValueError(f"loopback interfaces are given as name:fd, not {arg!r}")
+    return name, int(fd)
+
+# The link layer functions of wrapper.py over the loopback sockets. Receiving
+# mirrors lib.c: the ready interfaces are queued and served round-robin, at
+# most RX_QUOTA frames at a time. Sends never block: a frame that does not fit
+# in the peer's queue is dropped, as a full NIC queue would.
+class Loopback_links:
+    def __init__(self, interface_args):
+        self.names = []
+        self.socks = []
+        for arg in interface_args:
+            name, fd = parse_interface(arg)
+            sock = socket.socket(fileno=fd)
+            sock.setblocking(False)
+            self.names.append(name)
+            self.socks.append(sock)
+        self.dropped = 0
+        self.select(range(len(self.socks)))
+
+    # Only receives from the given interfaces from now on. A new epoll
+    # instance is created, since a forked worker shares the parent's one.
+    def select(self, interface_ids):
+        self.epoll = select.epoll()
+        self.fd_ids = {}
+        for i in interface_ids:
+            self.epoll.register(self.socks[i].fileno(), select.EPOLLIN)
+            self.fd_ids[self.socks[i].fileno()] = i
+        self.ready = deque()
+
+    # Returns a ready interface, or -1 if none became ready within timeout
+    # seconds (-1 waits forever)
+    def next_ready(self, timeout):
+        if not self.ready:
+            self.ready.extend(self.fd_ids[fd] for fd, _ in self.epoll.poll(timeout))
+            if not self.ready:
+                return -1
+        return self.ready.popleft()
+
+    def recv_from_any_link(self):
+        while True:
+            interface = self.next_ready(-1)
+            try:
+                data = self.socks[interface].recv(MAX_PACKET_LEN)
+            except BlockingIOError:
+                continue
+            return interface, data, len(data)
+
+    # Reads up to max_frames frames, RX_QUOTA at a time from each ready
+    # interface; the interfaces that may have more are queued again.
+    # receive(sock) returns a frame or raises BlockingIOError.
+    def receive_ready(self, max_frames, receive):
+        batch = []
+        interface = self.next_ready(-1)
+        while interface != -1:
+            sock = self.socks[interface]
+            count = 0
+            while count < RX_QUOTA and len(batch) < max_frames:
+                try:
+                    batch.append((interface, receive(sock)))
+                except BlockingIOError:
+                    break
+                count += 1
+            else:
+                self.ready.append(interface)
+            if len(batch) >= max_frames:
+                break
+            interface = self.next_ready(0)
+        return batch
+
+    def recv_batch(self, max_frames=MAX_BATCH):
+        return self.receive_ready(max_frames, lambda sock: sock.recv(MAX_PACKET_LEN))
+
+    def recv_batch_from(self, interface, max_frames=MAX_BATCH):
+        frames = []
+        sock = self.socks[interface]
+        while len(frames) < max_frames:
+            try:
+                frames.append(sock.recv(MAX_PACKET_LEN))
+            except BlockingIOError:
+                break
+        return frames
+
+    def recv_batch_into(self, pool, max_frames=MAX_BATCH):
+        count = min(max_frames, MAX_BATCH, len(pool.free))
+        assert count > 0, "no free slots left in the frame pool"
+
+        def receive(sock):
+            slot = pool.free[-1]
+            length = sock.recv_into(pool.views[slot])
+            pool.free.pop()
+            return slot, pool.views[slot][:length]
+
+        return [(interface, slot, data) for interface, (slot, data)
+                in self.receive_ready(count, receive)]
+
+    def interface_fd(self, interface):
+        return self.socks[interface].fileno()
+
+    def send_to_link(self, interface, length, buffer):
+        try:
+            self.socks[interface].send(buffer)
+        except (BlockingIOError, ConnectionError):
+            # Logged as wrapper.tx_full() does
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                switch_log.io.warning("Link %s full or closed, %d frames dropped so far",
+                                      self.names[interface], self.dropped)
+
+    def send_to_links(self, interfaces, buffer):
+        for interface in interfaces:
+            self.send_to_link(interface, len(buffer), buffer)
+
+    def get_interface_name(self, interface):
+        return self.names[interface]
+
+    # Locally administered, unique per switch process
+    def get_switch_mac(self):
+        return b'\x02\x00' + os.getpid().to_bytes(4, "big")
+
+# Switches and hosts wired like checker/topo.py: switch i has access links
+# r-0 .. r-<hosts-1> to hosts h-<i*hosts> .. and a trunk rr-<i>-<j> to every
+# other switch j (i < j). The switches run switch.py with their config file;
+# the hosts are sockets of this process.
+class Loopback_network:
+    def __init__(self, switches=3, hosts=2, options=(), output=subprocess.DEVNULL):
+        self.switches = switches
+        self.hosts_per_switch = hosts
+        self.options = list(options)
+        self.output = output
+        # host name -> its end of the access link
+        self.hosts = {}
+        # host name -> VLAN of its access port, None if the switch has no
+        # such port
+        self.host_vlans = {}
+        self.processes = []
+        # Ends of links whose other end has no switch, kept open
+        self.unwired = []
+
+    # (name, "T" or the VLAN ID) of the interfaces, in the config file's order
+    @staticmethod
+    def config_interfaces(switch_id):
+        with open(f"configs/switch{switch_id}.cfg") as file:
+            lines = file.read().split("\n")[1:]
+        return [tuple(line.split()[:2]) for line in lines if line.strip()]
+
+    def host_mac(self, host):
+        return bytes([0x02, 0, 0, 0, 0, int(host[2:]) + 1])
+
+    def mac_host(self, mac):
+        return f"h-{mac[5] - 1}"
+
+    def start(self):
+        # (switch, interface name) -> the switch's end of the link
+        ends = {}
+        for i in range(self.switches):
+            for j in range(i + 1, self.switches):
+                ends[(i, f"rr-{i}-{j}")], ends[(j, f"rr-{i}-{j}")] = self.socketpair()
+            for j in range(self.hosts_per_switch):
+                host = f"h-{i * self.hosts_per_switch + j}"
+                ends[(i, f"r-{j}")], self.hosts[host] = self.socketpair()
+                self.hosts[host].setblocking(False)
+
+        for i in range(self.switches):
+            # In the order of the config file, which gives the interface ids
+            config = self.config_interfaces(i)
+            names = [name for name, _ in config]
+            access_vlans = {name: int(field) for name, field in config if field != "T"}
+            for j in range(self.hosts_per_switch):
+                self.host_vlans[f"h-{i * self.hosts_per_switch + j}"] = access_vlans.get(f"r-{j}")
+            for name in names:
+                if (i, name) not in ends:
+                    ends[(i, name)], unwired = self.socketpair()
+                    self.unwired.append(unwired)
+            fds = [ends[(i, name)].fileno() for name in names]
+            interfaces = [f"{name}:{fd}" for name, fd in zip(names, fds)]
+            self.processes.append(subprocess.Popen(
+                [sys.executable, "switch.py", str(i), "--backend=loopback"] + self.options + interfaces,
+                pass_fds=fds, stdout=self.output, stderr=self.output))
+        for sock in ends.values():
+            sock.close()
+
+    @staticmethod
+    def socketpair():
+        a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        for sock in (a, b):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        return a, b
+
+    # Returns the frames received by each host within timeout seconds
+    def drain(self, timeout=0.2):
+        received = {host: [] for host in self.hosts}
+        socks = {sock.fileno(): host for host, sock in self.hosts.items()}
+        poller = select.epoll()
+        for fd in socks:
+            poller.register(fd, select.EPOLLIN)
+        end = time.monotonic() + timeout
+        # At least one pass, drain(0) takes what is already queued
+        while True:
+            for fd, _ in poller.poll(max(0.0, end - time.monotonic())):
+                sock = self.hosts[socks[fd]]
+                while True:
+                    try:
+                        received[socks[fd]].append(sock.recv(MAX_PACKET_LEN))
+                    except BlockingIOError:
+                        break
+            if time.monotonic() >= end:
+                break
+        poller.close()
+        return received
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait()
+
+# The payload starts with a sequence number, so every copy of a frame can be
+# told apart from the others
+def frame(dest_mac, src_mac, sequence=0):
+    return dest_mac + src_mac + b'\x08\x00' + struct.pack("!I", sequence) + b'x' * 42
+
+# Every host broadcasts once so the switches learn all MACs, then the hosts
+# send frames to random other hosts. Every frame received is checked:
+#   delivered: received by its destination, in the sender's VLAN (counted
+#              once per frame, later copies are duplicates)
+#   flood copies: received by another host of the sender's VLAN, as when the
+#              destination is unknown or in another VLAN
+#   misdelivered: received outside the sender's VLAN, or not a test frame
+# Only the frames whose destination is in the sender's VLAN are expected.
+def load_test(network, frames, settle):
+    time.sleep(settle)
+    for host, sock in network.hosts.items():
+        sock.send(frame(b'\xff' * 6, network.host_mac(host)))
+    network.drain(0.5)
+
+    rng = random.Random(0)
+    hosts = list(network.hosts)
+    vlans = network.host_vlans
+    result = {"sent": 0, "expected": 0, "delivered": 0, "duplicates": 0,
+              "flood_copies": 0, "misdelivered": 0}
+    seen = set()
+
+    def check(received):
+        for host, datas in received.items():
+            for data in datas:
+                src = network.mac_host(data[6:12])
+                if len(data) < 18 or data[12:14] != b'\x08\x00' or src not in vlans:
+                    result["misdelivered"] += 1
+                elif vlans[host] is None or vlans[host] != vlans[src]:
+                    result["misdelivered"] += 1
+                elif data[0:6] != network.host_mac(host):
+                    result["flood_copies"] += 1
+                else:
+                    sequence = struct.unpack_from("!I", data, 14)[0]
+                    if sequence in seen:
+                        result["duplicates"] += 1
+                    else:
+                        seen.add(sequence)
+                        result["delivered"] += 1
+
+    start = time.monotonic()
+    for n in range(frames):
+        src, dest = rng.sample(hosts, 2)
+        try:
+            network.hosts[src].send(frame(network.host_mac(dest), network.host_mac(src), n))
+        except BlockingIOError:
+            continue
+        result["sent"] += 1
+        if vlans[src] is not None and vlans[src] == vlans[dest]:
+            result["expected"] += 1
+        if n % 256 == 255:
+            check(network.drain(0))
+    check(network.drain(0.5))
+    result["elapsed"] = time.monotonic() - start - 0.5
+    return result
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Run the switches over loopback links and load-test them",
+        epilog="arguments after -- are passed to switch.py, e.g. -- --batch=32")
+    parser.add_argument("--switches", type=int, default=3)
+    parser.add_argument("--hosts", type=int, default=2, help="hosts per switch")
+    parser.add_argument("--frames", type=int, default=10000, help="frames sent by the hosts")
+    parser.add_argument("--settle", type=float, default=2.0,
+                        help="seconds given to STP before sending")
+    parser.add_argument("--verbose", action="store_true", help="show the switches' output")
+    args, options = parser.parse_known_args(argv)
+    options = [option for option in options if option != "--"]
+
+    network = Loopback_network(args.switches, args.hosts, options,
+                               None if args.verbose else subprocess.DEVNULL)
+    network.start()
+    try:
+        result = load_test(network, args.frames, args.settle)
+    finally:
+        network.stop()
+    elapsed = result["elapsed"]
+    print(f"{result['sent']} frames sent, {result['delivered']} of the {result['expected']} within "
+          f"a VLAN delivered in {elapsed:.2f} s ({result['delivered'] / elapsed:.0f} frames/s)")
+    print(f"  {result['flood_copies']} flood copies, {result['duplicates']} duplicates, "
+          f"{result['misdelivered']} misdelivered")
+    return 1 if (result["delivered"] < result["expected"] or result["misdelivered"]
+                 or result["duplicates"]) else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
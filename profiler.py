@@ -0,0 +1,85 @@
+# On-demand sampling profiler. kill -USR2 <pid> makes a running switch sample
+# the stacks of its receive thread (the coordinator's main thread with
+# --workers, which passes the signal on to its workers) and of its BPDU
+# thread, from a thread of its own, for --profile-seconds at --profile-hz.
+# The samples are written in the collapsed format of flamegraph tools, one
+# "frame;frame;... count" line per distinct stack, to
+# profile-<SWITCH_ID>.folded (profile-<SWITCH_ID>-<worker>.folded for the
+# workers):
+#   flamegraph.pl profile-0.folded > profile-0.svg
+#
+# Samples are taken by wall clock: a thread waiting in a receive call or in
+# sleep() shows up under that call. Every stack starts with a frame tagging
+# the switch's state when the profile started (CAM entries, STP ports by
+# state), followed by the thread's name.
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+import switch_log
+
+# "function (file:first line)" of the code objects seen, the same function
+# always gets the same frame whatever line it was at
+_labels = {}
+
+def frame_label(code):
+    label = _labels.get(code)
+    if label is None:
+        label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        _labels[code] = label
+    return label
+
+# The frames from the outermost call to frame, joined with ";"
+def collapse(frame):
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame.f_code))
+        frame = frame.f_back
+    labels.reverse()
+    return ";".join(labels)
+
+class Profiler:
+    # threads maps a name to the ident of a thread to sample, tag is the
+    # root frame of every stack
+    def __init__(self, threads: dict, tag: str, path: str, seconds: float = 10.0, hz: float = 100.0):
+        self.threads = threads
+        self.tag = tag.replace(";", ",")
+        self.path = path
+        self.seconds = seconds
+        self.interval = 1.0 / hz
+        self.stacks = Counter()
+        self.samples = 0
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+        return self
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def run(self):
+        end = time.monotonic() + self.seconds
+        next_sample = time.monotonic()
+        while next_sample < end:
+            self.sample()
+            next_sample += self.interval
+            time.sleep(max(0.0, next_sample - time.monotonic()))
+        self.write()
+
+    def sample(self):
+        frames = sys._current_frames()
+        for name, ident in self.threads.items():
+            frame = frames.get(ident)
+            if frame is not None:
+                self.stacks[f"{name};{collapse(frame)}"] += 1
+        self.samples += 1
+
+    def write(self):
+        with open(self.path, "w") as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f"{self.tag};{stack} {count}\n")
+        switch_log.fwd.warning("Wrote %d samples of %d stacks to %s", self.samples, len(self.stacks), self.path)
@@ -0,0 +1,273 @@
+#!/usr/bin/python3
+# Offline replay of recorded traffic through the switch. Frames are read from
+# pcap or pcapng captures, merged in timestamp order and handed to the
+# process_frame() of switch.py (so to handle_bpdu_frame() and forward_frame()),
+# with send_to_link()/send_to_links() replaced by per-egress-port pcap writers.
+# The CAM and STP run on the capture's clock, so a replay is deterministic;
+# --realtime additionally paces the frames as they were captured.
+#
+# Inputs are NAME=FILE for the capture of one ingress port, or a multi-interface
+# pcapng such as the checker's router<i>.pcap, split by interface name (frames
+# marked as outbound are skipped). Interface names and ids come from the
+# switch's config file.
+#   python3 replay.py 0 r-0=h0.pcap rr-0-1=trunk.pcap --out=replay-out
+#   python3 replay.py 0 router0.pcap --out=replay-out --stp=rapid
+import argparse
+import heapq
+import os
+import struct
+import sys
+import time
+
+import switch
+import switch_log
+from stp import MULTICAST_MAC, FLAG_AGREEMENT, parse_bpdu_flags
+
+LINKTYPE_ETHERNET = 1
+PCAP_MAGIC = {b'\xd4\xc3\xb2\xa1': ("<", 1e-6), b'\xa1\xb2\xc3\xd4': (">", 1e-6),
+              b'\x4d\x3c\xb2\xa1': ("<", 1e-9), b'\xa1\xb2\x3c\x4d': (">", 1e-9)}
+PCAPNG_SECTION = 0x0A0D0D0A
+PCAPNG_INTERFACE = 1
+PCAPNG_SIMPLE_PACKET = 3
+PCAPNG_ENHANCED_PACKET = 6
+# pcapng option codes and the outbound value of the epb_flags direction bits
+OPTION_END = 0
+OPTION_IF_NAME = 2
+OPTION_IF_TSRESOL = 9
+OPTION_EPB_FLAGS = 2
+DIRECTION_OUTBOUND = 2
+
+# Yields (timestamp, interface name or None, frame) from a pcap or pcapng file
+def read_capture(path):
+    with open(path, "rb") as file:
+        data = file.read()
+    if data[:4] in PCAP_MAGIC:
+        return read_pcap(data, path)
+    if struct.unpack_from("<I", data)[0] == PCAPNG_SECTION:
+        return read_pcapng(data, path)
+    raise ValueError(f"{path} is neither a pcap nor a pcapng file")
+
+def read_pcap(data, path):
+    order, resolution = PCAP_MAGIC[data[:4]]
+    if struct.unpack_from(order + "I", data, 20)[0] != LINKTYPE_ETHERNET:
+        raise ValueError(f"{path} is not an Ethernet capture")
+    record = struct.Struct(order + "IIII")
+    offset = 24
+    while offset + record.size <= len(data):
+        seconds, fraction, length, _ = record.unpack_from(data, offset)
+        offset += record.size
+        yield seconds + fraction * resolution, None, data[offset:offset + length]
+        offset += length
+
+# Returns {code: value} of the options starting at offset
+def pcapng_options(data, offset, end, order):
+    options = {}
+    while offset + 4 <= end:
+        code, length = struct.unpack_from(order + "HH", data, offset)
+        if code == OPTION_END:
+            break
+        options[code] = data[offset + 4:offset + 4 + length]
+        offset += 4 + (length + 3) // 4 * 4
+    return options
+
+def read_pcapng(data, path):
+    offset = 0
+    order = "<"
+    # Per interface of the current section: (name, linktype, resolution)
+    interfaces = []
+    while offset + 12 <= len(data):
+        block_type = struct.unpack_from(order + "I", data, offset)[0]
+        if block_type == PCAPNG_SECTION:
+            order = "<" if data[offset + 8:offset + 12] == b'\x4d\x3c\x2b\x1a' else ">"
+            interfaces = []
+        block_length = struct.unpack_from(order + "I", data, offset + 4)[0]
+        body = offset + 8
+        end = offset + block_length - 4
+
+        if block_type == PCAPNG_INTERFACE:
+            linktype = struct.unpack_from(order + "H", data, body)[0]
+            options = pcapng_options(data, body + 8, end, order)
+            name = options.get(OPTION_IF_NAME, b"").rstrip(b"\0").decode() or None
+            resolution = 1e-6
+            if OPTION_IF_TSRESOL in options:
+                value = options[OPTION_IF_TSRESOL][0]
+                resolution = 2.0 ** -(value & 0x7F) if value & 0x80 else 10.0 ** -value
+            interfaces.append((name, linktype, resolution))
+        elif block_type == PCAPNG_ENHANCED_PACKET:
+            interface, high, low, length = struct.unpack_from(order + "IIII", data, body)
+            name, linktype, resolution = interfaces[interface]
+            packet = body + 20
+            options = pcapng_options(data, packet + (length + 3) // 4 * 4, end, order)
+            flags = options.get(OPTION_EPB_FLAGS)
+            outbound = flags is not None and struct.unpack(order + "I", flags)[0] & 3 == DIRECTION_OUTBOUND
+            if linktype == LINKTYPE_ETHERNET and not outbound:
+                yield ((high << 32) | low) * resolution, name, data[packet:packet + length]
+        elif block_type == PCAPNG_SIMPLE_PACKET:
+            length = struct.unpack_from(order + "I", data, body)[0]
+            yield 0.0, interfaces[0][0] if interfaces else None, data[body + 4:body + 4 + length]
+        offset += block_length
+
+# Classic pcap with microsecond timestamps
+class Pcap_writer:
+    HEADER = struct.Struct("<IHHiIII")
+    RECORD = struct.Struct("<IIII")
+
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.file.write(self.HEADER.pack(0xa1b2c3d4, 2, 4, 0, 0, 65535, LINKTYPE_ETHERNET))
+        self.frames = 0
+
+    def write(self, timestamp, frame):
+        seconds = int(timestamp)
+        self.file.write(self.RECORD.pack(seconds, int((timestamp - seconds) * 1e6),
+                                         len(frame), len(frame)))
+        self.file.write(frame)
+        self.frames += 1
+
+    def close(self):
+        self.file.close()
+
+# Stand-in for the link layer of switch.py, writes every sent frame to the
+# capture of its egress port, stamped with the time of the frame being handled
+class Egress_captures:
+    def __init__(self, directory, names):
+        os.makedirs(directory, exist_ok=True)
+        self.writers = [Pcap_writer(os.path.join(directory, f"{name}.pcap")) for name in names]
+        self.now = 0.0
+        self.bytes = 0
+        # port id -> time of the first data frame (not a BPDU) sent on it
+        self.first_data = {}
+
+    def send_to_link(self, interface_id, length, data):
+        self.writers[interface_id].write(self.now, bytes(data))
+        self.bytes += length
+        if data[0:6] != MULTICAST_MAC and interface_id not in self.first_data:
+            self.first_data[interface_id] = self.now
+
+    def send_to_links(self, interface_ids, data):
+        for interface_id in interface_ids:
+            self.send_to_link(interface_id, len(data), data)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+# Yields (timestamp, ingress port id, frame) of all the inputs, in time order
+def merge_inputs(inputs, ids):
+    streams = []
+    for spec in inputs:
+        name, _, path = spec.rpartition("=")
+        if name and name not in ids:
+            raise ValueError(f"{name} is not an interface of this switch")
+
+        def frames(path=path, name=name):
+            for timestamp, interface_name, frame in read_capture(path):
+                interface_name = name or interface_name
+                if interface_name in ids:
+                    yield timestamp, ids[interface_name], frame
+        streams.append(frames())
+    return heapq.merge(*streams, key=lambda item: item[0])
+
+def replay(switch_id, inputs, out, realtime=False, stp_mode="legacy"):
+    switch.parse_switch_info(switch_id)
+    names = [switch.interfaces[i].name for i in range(len(switch.interfaces))]
+    captures = Egress_captures(out, names)
+    switch.send_to_link = captures.send_to_link
+    switch.send_to_links = captures.send_to_links
+
+    frames_in = 0
+    bytes_in = 0
+    next_hello = None
+    first = None
+    # port id -> time of the first agreement received on it
+    agreed_at = {}
+    start = time.perf_counter()
+    for timestamp, interface_id, frame in merge_inputs(inputs, {n: i for i, n in enumerate(names)}):
+        if first is None:
+            # The STP starts at the capture's first frame, so its timers
+            # (proposal deadlines, ages) count from there
+            first = timestamp
+            next_hello = timestamp
+            captures.now = timestamp
+            switch.init_stp(stp_mode, clock=lambda: captures.now)
+        if realtime:
+            delay = (timestamp - first) - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        # The STP timer runs on the capture's clock too
+        while next_hello <= timestamp:
+            captures.now = next_hello
+            switch.stp.tick(next_hello)
+            next_hello += switch.hello_interval
+        captures.now = timestamp
+        if frame[0:6] == MULTICAST_MAC and interface_id not in agreed_at:
+            flags = parse_bpdu_flags(frame)
+            if flags is not None and flags & FLAG_AGREEMENT:
+                agreed_at[interface_id] = timestamp
+        switch.cam.tick(timestamp)
+        switch.update_forwarding_tables()
+        switch.process_frame(interface_id, frame, len(frame))
+        frames_in += 1
+        bytes_in += len(frame)
+    elapsed = time.perf_counter() - start
+    captures.close()
+
+    return {
+        "frames_in": frames_in,
+        "frames_out": sum(writer.frames for writer in captures.writers),
+        "bytes_in": bytes_in,
+        "bytes_out": captures.bytes,
+        "elapsed": elapsed,
+        "capture_duration": 0.0 if first is None else timestamp - first,
+        "per_port_out": {name: writer.frames for name, writer in zip(names, captures.writers)},
+        "start": first,
+        "first_data_out": {names[i]: at for i, at in captures.first_data.items()},
+        "agreed_at": {names[i]: at for i, at in agreed_at.items()},
+    }
+
+# In the rapid mode a trunk blocks until its peer agrees or forward_delay has
+# passed. Returns the trunks of the replay that sent data frames before that,
+# as (name, seconds into the capture).
+def check_trunk_handshake(result, forward_delay):
+    early = []
+    for i, link in switch.interfaces.items():
+        sent_at = result["first_data_out"].get(link.name)
+        if not link.is_trunk or sent_at is None:
+            continue
+        allowed_at = min(result["start"] + forward_delay,
+                         result["agreed_at"].get(link.name, float("inf")))
+        if sent_at < allowed_at:
+            early.append((link.name, sent_at - result["start"]))
+    return early
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Replay captures through the switch")
+    parser.add_argument("switch_id")
+    parser.add_argument("inputs", nargs="+", help="NAME=FILE per ingress port, or a multi-interface pcapng")
+    parser.add_argument("--out", default="replay-out", help="directory of the per-egress-port pcaps")
+    parser.add_argument("--realtime", action="store_true", help="pace the frames as captured")
+    parser.add_argument("--stp", default="legacy", choices=("legacy", "rapid"), help="STP mode")
+    parser.add_argument("--hello", type=float, default=switch.hello_interval)
+    parser.add_argument("--check", action="store_true",
+                        help="fail if a trunk forwarded before the rapid mode handshake allowed it")
+    parser.add_argument("--log", default="warning")
+    args = parser.parse_args(argv)
+
+    switch_log.setup(args.log)
+    switch.hello_interval = args.hello
+    result = replay(args.switch_id, args.inputs, args.out, args.realtime, args.stp)
+    elapsed = max(result["elapsed"], 1e-9)
+    print(f"{result['frames_in']} frames in, {result['frames_out']} out in {elapsed:.3f} s: "
+          f"{result['frames_in'] / elapsed:.0f} frames/s, "
+          f"{result['bytes_in'] * 8 / elapsed / 1e6:.1f} Mbit/s in")
+    print("  out per port: " + ", ".join(f"{name}={count}" for name, count in result["per_port_out"].items()))
+    if args.check and args.stp == "rapid" and result["start"] is not None:
+        early = check_trunk_handshake(result, switch.stp.forward_delay)
+        for name, at in early:
+            print(f"  {name} forwarded data {at:.3f} s in, before an agreement or the forward delay")
+        if early:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,166 @@
+# CAM table shared by the forwarding processes of a switch (--workers=N).
+#
+# The table is a fixed-size open-addressing hash table in a
+# multiprocessing.shared_memory segment, so every worker learns into and looks
+# up the same entries. Each slot is protected by a sequence lock: writers
+# (serialized by one lock, they only run for new or moved MACs and for a
+# once-per-second refresh) make the sequence odd while they update the slot,
+# and readers retry whenever they saw an odd or changed sequence. Lookups,
+# which are the common case, never take a lock.
+import struct
+import time
+from multiprocessing import shared_memory
+
+# seq, port, key (see make_key(), 0 for an empty slot), last_seen
+SLOT = struct.Struct("<IiQd")
+# Slots probed after the home slot of a key before giving up
+MAX_PROBES = 16
+# Last seen time of a forgotten entry
+EXPIRED = float("-inf")
+
+# The top bit keeps the key of VLAN 0 and MAC 00:00:00:00:00:00 non-zero
+def make_key(vlan: int, mac: int):
+    return (1 << 63) | ((vlan & 0xFFF) << 48) | mac
+
+def home_slot(key: int, mask: int):
+    return (key ^ (key >> 17) ^ (key >> 48)) & mask
+
+class Shared_CAM_table:
+    def __init__(self, capacity: int, lock, aging_time: float = 300.0, name=None):
+        slots = 1
+        while slots < 2 * capacity:
+            slots <<= 1
+        self.slots = slots
+        self.mask = slots - 1
+        self.capacity = capacity
+        self.aging_time = aging_time
+        # Entries are only rewritten once their timestamp is this old
+        self.refresh_interval = 1.0
+        self.lock = lock
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=slots * SLOT.size)
+            self.shm.buf[:] = bytes(slots * SLOT.size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.buf = self.shm.buf
+        self.now = time.monotonic()
+        # Port id -> interface, set by each process with its own interfaces
+        self.interfaces = {}
+        # Counted per process
+        self.evicted = 0
+        self.aged = 0
+
+    # Aging is checked by lookup() and old entries are overwritten by
+    # learn(), so there is nothing to sweep
+    def tick(self, now: float):
+        self.now = now
+
+    def _read(self, offset):
+        buf = self.buf
+        while True:
+            seq, port, key, last_seen = SLOT.unpack_from(buf, offset)
+            if seq & 1 == 0 and SLOT.unpack_from(buf, offset)[0] == seq:
+                return port, key, last_seen
+
+    def _write(self, offset, port, key, last_seen):
+        seq = SLOT.unpack_from(self.buf, offset)[0]
+        struct.pack_into("<I", self.buf, offset, seq + 1)
+        SLOT.pack_into(self.buf, offset, seq + 1, port, key, last_seen)
+        struct.pack_into("<I", self.buf, offset, seq + 2)
+
+    # Returns (slot offset, port, last seen) of key, or None. The port and
+    # last seen time come from the read that matched the key, the slot may
+    # hold another key by the time it is read again.
+    def _find(self, key):
+        index = home_slot(key, self.mask)
+        for _ in range(MAX_PROBES):
+            offset = index * SLOT.size
+            port, slot_key, last_seen = self._read(offset)
+            if slot_key == key:
+                return offset, port, last_seen
+            if slot_key == 0:
+                return None
+            index = (index + 1) & self.mask
+        return None
+
+    # Returns whether the MAC moved, as CAM_table.learn()
+    def learn(self, vlan: int, mac: int, interface):
+        key = make_key(vlan, mac)
+        found = self._find(key)
+        if found is not None:
+            _, port, last_seen = found
+            if port == interface.id and self.now - last_seen < self.refresh_interval:
+                return False
+
+        with self.lock:
+            # The probe sequence is walked again under the lock, another
+            # worker may have learned the same key in the meantime
+            index = home_slot(key, self.mask)
+            target = -1
+            oldest = None
+            moved = False
+            for _ in range(MAX_PROBES):
+                offset = index * SLOT.size
+                port, slot_key, last_seen = SLOT.unpack_from(self.buf, offset)[1:]
+                if slot_key == key or slot_key == 0:
+                    target = offset
+                    moved = slot_key == key and port != interface.id and self.now - last_seen <= self.aging_time
+                    break
+                if oldest is None or last_seen < oldest[1]:
+                    oldest = (offset, last_seen)
+                index = (index + 1) & self.mask
+
+            if target == -1:
+                # The probe window is full, reuse its least recently seen slot
+                target, last_seen = oldest
+                if self.now - last_seen > self.aging_time:
+                    self.aged += 1
+                else:
+                    self.evicted += 1
+            self._write(target, interface.id, key, self.now)
+        return moved
+
+    def lookup(self, vlan: int, mac: int):
+        found = self._find(make_key(vlan, mac))
+        if found is None:
+            return None
+        _, port, last_seen = found
+        if self.now - last_seen > self.aging_time:
+            return None
+        return self.interfaces.get(port)
+
+    # (vlan, mac, port id, last seen) of the entries that have not expired
+    def export(self):
+        entries = []
+        oldest = self.now - self.aging_time
+        for offset in range(0, self.slots * SLOT.size, SLOT.size):
+            port, key, last_seen = self._read(offset)
+            if key != 0 and last_seen >= oldest:
+                entries.append(((key >> 48) & 0xFFF, key & 0xFFFFFFFFFFFF, port, last_seen))
+        return entries
+
+    # Expires the entries learned on the ports, e.g. after their VLAN changed.
+    # Slots are never emptied, a later learn() of the key reuses the slot.
+    def forget_ports(self, port_ids):
+        forgotten = 0
+        with self.lock:
+            for offset in range(0, self.slots * SLOT.size, SLOT.size):
+                _, port, key, last_seen = SLOT.unpack_from(self.buf, offset)
+                if key != 0 and port in port_ids and last_seen != EXPIRED:
+                    self._write(offset, port, key, EXPIRED)
+                    forgotten += 1
+        return forgotten
+
+    def stats(self):
+        entries = 0
+        for offset in range(0, self.slots * SLOT.size, SLOT.size):
+            if SLOT.unpack_from(self.buf, offset)[2] != 0:
+                entries += 1
+        return {"entries": entries, "capacity": self.capacity,
+                "evicted": self.evicted, "aged": self.aged}
+
+    def close(self, unlink=False):
+        self.buf = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
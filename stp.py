@@ -0,0 +1,479 @@
+# STP state machine of the switch.
+#
+# All switches in the testing topology understand this custom STP protocol, so
+# we'll make a custom BPDU frame header for easier parsing, as following:
+# MAC_MULTICAST(6 BYTES) | OWN_BID (8 BYTES) | ROOT_BRIDGE_ID (8 BYTES) | ROOT_PATH_COST(4 BYTES)
+#
+# The state machine is changed from several threads: received BPDUs, the
+# timer's tick() and link checks, reconfigure() on a config reload and
+# restore() on a warm start. Every change is made under one lock, stp_lock in
+# switch.py. Everybody else (the forwarding path, the hello sender) only reads
+# self.snapshot, an immutable Port_snapshot that is replaced as a whole after
+# every change, so a reader always sees one consistent topology without
+# taking the lock. The snapshot version lets readers cache whatever they
+# derive from it.
+import struct
+import time
+from collections import namedtuple
+
+import switch_log
+from data_structs import Port_state
+
+MULTICAST_MAC = b'\x01\x80\xc2\x00\x00\x00'
+BPDU = struct.Struct('!6sQQI')
+# Rapid mode BPDUs append a flags byte, ignored by switches in the legacy mode
+RAPID_BPDU = struct.Struct('!6sQQIB')
+FLAG_PROPOSAL = 0x01
+FLAG_AGREEMENT = 0x02
+# Set in every rapid BPDU, so a zero padding byte is not taken for flags
+FLAG_RAPID = 0x80
+# all links have a mock 100 Mbps latency, so any link cost is a standard value
+LINK_COST = 10
+
+DESIGNATED = Port_state.DESIGNATED
+ROOT = Port_state.ROOT
+BLOCKING = Port_state.BLOCKING
+# Port role of the rapid mode, the port is BLOCKING
+ALTERNATE = Port_state.ALTERNATE
+
+# states[port id] is the state of that port
+Port_snapshot = namedtuple("Port_snapshot", "version own_bid root_bid root_path_cost states")
+
+def parse_bpdu_frame(data):
+    bpdu_bid = int.from_bytes(data[6:14], byteorder = "big")
+    bpdu_root_bid = int.from_bytes(data[14:22], byteorder = "big")
+    bpdu_root_path_cost = int.from_bytes(data[22:26], byteorder = "big")
+
+    return bpdu_bid, bpdu_root_bid, bpdu_root_path_cost
+
+def make_bpdu_frame(bid, root_bid, root_path_cost):
+    return BPDU.pack(MULTICAST_MAC, bid, root_bid, root_path_cost)
+
+# Returns the flags of a rapid BPDU, or None for a legacy one
+def parse_bpdu_flags(data):
+    if len(data) < RAPID_BPDU.size or not data[26] & FLAG_RAPID:
+        return None
+    return data[26]
+
+def make_rapid_bpdu_frame(bid, root_bid, root_path_cost, flags=0):
+    return RAPID_BPDU.pack(MULTICAST_MAC, bid, root_bid, root_path_cost, FLAG_RAPID | flags)
+
+class STP:
+    # interfaces maps port ids (0 .. n - 1) to interfaces, send(port id, frame)
+    # transmits a BPDU
+    def __init__(self, own_bid: int, interfaces: dict, send):
+        self.send = send
+        self.trunk_ids = [i.id for i in interfaces.values() if i.is_trunk]
+        # When firstly initialized, each switch considers itself the root bridge
+        self.own_bid = own_bid
+        self.root_bid = own_bid
+        self.root_path_cost = 0
+        # Each port starts in the state it was configured with (DESIGNATED)
+        self.states = [interfaces[i].state for i in range(len(interfaces))]
+        # Time by which BPDUs must have confirmed a restored state, see restore()
+        self.confirm_by = None
+        # Whether the root's hello was relayed since the last tick()
+        self.relayed = False
+        self.snapshot = None
+        self.publish()
+
+    def publish(self):
+        version = 0 if self.snapshot is None else self.snapshot.version + 1
+        self.snapshot = Port_snapshot(version, self.own_bid, self.root_bid,
+                                      self.root_path_cost, tuple(self.states))
+
+    # Replaces the snapshot with one computed elsewhere, used by the
+    # forwarding workers to follow the coordinator's state machine
+    def load_snapshot(self, snapshot: Port_snapshot):
+        self.snapshot = snapshot
+
+    # Sends hellos on the trunk ports if this switch is the root bridge
+    def send_hellos(self):
+        snapshot = self.snapshot
+        if snapshot.own_bid != snapshot.root_bid:
+            return False
+        frame = make_bpdu_frame(snapshot.own_bid, snapshot.root_bid, snapshot.root_path_cost)
+        for port_id in self.trunk_ids:
+            self.send(port_id, frame)
+        return True
+
+    # Called every hello interval. Returns whether the snapshot changed.
+    def tick(self, now: float):
+        self.relayed = False
+        changed = self.check_confirmed(now)
+        self.send_hellos()
+        return changed
+
+    # Takes the root information and port states saved by an earlier run
+    # (warm start, see warm_state.py) instead of claiming the root. Unless the
+    # root's BPDU arrives on the restored root port (from the root or relayed
+    # by the switch above, see handle_bpdu()) or a better root is heard by
+    # confirm_by, the switch starts over as if it had just been started.
+    def restore(self, root_bid: int, root_path_cost: int, states, port_info, confirm_by: float):
+        if root_bid > self.own_bid:
+            return False
+        self.root_bid = root_bid
+        self.root_path_cost = root_path_cost
+        for port_id in self.trunk_ids:
+            self.states[port_id] = states[port_id]
+        self.confirm_by = None if root_bid == self.own_bid else confirm_by
+        self.publish()
+        return True
+
+    def check_confirmed(self, now: float):
+        if self.confirm_by is None or now < self.confirm_by:
+            return False
+        switch_log.stp.warning("The restored root %d was not confirmed by a BPDU, starting over",
+                               self.root_bid)
+        self.confirm_by = None
+        self.root_bid = self.own_bid
+        self.root_path_cost = 0
+        for i in self.trunk_ids:
+            self.states[i] = DESIGNATED
+        self.publish()
+        return True
+
+    # Makes port_id the root port, towards root_bid at root_path_cost. The
+    # old root port blocks, and so do the other trunks for a new root, until
+    # the BPDUs say they are designated. The new path is announced on every
+    # trunk, the root port included: the switch above learns from it that
+    # its end of the link is designated.
+    def take_root_port(self, port_id: int, root_bid: int, root_path_cost: int):
+        states = self.states
+        for i in self.trunk_ids:
+            if root_bid != self.root_bid or states[i] == ROOT:
+                states[i] = BLOCKING
+        states[port_id] = ROOT
+        self.root_bid = root_bid
+        self.root_path_cost = root_path_cost
+
+        bpdu_frame = make_bpdu_frame(self.own_bid, self.root_bid, self.root_path_cost)
+        for i in self.trunk_ids:
+            self.send(i, bpdu_frame)
+
+    # Updates the state machine with a received BPDU. Returns whether the
+    # snapshot changed.
+    def handle_bpdu(self, data, port_id: int):
+        states = self.states
+        before = (self.root_bid, self.root_path_cost, list(states))
+
+        bpdu_bid, bpdu_root_bid, bpdu_root_path_cost = parse_bpdu_frame(data)
+        if self.confirm_by is not None and (bpdu_root_bid < self.root_bid or
+                                            bpdu_root_bid == self.root_bid and states[port_id] == ROOT):
+            self.confirm_by = None
+        if (bpdu_root_bid < self.root_bid):
+            self.take_root_port(port_id, bpdu_root_bid, bpdu_root_path_cost + LINK_COST)
+        elif (bpdu_root_bid == self.root_bid):
+            if (states[port_id] == ROOT and (bpdu_root_path_cost + LINK_COST) < self.root_path_cost):
+                self.root_path_cost = bpdu_root_path_cost + LINK_COST
+            elif (states[port_id] != ROOT and (bpdu_root_path_cost + LINK_COST) < self.root_path_cost):
+                # A shorter path to the root than the root port's, e.g. the
+                # root's own hello heard after a neighbour announced the root
+                self.take_root_port(port_id, self.root_bid, bpdu_root_path_cost + LINK_COST)
+            elif (states[port_id] != ROOT and bpdu_root_path_cost > self.root_path_cost):
+                states[port_id] = DESIGNATED
+            if states[port_id] == ROOT and not self.relayed:
+                # The root's hello, relayed on the designated ports as in
+                # 802.1D, so it reaches the switches below. Once per hello
+                # interval, so a relay can never loop.
+                self.relayed = True
+                bpdu_frame = make_bpdu_frame(self.own_bid, self.root_bid, self.root_path_cost)
+                for i in self.trunk_ids:
+                    if states[i] == DESIGNATED:
+                        self.send(i, bpdu_frame)
+
+        elif (bpdu_bid == self.own_bid):
+            states[port_id] = BLOCKING
+
+        if self.own_bid == self.root_bid:
+            for i in self.trunk_ids:
+                states[i] = DESIGNATED
+
+        if (self.root_bid, self.root_path_cost, states) == before:
+            return False
+        self.publish()
+        return True
+
+    # Applies a reloaded configuration: a new bridge id and ports that became
+    # trunks or access ports. Returns whether the snapshot changed.
+    def reconfigure(self, own_bid: int, interfaces: dict):
+        states = self.states
+        before = (self.root_bid, self.root_path_cost, list(states))
+        was_root = self.own_bid == self.root_bid
+        old_trunk_ids = set(self.trunk_ids)
+        self.own_bid = own_bid
+        self.trunk_ids = [i.id for i in interfaces.values() if i.is_trunk]
+        for i in interfaces.values():
+            if not i.is_trunk:
+                states[i.id] = DESIGNATED
+            elif i.id not in old_trunk_ids:
+                # A new trunk only forwards once the BPDUs say it may
+                states[i.id] = DESIGNATED if was_root else BLOCKING
+
+        lost_root_port = ROOT not in [states[i] for i in self.trunk_ids]
+        if was_root or own_bid < self.root_bid or lost_root_port:
+            # Claim the root again, as at startup; a better root's BPDUs
+            # take it back
+            self.root_bid = own_bid
+            self.root_path_cost = 0
+            for i in self.trunk_ids:
+                states[i] = DESIGNATED
+
+        if (self.root_bid, self.root_path_cost, states) == before:
+            return False
+        self.publish()
+        return True
+
+# RSTP-like mode (--stp=rapid). Every switch sends BPDUs on its designated
+# trunk ports each hello interval and immediately after any change, and keeps
+# the last BPDU heard on each trunk port, aged out after 3 hello intervals. The
+# port roles are recomputed from those on every change: the port with the best
+# path to the root is the root port, ports hearing a better designated bridge
+# are alternates (blocking, ordered as the next root port candidates) and the
+# others are designated ports. When the root port fails (its information ages
+# out, or port_down() reports the link down), the first alternate takes over
+# as root port and forwards at once, without a proposal: it was blocking, so
+# its path to the root cannot go through this switch.
+#
+# A port that becomes designated starts blocking and sends proposals. The
+# switch at the other end answers on its root port with an agreement after
+# putting its own designated ports through the same handshake (sync), and the
+# port starts forwarding as soon as the agreement arrives, or after the
+# fallback delay for a peer that never answers (e.g. in the legacy mode).
+# Access ports are edge ports and always forward.
+class Rapid_STP(STP):
+    def __init__(self, own_bid: int, interfaces: dict, send, hello_interval: float = 1.0,
+                 clock=time.monotonic):
+        self.clock = clock
+        self.now = clock()
+        self.hello_interval = hello_interval
+        self.max_age = 3 * hello_interval
+        self.forward_delay = 2 * hello_interval
+        # port id -> (root bid, root path cost, sender bid, received at, legacy)
+        self.port_info = {}
+        self.roles = {}
+        self.root_port = None
+        # Root port candidates, best first
+        self.alternates = []
+        # Designated ports waiting for an agreement -> forwarding deadline
+        self.proposing = {}
+        # Designated ports that agreed since the root information changed
+        self.agreed = set()
+        # Trunk ports whose link is down, see port_down()
+        self.down = set()
+        super().__init__(own_bid, interfaces, send)
+        self.forwarding = set(range(len(self.states))) - set(self.trunk_ids)
+        self.update_roles()
+        self.update_states()
+        self.publish()
+
+    def update_roles(self):
+        best = (self.own_bid, 0, self.own_bid, -1)
+        for port_id, (root_bid, cost, bid, _, _) in self.port_info.items():
+            vector = (root_bid, cost + LINK_COST, bid, port_id)
+            # Our own BPDUs looped back are never a path to the root
+            if vector < best and bid != self.own_bid:
+                best = vector
+        root_bid, root_path_cost, _, root_port = best
+        if (root_bid, root_path_cost) != (self.root_bid, self.root_path_cost):
+            # Agreements were given for the old root information
+            self.agreed.clear()
+        self.root_bid, self.root_path_cost = root_bid, root_path_cost
+        self.root_port = None if root_port == -1 else root_port
+
+        own_vector = (self.root_bid, self.root_path_cost, self.own_bid)
+        alternates = []
+        for port_id in self.trunk_ids:
+            info = self.port_info.get(port_id)
+            if port_id in self.down:
+                # Disabled, neither a path to the root nor to be proposed on
+                role = BLOCKING
+            elif port_id == self.root_port:
+                role = ROOT
+            elif info is not None and (info[:3] < own_vector or info[2] == self.own_bid):
+                # Also a port hearing its own BPDUs, looped back to this switch
+                role = ALTERNATE
+                if info[2] != self.own_bid:
+                    alternates.append(((info[0], info[1] + LINK_COST, info[2], port_id), port_id))
+            else:
+                role = DESIGNATED
+            if role != self.roles.get(port_id):
+                self.roles[port_id] = role
+                if role == ROOT:
+                    self.forwarding.add(port_id)
+                    self.proposing.pop(port_id, None)
+                elif role == DESIGNATED:
+                    self.propose(port_id)
+                else:
+                    self.forwarding.discard(port_id)
+                    self.proposing.pop(port_id, None)
+        self.alternates = [port_id for _, port_id in sorted(alternates)]
+
+    # Blocks a designated port until its peer agrees
+    def propose(self, port_id):
+        self.forwarding.discard(port_id)
+        self.agreed.discard(port_id)
+        self.proposing[port_id] = self.now + self.forward_delay
+
+    def update_states(self):
+        states = list(self.states)
+        for port_id in self.trunk_ids:
+            states[port_id] = (BLOCKING if port_id not in self.forwarding
+                               else self.roles[port_id])
+        self.states = states
+
+    def send_bpdus(self):
+        for port_id in self.trunk_ids:
+            if self.roles[port_id] != DESIGNATED:
+                continue
+            flags = FLAG_PROPOSAL if port_id in self.proposing else 0
+            self.send(port_id, make_rapid_bpdu_frame(self.own_bid, self.root_bid,
+                                                     self.root_path_cost, flags))
+
+    # Publishes the new state and sends triggered BPDUs if anything changed
+    def commit(self, before):
+        if (self.root_bid, self.root_path_cost, self.states, self.roles) == before:
+            return False
+        self.publish()
+        self.send_bpdus()
+        return True
+
+    def save(self):
+        return (self.root_bid, self.root_path_cost, list(self.states), dict(self.roles))
+
+    def handle_bpdu(self, data, port_id: int):
+        if port_id not in self.roles or port_id in self.down:
+            return False
+        self.now = self.clock()
+        before = self.save()
+        old_root_port = self.root_port
+        bpdu_bid, bpdu_root_bid, bpdu_root_path_cost = parse_bpdu_frame(data)
+        flags = parse_bpdu_flags(data)
+        self.port_info[port_id] = (bpdu_root_bid, bpdu_root_path_cost, bpdu_bid,
+                                   self.now, flags is None)
+        self.update_roles()
+        if self.root_port != old_root_port and switch_log.stp_debug:
+            switch_log.stp.debug("Root port %s -> %s, alternates %s",
+                                 old_root_port, self.root_port, self.alternates)
+
+        if flags is not None and flags & FLAG_AGREEMENT and port_id in self.proposing:
+            del self.proposing[port_id]
+            self.forwarding.add(port_id)
+            self.agreed.add(port_id)
+        if flags is not None and flags & FLAG_PROPOSAL and port_id == self.root_port:
+            # Sync: block the designated ports that have not agreed to the
+            # current root information, then agree
+            for i in self.trunk_ids:
+                if (self.roles[i] == DESIGNATED and i in self.forwarding
+                        and i not in self.agreed):
+                    self.propose(i)
+            self.send(port_id, make_rapid_bpdu_frame(self.own_bid, self.root_bid,
+                                                     self.root_path_cost, FLAG_AGREEMENT))
+        elif flags is not None and flags & FLAG_PROPOSAL and self.roles[port_id] == ALTERNATE:
+            # The port blocks, so the proposing end can forward safely
+            self.send(port_id, make_rapid_bpdu_frame(self.own_bid, self.root_bid,
+                                                     self.root_path_cost, FLAG_AGREEMENT))
+        self.update_states()
+        return self.commit(before)
+
+    def reconfigure(self, own_bid: int, interfaces: dict):
+        self.now = self.clock()
+        before = self.save()
+        self.own_bid = own_bid
+        trunk_ids = [i.id for i in interfaces.values() if i.is_trunk]
+        for port_id in set(self.trunk_ids) - set(trunk_ids):
+            # Now an edge port, which always forwards
+            self.port_info.pop(port_id, None)
+            self.roles.pop(port_id, None)
+            self.proposing.pop(port_id, None)
+            self.agreed.discard(port_id)
+            self.forwarding.add(port_id)
+            self.states[port_id] = DESIGNATED
+        for port_id in set(trunk_ids) - set(self.trunk_ids):
+            # Gets a role, and goes through a proposal if it is designated
+            self.forwarding.discard(port_id)
+        self.trunk_ids = trunk_ids
+        self.update_roles()
+        self.update_states()
+        return self.commit(before)
+
+    # The BPDU information of the ports is restored as if just received, so
+    # it ages out after max_age unless the neighbours confirm it, and the ports
+    # that were forwarding forward right away, without a proposal.
+    def restore(self, root_bid: int, root_path_cost: int, states, port_info, confirm_by: float):
+        self.now = self.clock()
+        before = self.save()
+        for port_id, (info_root_bid, cost, bid, legacy) in port_info.items():
+            if port_id in self.trunk_ids:
+                self.port_info[port_id] = (info_root_bid, cost, bid, self.now, legacy)
+        self.update_roles()
+        for port_id in self.trunk_ids:
+            if states[port_id] != BLOCKING and self.roles[port_id] != ALTERNATE:
+                self.proposing.pop(port_id, None)
+                self.forwarding.add(port_id)
+                if self.roles[port_id] == DESIGNATED:
+                    self.agreed.add(port_id)
+        self.update_states()
+        self.commit(before)
+        return (self.root_bid, self.root_path_cost) == (root_bid, root_path_cost)
+
+    # Drops the information of the ports and recomputes the roles. If the
+    # root port was among them, the first alternate becomes the root port.
+    def forget_ports(self, port_ids, reason):
+        old_root_port = self.root_port
+        alternates = self.alternates
+        for port_id in port_ids:
+            del self.port_info[port_id]
+        self.update_roles()
+        if self.root_port != old_root_port:
+            candidates = [port_id for port_id in alternates if port_id not in port_ids]
+            switch_log.stp.info("Root port %s %s, failing over to %s (alternates %s)",
+                                old_root_port, reason, self.root_port, candidates)
+
+    # Called when the link of a trunk port goes down: its information goes
+    # right away instead of aging out, and the port blocks until port_up().
+    # Returns whether the snapshot changed.
+    def port_down(self, port_id: int):
+        if port_id not in self.roles or port_id in self.down:
+            return False
+        self.now = self.clock()
+        before = self.save()
+        self.down.add(port_id)
+        self.forget_ports([port_id] if port_id in self.port_info else [], "down")
+        self.update_states()
+        return self.commit(before)
+
+    # The link is back, the port goes through a proposal as a new designated port
+    def port_up(self, port_id: int):
+        if port_id not in self.down:
+            return False
+        self.now = self.clock()
+        before = self.save()
+        self.down.discard(port_id)
+        self.update_roles()
+        self.update_states()
+        return self.commit(before)
+
+    # Information from legacy mode neighbours ages out too: a legacy switch
+    # that is not the root only sends BPDUs when its path changes and on its
+    # designated ports, so a port facing its root port is designated after
+    # max_age and forwards after the fallback delay if the neighbour never
+    # answers.
+    def tick(self, now: float):
+        self.now = now
+        before = self.save()
+        expired = [port_id for port_id, info in self.port_info.items()
+                   if now - info[3] > self.max_age]
+        if expired:
+            self.forget_ports(expired, "timed out")
+
+        for port_id, deadline in list(self.proposing.items()):
+            if now >= deadline:
+                # No agreement, the peer does not speak the rapid mode
+                del self.proposing[port_id]
+                self.forwarding.add(port_id)
+        self.update_states()
+        changed = self.commit(before)
+        if not changed:
+            self.send_bpdus()
+        return changed
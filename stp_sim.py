@@ -0,0 +1,340 @@
+#!/usr/bin/python3
+# STP convergence simulator. Runs one STP state machine (stp.py) per bridge in
+# this process, connected by virtual point-to-point links, on a virtual clock:
+# events (BPDU deliveries and hello timers) are kept in a heap and run in time
+# order, so a run is deterministic for a given seed and takes no real time.
+#
+# Reports when the last port state changed (the convergence time), the BPDUs
+# sent before that and in total, the final port roles, and whether every
+# bridge agrees on the root and the forwarding links form a spanning tree.
+#
+# --warm-restart then restarts the bridge farthest from the root from its
+# saved state and checks that the BPDUs confirmed it instead of the bridge
+# starting over.
+#
+# --fail-root-port (rapid mode) then takes down the root port link of the
+# first bridge that has an alternate port, checks that the alternate became
+# the root port and forwards right away, and runs as long again to report
+# the reconvergence.
+#
+#   python3 stp_sim.py ring:64
+#   python3 stp_sim.py ring:16 --mode=rapid --fail-root-port
+#   python3 stp_sim.py fat-tree:8 --mode=rapid --hello=0.05 --json=result.json
+#   python3 stp_sim.py random:300:4 --seed=7
+import argparse
+import heapq
+import json
+import random
+import sys
+import time
+
+from data_structs import interface
+from stp import STP, Rapid_STP, ALTERNATE, BLOCKING
+
+# A topology is (number of bridges, [(bridge a, bridge b), ...])
+def ring(n: int):
+    return n, [(i, (i + 1) % n) for i in range(n)]
+
+def mesh(n: int):
+    return n, [(a, b) for a in range(n) for b in range(a + 1, n)]
+
+# k-ary fat-tree: (k/2)^2 core bridges and k pods of k/2 aggregation and k/2
+# edge bridges, every edge bridge linked to every aggregation bridge of its pod
+# and aggregation bridge i of a pod linked to core bridges i*k/2 .. i*k/2+k/2-1
+def fat_tree(k: int):
+    if k % 2:
+        raise ValueError("a fat-tree needs an even k")
+    half = k // 2
+    cores = half * half
+    links = []
+    for pod in range(k):
+        aggregation = cores + pod * k
+        edge = aggregation + half
+        for i in range(half):
+            for j in range(half):
+                links.append((aggregation + i, edge + j))
+                links.append((i * half + j, aggregation + i))
+    return cores + k * k, links
+
+# Connected random graph: a random spanning tree plus random extra links until
+# the average degree is reached
+def random_graph(n: int, degree: float = 3.0, rng=None):
+    rng = rng or random.Random(0)
+    links = set()
+    for i in range(1, n):
+        links.add((rng.randrange(i), i))
+    wanted = max(n - 1, int(n * degree / 2))
+    while len(links) < min(wanted, n * (n - 1) // 2):
+        a, b = sorted(rng.sample(range(n), 2))
+        if (b, a) not in links:
+            links.add((a, b))
+    return n, sorted(links)
+
+TOPOLOGIES = {"ring": ring, "mesh": mesh, "fat-tree": fat_tree, "random": random_graph}
+
+# "name:arg:arg", e.g. "ring:16", "random:200:3.5"
+def parse_topology(spec: str, rng):
+    name, *args = spec.split(":")
+    if name not in TOPOLOGIES:
+        raise ValueError(f"unknown topology {name!r}, one of {', '.join(TOPOLOGIES)}")
+    if name == "random":
+        return random_graph(int(args[0]), *map(float, args[1:]), rng=rng)
+    return TOPOLOGIES[name](*map(int, args))
+
+class Bridge:
+    def __init__(self, sim, bridge_id: int, bid: int, ports: int):
+        self.id = bridge_id
+        self.bid = bid
+        # port id -> (peer bridge, peer port)
+        self.peers = {}
+        self.ports = ports
+        self.stp = self.start(sim)
+
+    # A new state machine, as when the bridge (re)starts
+    def start(self, sim):
+        interfaces = {i: interface(f"rr-{self.id}-{i}", "T", 0, i, "DESIGNATED")
+                      for i in range(self.ports)}
+        send = lambda port_id, frame: sim.transmit(self, port_id, frame)
+        if sim.mode == "rapid":
+            return Rapid_STP(self.bid, interfaces, send, sim.hello_interval,
+                             clock=lambda: sim.now)
+        return STP(self.bid, interfaces, send)
+
+    # The rapid mode roles, with designated ports still waiting for an
+    # agreement shown as BLOCKING. The legacy mode only has the port states.
+    def roles(self):
+        roles = getattr(self.stp, "roles", {})
+        return [(roles[i] if roles.get(i) == ALTERNATE or state != BLOCKING and i in roles
+                 else state).name for i, state in enumerate(self.stp.snapshot.states)]
+
+class Simulator:
+    def __init__(self, topology, mode="legacy", hello_interval=1.0, latency=0.001, seed=0):
+        self.mode = mode
+        self.hello_interval = hello_interval
+        self.latency = latency
+        self.rng = random.Random(seed)
+        self.now = 0.0
+        self.events = []
+        self.sequence = 0
+        self.sent = 0
+        self.last_change = 0.0
+        self.sent_at_last_change = 0
+
+        count, links = topology
+        ports = [0] * count
+        ends = []
+        for a, b in links:
+            ends.append(((a, ports[a]), (b, ports[b])))
+            ports[a] += 1
+            ports[b] += 1
+        bids = self.rng.sample(range(1, 1 << 16), count)
+        self.bridges = [Bridge(self, i, bids[i], ports[i]) for i in range(count)]
+        for (a, port_a), (b, port_b) in ends:
+            self.bridges[a].peers[port_a] = (self.bridges[b], port_b)
+            self.bridges[b].peers[port_b] = (self.bridges[a], port_a)
+        # (bridge a, port a, bridge b, port b) of every link
+        self.port_links = [(a, port_a, b, port_b) for (a, port_a), (b, port_b) in ends]
+
+        # The hello timers start at random phases, as real switches would
+        for bridge in self.bridges:
+            self.schedule(self.rng.uniform(0, hello_interval), self.hello, bridge)
+
+    def schedule(self, delay, callback, *args):
+        heapq.heappush(self.events, (self.now + delay, self.sequence, callback, args))
+        self.sequence += 1
+
+    def transmit(self, bridge, port_id, frame):
+        if port_id not in bridge.peers:
+            return    # the link is down
+        self.sent += 1
+        peer, peer_port = bridge.peers[port_id]
+        self.schedule(self.latency, self.deliver, peer, peer_port, frame)
+
+    def changed(self):
+        self.last_change = self.now
+        self.sent_at_last_change = self.sent
+
+    def deliver(self, bridge, port_id, frame):
+        if port_id not in bridge.peers:
+            return    # lost with the link
+        if bridge.stp.handle_bpdu(frame, port_id):
+            self.changed()
+
+    # Takes the link of a bridge's port down, both ends see it at once
+    def fail_link(self, bridge, port_id):
+        peer, peer_port = bridge.peers.pop(port_id)
+        del peer.peers[peer_port]
+        self.port_links = [link for link in self.port_links
+                           if (link[0], link[1]) not in ((bridge.id, port_id), (peer.id, peer_port))]
+        for end, end_port in ((bridge, port_id), (peer, peer_port)):
+            if end.stp.port_down(end_port):
+                self.changed()
+
+    # Restarts the bridge farthest from the root with the state it had, as
+    # --warm-start does with its state file. Returns the restored state, to be
+    # checked once the BPDUs had time to confirm it.
+    def warm_restart(self):
+        root_bid = min(bridge.bid for bridge in self.bridges)
+        bridge = max((b for b in self.bridges if b.stp.snapshot.root_bid == root_bid),
+                     key=lambda b: b.stp.snapshot.root_path_cost)
+        saved = bridge.stp.snapshot
+        port_info = {port_id: info[:3] + (info[4],)
+                     for port_id, info in getattr(bridge.stp, "port_info", {}).items()}
+        bridge.stp = bridge.start(self)
+        bridge.stp.restore(saved.root_bid, saved.root_path_cost, saved.states, port_info,
+                           self.now + 3 * self.hello_interval)
+        return bridge, saved
+
+    # Fails the root port link of the first bridge with an alternate port.
+    # Returns the check of the failover: the alternate must be the root port
+    # and forward as soon as the link is down, before any BPDU is exchanged.
+    def fail_root_port(self):
+        for bridge in self.bridges:
+            stp = bridge.stp
+            if stp.root_port is None or not stp.alternates:
+                continue
+            root_port, alternate = stp.root_port, stp.alternates[0]
+            self.fail_link(bridge, root_port)
+            return {
+                "bridge": bridge.bid,
+                "failed_port": root_port,
+                "alternate": alternate,
+                "took_over": (stp.root_port == alternate
+                              and stp.snapshot.states[alternate] != BLOCKING),
+                "failed_at": self.now,
+            }
+        return None
+
+    def hello(self, bridge):
+        if bridge.stp.tick(self.now):
+            self.changed()
+        self.schedule(self.hello_interval, self.hello, bridge)
+
+    def run(self, duration):
+        events = self.events
+        while events and events[0][0] <= duration:
+            self.now, _, callback, args = heapq.heappop(events)
+            callback(*args)
+        self.now = duration
+
+    # A link forwards when neither end blocks it. The forwarding links must
+    # connect every bridge without a cycle.
+    def check_tree(self):
+        parent = list(range(len(self.bridges)))
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        forwarding = 0
+        loop_free = True
+        for a, port_a, b, port_b in self.port_links:
+            if (self.bridges[a].stp.snapshot.states[port_a] == BLOCKING
+                    or self.bridges[b].stp.snapshot.states[port_b] == BLOCKING):
+                continue
+            forwarding += 1
+            root_a, root_b = find(a), find(b)
+            if root_a == root_b:
+                loop_free = False
+            else:
+                parent[root_a] = root_b
+        connected = len({find(i) for i in range(len(self.bridges))}) == 1
+        return forwarding, loop_free, connected
+
+    def report(self):
+        root_bid = min(bridge.bid for bridge in self.bridges)
+        forwarding, loop_free, connected = self.check_tree()
+        role_counts = {}
+        for bridge in self.bridges:
+            for role in bridge.roles():
+                role_counts[role] = role_counts.get(role, 0) + 1
+        return {
+            "mode": self.mode,
+            "bridges": len(self.bridges),
+            "links": len(self.port_links),
+            "hello_interval": self.hello_interval,
+            "duration": self.now,
+            "converged_at": self.last_change,
+            "bpdus_to_converge": self.sent_at_last_change,
+            "bpdus": self.sent,
+            "root_agreed": all(b.stp.snapshot.root_bid == root_bid for b in self.bridges),
+            "forwarding_links": forwarding,
+            "loop_free": loop_free,
+            "connected": connected,
+            "roles": role_counts,
+            "bridge_roles": {b.bid: b.roles() for b in self.bridges},
+        }
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Simulate STP convergence")
+    parser.add_argument("topology", help="ring:N, mesh:N, fat-tree:K or random:N[:DEGREE]")
+    parser.add_argument("--mode", choices=("legacy", "rapid"), default="legacy")
+    parser.add_argument("--hello", type=float, default=1.0, help="seconds between hellos")
+    parser.add_argument("--latency", type=float, default=0.001, help="link latency in seconds")
+    parser.add_argument("--duration", type=float, help="virtual seconds to run (default 30 hellos)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also save the results to this file")
+    parser.add_argument("--warm-restart", action="store_true",
+                        help="then restart the bridge farthest from the root from its saved state")
+    parser.add_argument("--fail-root-port", action="store_true",
+                        help="then fail a root port link that has an alternate (rapid mode)")
+    args = parser.parse_args(argv)
+    if args.fail_root_port and args.mode != "rapid":
+        parser.error("--fail-root-port needs --mode=rapid")
+
+    rng = random.Random(args.seed)
+    sim = Simulator(parse_topology(args.topology, rng), args.mode, args.hello,
+                    args.latency, args.seed)
+    start = time.perf_counter()
+    duration = args.duration or 30 * args.hello
+    sim.run(duration)
+    restarted = None
+    if args.warm_restart:
+        restarted, saved = sim.warm_restart()
+        sim.run(2 * duration)
+        duration *= 2
+    failover = None
+    if args.fail_root_port:
+        failover = sim.fail_root_port()
+        sim.run(2 * duration)
+        duration *= 2
+    result = sim.report()
+    result["topology"] = args.topology
+    result["seed"] = args.seed
+    result["wall_time"] = time.perf_counter() - start
+
+    print(f"{args.topology} ({result['bridges']} bridges, {result['links']} links), {args.mode} mode")
+    print(f"  converged at {result['converged_at'] * 1000:.1f} ms after "
+          f"{result['bpdus_to_converge']} BPDUs ({result['bpdus']} in {result['duration']:g} s)")
+    print(f"  root agreed: {result['root_agreed']}, loop free: {result['loop_free']}, "
+          f"connected: {result['connected']}, {result['forwarding_links']} forwarding links")
+    print(f"  port roles: {result['roles']}")
+    if args.warm_restart:
+        snapshot = restarted.stp.snapshot
+        confirmed = (snapshot.root_bid, snapshot.root_path_cost) == (saved.root_bid, saved.root_path_cost)
+        result["warm_restart"] = {"bridge": restarted.bid, "root_path_cost": saved.root_path_cost,
+                                  "confirmed": confirmed}
+        print(f"  warm restart of bridge {restarted.bid}, {saved.root_path_cost} from the root: "
+              f"confirmed: {confirmed}")
+    if args.fail_root_port:
+        result["failover"] = failover
+        if failover is None:
+            print("  no bridge has an alternate port to fail over to")
+        else:
+            print(f"  failed root port {failover['failed_port']} of bridge {failover['bridge']}: "
+                  f"alternate {failover['alternate']} took over: {failover['took_over']}, "
+                  f"reconverged {(result['converged_at'] - failover['failed_at']) * 1000:.1f} ms later")
+    print(f"  simulated in {result['wall_time']:.2f} s")
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(result, file, indent=2)
+    ok = result["root_agreed"] and result["loop_free"] and result["connected"]
+    if args.warm_restart:
+        ok = ok and result["warm_restart"]["confirmed"]
+    if args.fail_root_port:
+        ok = ok and failover is not None and failover["took_over"]
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
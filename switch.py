@@ -1,51 +1,170 @@
 #!/usr/bin/python3
+import os
 import sys
+import ctypes
+import signal
 import struct
 import wrapper
+import switch_log
 import threading
 import time
-from wrapper import recv_from_any_link, send_to_link, get_switch_mac
-from data_structs import interface
+import asyncio
+import multiprocessing
+from wrapper import recv_from_any_link, recv_batch, recv_batch_into, send_to_link, send_to_links, get_switch_mac
+from data_structs import interface, Port_type, Port_state
 from data_structs import CAM_table
-
-multicast_mac = b'\x01\x80\xc2\x00\x00\x00'
+from data_structs import VLAN_table
+from data_structs import Egress_table, TAG_KEEP, TAG_PUSH, TAG_POP
+from shared_cam import Shared_CAM_table
+from compact_cam import Compact_CAM_table
+import warm_state
+from warm_state import State_file
+from stp import STP, Rapid_STP, MULTICAST_MAC, DESIGNATED
+from switch_log import TraceRing, DECISION_UNICAST, DECISION_FLOOD, DECISION_DROP, DECISION_BPDU
+from classify import get_classifier, mac_key
+from counters import Counters, segment_name, PUBLISH_INTERVAL
+from latency import Latency_recorder, STAGE_PARSE, STAGE_LEARN, STAGE_STP
+from profiler import Profiler
+
+# MACs are handled as 48-bit integers, which are also the CAM keys
+multicast_mac = mac_key(MULTICAST_MAC)
 cam = CAM_table()
+vlans = VLAN_table()
+egress = Egress_table()
+TAG_ACTIONS = {TAG_KEEP: "802.1q header kept", TAG_PUSH: "added 802.1q header",
+               TAG_POP: "removed 802.1q header"}
+# Ring of the last frames handled, enabled with --trace=N
+trace = None
+# Shared memory counters (--counters, see counters.py), and the block the
+# forwarding thread of this process counts in
+counters = None
+counts = None
+# Per-stage latency histograms (--latency, see latency.py)
+latency = None
+# Sampling profile started by SIGUSR2 (see profiler.py), its length in
+# seconds and sampling rate, and the BPDU thread it samples
+profiler = None
+profile_seconds = 10.0
+profile_hz = 100.0
+bpdu_thread = None
+# Signals the switch handles, always delivered to the main thread
+HANDLED_SIGNALS = {signal.SIGUSR1, signal.SIGUSR2, signal.SIGHUP, signal.SIGTERM}
 # Each switch has a list of interfaces that holds each interface's information
 # like the name, type (trunk or access, and eventually the vlan_id)
 interfaces = {}
-global own_bid
-global root_bid
-global own_root_path_cost
+# STP state machine, created by init_stp()
+stp = None
+# Serializes the BPDU handling and the STP timer, which run in different threads
+stp_lock = threading.Lock()
+# Seconds between BPDU hellos (--hello=SECONDS)
+hello_interval = 1.0
+# Version of the STP snapshot the forwarding tables were compiled from
+tables_version = -1
+# Header classifier of the received batches (--classify=auto|numpy|python)
+classify_batch = get_classifier("auto")
+# Switch id of the config file, and whether SIGHUP asked to reload it
+config_switch_id = None
+reload_pending = False
+# Warm restart state file (--state-file), saved every state_interval seconds
+state_file = None
+state_interval = 5.0
+next_state_save = 0.0
 # Parses the switch's information from the config file
 def parse_switch_info(switch_id):
+    global switch_priority, config_switch_id
+    config_switch_id = switch_id
+    switch_priority, links = read_switch_info(switch_id)
+    switch_log.stp.info("Switch priority %d", switch_priority)
+    interfaces.update(links)
+
+# Returns the priority and the interfaces of the config file
+def read_switch_info(switch_id):
     path = "configs/switch" + str(switch_id) + ".cfg"
+    links = {}
    
     with open(path, "r") as file:
         # Read the first line before the parsing loop, to get the switches' priority
         line = file.readline().strip()
-        global switch_priority
-        switch_priority = int(line)
-        print(f"{switch_priority}")
+        priority = int(line)
         count = 0
         # Parse the interfaces' info
         for line in file:
             line = line.strip()
             parts = line.split()
             name_str = parts[0]
-            if name_str.startswith("r-"):   # not a trunk link then
+            # The second field is "T" for a trunk or the VLAN ID of an access
+            # port, so a reload can change the role of a link
+            if parts[1] == "T":    # trunk link then
+                link = interface(name_str, Port_type.TRUNK, 0, count, DESIGNATED)
+                links[count] = link
+            else:   # not a trunk link then
                 vlan_id = parts[1]
-                link = interface(name_str, "A", int(vlan_id), count, "DESIGNATED")
-                interfaces[count] = link
-            elif name_str.startswith("rr-"):    # trunk link then
-                link = interface(name_str, "T", 0, count, "DESIGNATED")   
-                interfaces[count] = link
+                link = interface(name_str, Port_type.ACCESS, int(vlan_id), count, DESIGNATED)
+                links[count] = link
             count += 1
+    return priority, links
+
+# SIGHUP reloads the config file. The new one is diffed against the running
+# configuration: the ports whose VLAN or type changed are updated in place
+# and forget their CAM entries, STP takes the new priority and trunk ports,
+# and only the egress entries of the VLANs whose flood lists changed are
+# recompiled. The other ports keep forwarding with their CAM entries. The set
+# of interfaces itself cannot change without a restart.
+#
+# The signal handler only flags the reload: it runs before the next batch in
+# the thread that owns the forwarding tables (refresh_port_states()), or in
+# the STP timer of a coordinator, whose workers reload their own copy of the
+# interfaces when it signals them in turn.
+def request_reload(signum, frame):
+    global reload_pending
+    reload_pending = True
+
+def reload_config():
+    global switch_priority, tables_version, reload_pending
+    reload_pending = False
+    try:
+        priority, links = read_switch_info(config_switch_id)
+    except (OSError, ValueError, IndexError) as e:
+        switch_log.fwd.warning("Config reload failed, keeping the running config: %s", e)
+        return
+    if [link.name for link in links.values()] != [i.name for i in interfaces.values()]:
+        switch_log.fwd.warning("Config reload: the interfaces changed, restart the switch to apply it")
+        return
+
+    changed = {i for i, link in links.items() if link.vlan != interfaces[i].vlan}
+    if not changed and priority == switch_priority:
+        switch_log.fwd.info("Config reload: no changes")
+        return
+    for i in changed:
+        interfaces[i].set_vlan(links[i].vlan)
+    forgotten = 0
+    if not in_worker:
+        # The coordinator runs STP and clears the shared CAM for the workers
+        forgotten = cam.forget_ports(changed)
+        with stp_lock:
+            stp.reconfigure(priority, interfaces)
+            if port_states is not None:
+                publish_port_states()
+    switch_log.fwd.info("Config reload: priority %d -> %d, ports %s changed, %d CAM entries forgotten",
+                        switch_priority, priority, sorted(changed), forgotten)
+    switch_priority = priority
+
+    if worker_processes:
+        for process in worker_processes:
+            os.kill(process.pid, signal.SIGHUP)
+        return
+    tables_version = -1
+    update_forwarding_tables()
+    if egress.recompiled is not None:
+        switch_log.fwd.info("Config reload: recompiled the egress entries of VLANs %s",
+                            sorted(egress.recompiled))
 
 def parse_ethernet_header(data):
-    # Unpack the header fields from the byte array
+    # Unpack the header fields from the byte array (or memoryview)
     # dest_mac, src_mac, ethertype = struct.unpack('!6s6sH', data[:14])
-    dest_mac = data[0:6]
-    src_mac = data[6:12]
+    # The MACs are read as integers since they are used as CAM keys
+    dest_mac = int.from_bytes(data[0:6], "big")
+    src_mac = int.from_bytes(data[6:12], "big")
     
     # Extract ethertype. Under 802.1Q, this may be the bytes from the VLAN TAG
     ether_type = (data[12] << 8) + data[13]
@@ -64,157 +183,336 @@ def create_vlan_tag(data, vlan_id):
     # 0x8200 for the Ethertype for 802.1Q (mock value)
     # vlan_id & 0x0FFF ensures that only the last 12 bits are used
     tag_data = struct.pack('!H', 0x8200) + struct.pack('!H', vlan_id & 0x0FFF)
-    return data[0:12] + tag_data + data[12:]
-
-
-def send_from_tagged_frame(send_interface, recv_interface, data, length, recv_vlan_id):
-    if (send_interface.id != recv_interface.id):
-            if (send_interface.type == "A" and send_interface.vlan == recv_vlan_id):
-                # remove the 802.1q header and send frame
-                print(f"Sending on interface {send_interface!r} with removed 802.1q header")
-                new_data = remove_tagged_header(data)
-                new_length = length - 4
-                send_to_link(send_interface.id, new_length, new_data)
-            elif (send_interface.type == "T" and send_interface.state != "BLOCKING"):
-                # keep the 802.1q header and send the frame
-                print(f"sending in handle tagged on {send_interface!r} with kept 802.1q heeader")
-                send_to_link(send_interface.id, length, data)
-
-
-def send_from_untagged_frame (send_interface, recv_interface, data, length):
-    if (send_interface.id != recv_interface.id):
-        if (send_interface.type == "A" and send_interface.vlan == recv_interface.vlan):
-            print(f"Sending on interface {send_interface!r}")
-            send_to_link(send_interface.id, length, data)
-        elif (send_interface.type == "T" and send_interface.state != "BLOCKING"):
-            new_data = create_vlan_tag(data, recv_interface.vlan)
-            new_length = length + 4
-            print(f"Sending on interface {send_interface!r} with added 802.1q header")
-            send_to_link(send_interface.id, new_length, new_data)
-
-def handle_untagged_frame(recv_interface_id, data, length, dest_mac):
-    recv_interface = interfaces[recv_interface_id]
-    if (cam.entry_exists(dest_mac)):
-        send_interface = cam.table[dest_mac]
-        send_from_untagged_frame(send_interface, recv_interface, data, length)
-    else:   # send broadcast
-        print(f"(UNTAGGED BROADCAST)")
-        for send_interface in interfaces.values():
-            send_from_untagged_frame(send_interface, recv_interface, data, length)
-
-def handle_tagged_frame(recv_interface_id, data, length, dest_mac, recv_vlan_id):
-    recv_interface = interfaces[recv_interface_id]
-    if (cam.entry_exists(dest_mac)):
-        send_interface = cam.table[dest_mac]
-        send_from_tagged_frame(send_interface, recv_interface, data, length, recv_vlan_id)
-    else:   # send broadcast
-        print(f"(TAGGED BROADCAST)")
-        for send_interface in interfaces.values():
-            send_from_tagged_frame(send_interface, recv_interface, data, length, recv_vlan_id)
+    return b"".join((data[0:12], tag_data, data[12:]))
 
 
 def remove_tagged_header(old_frame):
-    new_frame = old_frame[0:12] + old_frame[16:]
+    new_frame = b"".join((old_frame[0:12], old_frame[16:]))
     return new_frame
 
+def apply_tag_action(action, data, vlan_id):
+    if action == TAG_KEEP:
+        return data
+    if action == TAG_PUSH:
+        return create_vlan_tag(data, vlan_id)
+    return remove_tagged_header(data)
+
+# The egress ports and tag actions come from the compiled egress table, so
+# forwarding a frame is a table lookup and the sends. Flooded frames are built
+# once per tag action and sent to all of its ports at once.
 def forward_frame(recv_interface_id, data, length, dest_mac, recv_vlan_id):
-    tpid = int.from_bytes(data[12:14], byteorder='big')
-    if tpid == 0x8200:
-        # tagged frame
-        handle_tagged_frame(recv_interface_id, data, length, dest_mac, recv_vlan_id)
-    else:
-        # untagged frame
-        handle_untagged_frame(recv_interface_id, data, length, dest_mac)
+    tagged = recv_vlan_id != -1
+    vlan_id = recv_vlan_id if tagged else interfaces[recv_interface_id].vlan
+    flood, unicast = egress.lookup(recv_interface_id, vlan_id, tagged)
+
+    send_interface = cam.lookup(vlan_id, dest_mac)
+    if (send_interface is not None):
+        action = unicast.get(send_interface.id)
+        if action is None:
+            if trace is not None:
+                trace.record(recv_interface_id, vlan_id, send_interface.id, DECISION_DROP, bytes(data[0:6]), bytes(data[6:12]))
+            if counts is not None:
+                counts.dropped_vlan(recv_interface_id, vlan_id)
+            return
+        if switch_log.fwd_debug:
+            switch_log.fwd.debug("Sending on interface %r (%s)", send_interface, TAG_ACTIONS[action])
+        if trace is not None:
+            trace.record(recv_interface_id, vlan_id, send_interface.id, DECISION_UNICAST, bytes(data[0:6]), bytes(data[6:12]))
+        new_data = apply_tag_action(action, data, vlan_id)
+        send_to_link(send_interface.id, len(new_data), new_data)
+        if counts is not None:
+            counts.forwarded(vlan_id, send_interface.id, len(new_data))
+    else:   # send broadcast
+        if trace is not None:
+            trace.record(recv_interface_id, vlan_id, -1, DECISION_FLOOD, bytes(data[0:6]), bytes(data[6:12]))
+        if counts is not None:
+            # The group bit of the first byte is set for multicast/broadcast
+            counts.flooded(vlan_id, not dest_mac >> 40 & 1)
+        for action, send_ids in flood:
+            if switch_log.fwd_debug:
+                switch_log.fwd.debug("Flooding in VLAN %d on interfaces %s (%s)",
+                                     vlan_id, send_ids, TAG_ACTIONS[action])
+            new_data = apply_tag_action(action, data, vlan_id)
+            send_to_links(send_ids, new_data)
+            if counts is not None:
+                counts.sent_many(send_ids, len(new_data))
+
+# Recompiles the flood lists and egress tables when the STP snapshot changed
+# since they were last compiled; a version check otherwise. The forwarding
+# path only reads the compiled tables, so it sees the port states of a single
+# snapshot at a time.
+def update_forwarding_tables():
+    global tables_version
+    snapshot = stp.snapshot
+    if snapshot.version == tables_version:
+        return
+    if vlans.rebuild(interfaces, snapshot.states):
+        egress.compile(interfaces, vlans)
+    tables_version = snapshot.version
+
+# Called from the BPDU thread and from the thread handling received BPDUs
+def send_bpdu(interface_id, frame):
+    send_to_link(interface_id, len(frame), frame)
+    if counters is not None:
+        counters.current().bpdu_out(interface_id)
+
+# Polls the links of the trunk ports in the rapid mode. A root port whose
+# link went down fails over to the best alternate right away (see
+# Rapid_STP.port_down()), instead of once its information aged out.
+# Returns whether the snapshot changed.
+def check_links():
+    if not isinstance(stp, Rapid_STP):
+        return False
+    changed = False
+    for port_id in stp.trunk_ids:
+        name = interfaces[port_id].name
+        if wrapper.link_up(name):
+            if port_id in stp.down:
+                switch_log.io.warning("Link %s up", name)
+                changed = stp.port_up(port_id) or changed
+        elif port_id not in stp.down:
+            switch_log.io.warning("Link %s down", name)
+            changed = stp.port_down(port_id) or changed
+    return changed
+
+# Sends the hellos, and in the rapid mode ages the BPDU information and runs
+# the proposal timeouts
+def run_stp_timer():
+    if worker_processes:
+        # A coordinator has no forwarding loop, its CAM is the shared one
+        if reload_pending:
+            reload_config()
+        if state_file is not None:
+            save_state_if_due()
+    with stp_lock:
+        changed = check_links()
+        changed = stp.tick(time.monotonic()) or changed
+        if changed and port_states is not None:
+            publish_port_states()
+    if changed and switch_log.stp_debug:
+        switch_log.stp.debug("Port states changed: %s", stp.snapshot)
+    wrapper.flush_links()
 
-# All switches in the testing topology understand this custom STP protocol, so
-# we'll make a custom BPDU frame header for easier parsing, as following:
-# MAC_MULTICAST(6 BYTES) | OWN_BID (8 BYTES) | ROOT_BRIDGE_ID (8 BYTES) | ROOT_PATH_COST(4 BYTES)
 def send_bdpu_every_sec():
-    global own_bid, root_bid, own_root_path_cost
+    if counters is not None:
+        counters.bind(1)
     while True:
-        if own_bid == root_bid:
-            print("sending bpdu frame every sec")
-            for interface in interfaces.values():
-                if interface.type != "T": continue
-                data = multicast_mac + struct.pack('!Q', own_bid) + struct.pack('!Q', root_bid) + struct.pack('!I', own_root_path_cost)
-
-                send_to_link(interface.id,len(data), data)
-
-        time.sleep(1)
-
-def parse_bpdu_frame(data):
-    bpdu_bid = int.from_bytes(data[6:14], byteorder = "big")
-    bpdu_root_bid = int.from_bytes(data[14:22], byteorder = "big")
-    bpdu_root_path_cost = int.from_bytes(data[22:26], byteorder = "big")
-
-    return bpdu_bid, bpdu_root_bid, bpdu_root_path_cost
+        run_stp_timer()
+        time.sleep(hello_interval)
 
 def handle_bpdu_frame(data, interface_id):
-    global own_bid, root_bid, own_root_path_cost
-    was_root = False
-    if (own_bid == root_bid):
-        was_root = True
-    bpdu_bid, bpdu_root_bid, bpdu_root_path_cost = parse_bpdu_frame(data)
-    if (bpdu_root_bid < root_bid):
-        root_bid = bpdu_root_bid
-        # all links have a mock 100 Mbps latency, so any link cost is a standard value
-        own_root_path_cost = bpdu_root_path_cost + 10
-        root_port = interfaces[interface_id]
-        root_port.state = "ROOT"
-
-        if was_root:
-            for interface in interfaces.values():
-                if interface.type == "T" and interface.state != "ROOT":
-                    interface.state = "BLOCKING"
-
-        new_bpdu_bid = own_bid
-        new_bpdu_root_path_cost = own_root_path_cost
-        bpdu_frame = (
-            multicast_mac +
-            struct.pack('!Q', new_bpdu_bid) +
-            struct.pack('!Q', root_bid) +
-            struct.pack('!I', new_bpdu_root_path_cost)
-        )
-        for interface in interfaces.values():
-            if interface.type == "T" and interface.state != "ROOT":
-                send_to_link(interface.id,len(bpdu_frame), bpdu_frame)
-    elif (bpdu_root_bid == root_bid):
-        if (interfaces[interface_id].state == "ROOT" and (bpdu_root_path_cost + 10) < own_root_path_cost):
-            own_root_path_cost = bpdu_root_path_cost + 10
-        elif (interfaces[interface_id].state != "ROOT" and bpdu_root_path_cost > own_root_path_cost):
-            interfaces[interface_id].state = "DESIGNATED"
-
-    elif (bpdu_bid == own_bid):
-        interfaces[interface_id].state = "BLOCKING"
-
-    if own_bid == root_bid:
-        for interface in interfaces.values():
-            if interface.type == "T":
-                interface.state = "DESIGNATED"
-
-def init_stp():
-    global own_bid, root_bid, own_root_path_cost
-    own_bid = switch_priority
-    root_bid = own_bid 
-    own_root_path_cost = 0
-
-def main():
-    # init returns the max interface number. Our interfaces
-    # are 0, 1, 2, ..., init_ret value + 1
-    switch_id = sys.argv[1]
-
-    num_interfaces = wrapper.init(sys.argv[2:])
-    interfaces_count = range(0, num_interfaces)
-    switch_mac = get_switch_mac()
-
-    parse_switch_info(switch_id)
-    init_stp()
-
-
-    # Create and start a new thread that deals with sending BDPU
-    t = threading.Thread(target=send_bdpu_every_sec)
-    t.start()
-    
+    with stp_lock:
+        changed = stp.handle_bpdu(data, interface_id)
+        if changed and port_states is not None:
+            publish_port_states()
+    if changed:
+        if switch_log.stp_debug:
+            switch_log.stp.debug("Port states changed: %s", stp.snapshot)
+        if port_states is None:
+            update_forwarding_tables()
+
+# mode is "legacy" or "rapid" (see stp.py), clock gives the rapid mode's time
+def init_stp(mode="legacy", clock=time.monotonic):
+    global stp
+    if mode == "rapid":
+        stp = Rapid_STP(switch_priority, interfaces, send_bpdu, hello_interval, clock)
+    elif mode == "legacy":
+        stp = STP(switch_priority, interfaces, send_bpdu)
+    else:
+        raise ValueError(f"unknown STP mode {mode!r}")
+
+# The CAM is saved from the thread that forwards, so it does not change while
+# it is exported
+def save_state():
+    now = time.monotonic()
+    entries = state_file.save(stp, cam, interfaces, now)
+    if switch_log.fwd_debug:
+        switch_log.fwd.debug("Saved %d CAM entries and %s to %s", entries, stp.snapshot, state_file.path)
+
+def save_state_if_due():
+    global next_state_save
+    now = time.monotonic()
+    if now >= next_state_save:
+        next_state_save = now + state_interval
+        save_state()
+
+def load_state():
+    state = state_file.load()
+    if state is None:
+        switch_log.stp.info("No saved state in %s, cold start", state_file.path)
+        return
+    now = time.monotonic()
+    # Three hellos for the BPDUs to confirm the restored root
+    with stp_lock:
+        entries = warm_state.restore(state, stp, cam, interfaces, now, now + 3 * hello_interval)
+        if port_states is not None:
+            publish_port_states()
+    update_forwarding_tables()
+    switch_log.stp.info("Warm start after %.1f s down: %d CAM entries, %s", state["downtime"], entries, stp.snapshot)
+
+# Picks up port state changes made by the STP timer or, in a worker, by the
+# coordinator, and config reloads, and saves the warm restart state when it
+# is due. Called once per received batch.
+def refresh_port_states():
+    if reload_pending:
+        reload_config()
+    if state_file is not None and not in_worker and not worker_processes:
+        save_state_if_due()
+    if port_states is not None:
+        sync_port_states()
+    else:
+        update_forwarding_tables()
+
+# Switch options are passed as --name=value arguments mixed with the interface
+# names (which never start with "--"), e.g. --batch=32, --zero-copy or
+# --backend=mmap
+def parse_options(args):
+    options = {}
+    names = []
+    for arg in args:
+        if arg.startswith("--"):
+            name, _, value = arg[2:].partition("=")
+            options[name] = value
+        else:
+            names.append(arg)
+    return options, names
+
+def process_frame(interface_id, data, length):
+    dest_mac, src_mac, ethertype, recv_vlan_id = parse_ethernet_header(data)
+    handle_frame(interface_id, data, length, dest_mac, src_mac, recv_vlan_id)
+
+# Handles the frames of a received batch, given as (interface id, frame)
+# pairs, whose headers are all classified at once
+def process_batch(batch):
+    dest_macs, src_macs, vlan_ids = classify_batch([data for _, data in batch])
+    for (interface_id, data), dest_mac, src_mac, recv_vlan_id in zip(batch, dest_macs, src_macs, vlan_ids):
+        handle_frame(interface_id, data, len(data), dest_mac, src_mac, recv_vlan_id)
+
+def handle_frame(interface_id, data, length, dest_mac, src_mac, recv_vlan_id):
+    if (dest_mac == multicast_mac):   # BPDU FRAME
+        if trace is not None:
+            trace.record(interface_id, recv_vlan_id, -1, DECISION_BPDU, bytes(data[0:6]), bytes(data[6:12]))
+        if counts is not None:
+            counts.bpdu_in(interface_id)
+        if bpdu_queue is not None:
+            # A forwarding worker, STP runs in the coordinator
+            bpdu_queue.put((interface_id, bytes(data)))
+        else:
+            handle_bpdu_frame(data, interface_id)
+        return    # wait for a non BPDU frame
+    if interface_id in vlans.blocked_ports:
+        if counts is not None:
+            counts.dropped_blocked(interface_id, length)
+        return    # a blocked port neither learns nor forwards
+
+    recv_interface = interfaces[interface_id]
+    vlan_id = recv_vlan_id if recv_vlan_id != -1 else recv_interface.vlan
+    moved = cam.learn(vlan_id, src_mac, recv_interface)
+    if counts is not None:
+        counts.received(interface_id, vlan_id, length, moved)
+    forward_frame(interface_id, data, length, dest_mac, recv_vlan_id)
+
+# SIGUSR1 dumps the trace ring to trace-<suffix>.bin, decoded with
+# python3 switch_log.py <file>, and the latency histograms to
+# latency-<suffix>.bin, printed with python3 latency.py <file>. A
+# coordinator handles no frames, it passes the signal on to its workers.
+def dump_diagnostics(suffix):
+    def handler(signum, frame):
+        if worker_processes:
+            for process in worker_processes:
+                os.kill(process.pid, signal.SIGUSR1)
+            return
+        if trace is not None:
+            path = f"trace-{suffix}.bin"
+            trace.dump(path)
+            switch_log.fwd.warning("Dumped %d trace records to %s", trace.count, path)
+        if latency is not None:
+            path = f"latency-{suffix}.bin"
+            latency.dump(path)
+            switch_log.fwd.warning("Dumped the latency histograms to %s", path)
+    return handler
+
+# SIGUSR2 samples the stacks of the receive and BPDU threads for
+# profile_seconds into profile-<suffix>.folded. A coordinator profiles its
+# own threads and passes the signal on to its workers.
+def start_profile(suffix):
+    def handler(signum, frame):
+        global profiler
+        for process in worker_processes:
+            os.kill(process.pid, signal.SIGUSR2)
+        if profiler is not None and profiler.is_alive():
+            switch_log.fwd.warning("A profile is already running")
+            return
+
+        threads = {"coordinator" if worker_processes else "receive": threading.main_thread().ident}
+        if bpdu_thread is not None:
+            threads["bpdu"] = bpdu_thread.ident
+        states = stp.snapshot.states
+        tag = (f"switch {suffix} cam={cam.stats()['entries']}/{cam.capacity} stp_ports={len(states)} "
+               + " ".join(f"{state.name.lower()}={states.count(state)}" for state in Port_state
+                          if state in states))
+        path = f"profile-{suffix}.folded"
+        profiler = Profiler(threads, tag, path, profile_seconds, profile_hz)
+        # The sampling thread must not take the signals of the main thread
+        signal.pthread_sigmask(signal.SIG_BLOCK, HANDLED_SIGNALS)
+        profiler.start()
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, HANDLED_SIGNALS)
+        switch_log.fwd.warning("Profiling %s for %g s at %g Hz into %s",
+                               ", ".join(threads), profile_seconds, profile_hz, path)
+    return handler
+
+# Replaces the stages of the forwarding path with the timing wrappers of the
+# latency recorder (see latency.py); nothing is timed unless this is called.
+# Runs in every forwarding process, once its CAM is the final one.
+def install_latency_hooks():
+    global recv_from_any_link, recv_batch, recv_batch_into, parse_ethernet_header, classify_batch
+    global apply_tag_action, send_to_link, send_to_links, handle_bpdu_frame, handle_frame
+    recv_from_any_link = latency.received(recv_from_any_link)
+    recv_batch = latency.received(recv_batch)
+    recv_batch_into = latency.received(recv_batch_into)
+    wrapper.recv_batch_from = latency.received(wrapper.recv_batch_from)
+    if wrapper.ring is not None:
+        wrapper.ring.recv_batch = latency.received(wrapper.ring.recv_batch)
+    parse_ethernet_header = latency.timed(parse_ethernet_header, STAGE_PARSE)
+    classify_batch = latency.timed_classify(classify_batch)
+    cam.learn = latency.timed(cam.learn, STAGE_LEARN)
+    cam.lookup = latency.timed_lookup(cam.lookup)
+    apply_tag_action = latency.timed_tag(apply_tag_action)
+    send_to_link = latency.timed_send(send_to_link)
+    send_to_links = latency.timed_send(send_to_links)
+    handle_bpdu_frame = latency.timed(handle_bpdu_frame, STAGE_STP)
+    handle_frame = latency.frame(handle_frame, multicast_mac)
+
+def run_forwarding(batch_size, zero_copy):
+    if latency is not None:
+        install_latency_hooks()
+
+    if wrapper.ring is not None:
+        # Frames are views into the RX ring, flush() releases them and sends
+        # everything queued while processing the batch
+        while True:
+            batch = wrapper.ring.recv_batch(batch_size or wrapper.MAX_BATCH)
+            cam.tick(time.monotonic())
+            refresh_port_states()
+            process_batch(batch)
+            wrapper.ring.flush()
+
+    if zero_copy:
+        pool = wrapper.FramePool()
+        while True:
+            batch = recv_batch_into(pool, batch_size or wrapper.MAX_BATCH)
+            cam.tick(time.monotonic())
+            refresh_port_states()
+            process_batch([(interface_id, data) for interface_id, _, data in batch])
+            for _, slot, _ in batch:
+                pool.release(slot)
+
+    if batch_size > 0:
+        while True:
+            batch = recv_batch(batch_size)
+            cam.tick(time.monotonic())
+            refresh_port_states()
+            process_batch(batch)
 
     while True:
         # Note that data is of type bytes([...]).
@@ -222,14 +520,249 @@ def main():
         # b2 = bytes([32, 87, 111, 114, 108, 100])  # " World"
         # b3 = b1[0:2] + b[3:4].
         interface_id, data, length = recv_from_any_link()
+        cam.tick(time.monotonic())
+        refresh_port_states()
+        process_frame(interface_id, data, length)
+
+# Multi-process mode (--workers=N): the coordinator process runs STP and the
+# BPDU hellos, while N forked workers each receive from and forward the
+# frames of a subset of the interfaces. The workers share one CAM table in
+# shared memory and send the BPDUs they receive to the coordinator, which
+# publishes the resulting port states in a shared array: port_states[0] is a
+# version bumped after every change, port_states[1 + id] the state of port id
+# (a Port_state value).
+PR_SET_PDEATHSIG = 1
+port_states = None
+port_states_version = -1
+bpdu_queue = None
+# The workers of a coordinator, and whether this process is a worker
+worker_processes = []
+in_worker = False
+
+def publish_port_states():
+    changed = False
+    for interface_id, state in enumerate(stp.snapshot.states):
+        if port_states[1 + interface_id] != state:
+            port_states[1 + interface_id] = state
+            changed = True
+    if changed:
+        port_states[0] += 1
+
+def sync_port_states():
+    global port_states_version
+    version = port_states[0]
+    if version == port_states_version:
+        return
+    # A change published while copying bumps the version again, so it is
+    # picked up on the next call
+    states = tuple(map(Port_state, port_states[1:]))
+    snapshot = stp.snapshot
+    stp.load_snapshot(snapshot._replace(version=snapshot.version + 1, states=states))
+    port_states_version = version
+    update_forwarding_tables()
+
+def run_worker(switch_id, worker_id, interface_ids, batch_size, zero_copy):
+    global in_worker, counts
+    in_worker = True
+    # Get a SIGTERM when the coordinator exits, however it exits
+    ctypes.CDLL(None, use_errno=True).prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+    if os.getppid() == 1:
+        return
+    if counters is not None:
+        # Blocks 0 and 1 are the coordinator's threads
+        counts = counters.bind(2 + worker_id)
+        signal.pthread_sigmask(signal.SIG_BLOCK, HANDLED_SIGNALS)
+        counters.start_publisher()
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, HANDLED_SIGNALS)
+
+    wrapper.select_interfaces(interface_ids)
+    if trace is not None or latency is not None:
+        signal.signal(signal.SIGUSR1, dump_diagnostics(f"{switch_id}-{worker_id}"))
+    signal.signal(signal.SIGUSR2, start_profile(f"{switch_id}-{worker_id}"))
+    switch_log.fwd.info("Worker %d forwarding from interfaces %s", worker_id, interface_ids)
+    run_forwarding(batch_size, zero_copy)
+
+def start_workers(switch_id, workers, batch_size, zero_copy):
+    global cam, port_states, bpdu_queue
+    context = multiprocessing.get_context("fork")
+
+    shared_cam = Shared_CAM_table(cam.capacity, context.Lock(), cam.aging_time)
+    shared_cam.interfaces = interfaces
+    cam = shared_cam
+    port_states = context.RawArray('i', 1 + len(interfaces))
+    publish_port_states()
+    bpdu_queue = context.SimpleQueue()
+
+    processes = []
+    for worker_id in range(workers):
+        interface_ids = [i for i in interfaces if i % workers == worker_id]
+        process = context.Process(target=run_worker, daemon=True,
+                                  args=(switch_id, worker_id, interface_ids, batch_size, zero_copy))
+        process.start()
+        processes.append(process)
+    return processes
+
+def stop_workers():
+    for process in worker_processes:
+        process.terminate()
+    for process in worker_processes:
+        process.join()
+
+def run_coordinator():
+    while True:
+        interface_id, data = bpdu_queue.get()
+        handle_bpdu_frame(data, interface_id)
+
+# asyncio runtime (--runtime=asyncio): a single thread whose event loop waits
+# on every interface socket with add_reader() and runs the BPDU hellos and the
+# periodic CAM maintenance as timers, instead of a blocking receive call and a
+# separate BPDU thread.
+CAM_TICK_INTERVAL = 0.5
+
+def on_readable(interface_id, batch_size):
+    # Drains at most one batch per callback so the sockets take turns
+    frames = wrapper.recv_batch_from(interface_id, batch_size)
+    cam.tick(time.monotonic())
+    refresh_port_states()
+    process_batch([(interface_id, data) for data in frames])
+
+def call_every(loop, interval, callback):
+    def run():
+        callback()
+        loop.call_later(interval, run)
+    loop.call_soon(run)
+
+def run_asyncio(batch_size):
+    if latency is not None:
+        install_latency_hooks()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    for interface_id in interfaces:
+        loop.add_reader(wrapper.interface_fd(interface_id), on_readable,
+                        interface_id, batch_size or wrapper.MAX_BATCH)
+    call_every(loop, hello_interval, run_stp_timer)
+    call_every(loop, CAM_TICK_INTERVAL, lambda: cam.tick(time.monotonic()))
+    if counters is not None:
+        call_every(loop, PUBLISH_INTERVAL, counters.publish)
+    loop.run_forever()
 
-        dest_mac, src_mac, ethertype, recv_vlan_id = parse_ethernet_header(data)
-        if (dest_mac == multicast_mac):   # BPDU FRAME
-            handle_bpdu_frame(data, interface_id)
-            continue    # wait for a non BPDU frame
+def main():
+    global trace, hello_interval, classify_batch, cam, state_file, state_interval, counters, counts, latency
+    global profile_seconds, profile_hz, bpdu_thread
+    # init returns the max interface number. Our interfaces
+    # are 0, 1, 2, ..., init_ret value + 1
+    switch_id = sys.argv[1]
+    options, interface_names = parse_options(sys.argv[2:])
+    # Number of frames read per native call, 0 reads them one at a time
+    batch_size = int(options.get("batch", 0))
+    # Receive into a reusable buffer pool instead of fresh bytes objects
+    zero_copy = "zero-copy" in options
+    # "socket", "mmap" for the TPACKET_V3 ring backend or "loopback" for Unix
+    # datagram sockets instead of interfaces (see loopback.py)
+    backend = options.get("backend", "socket")
+    # Number of forwarding processes, 0 forwards in this process
+    workers = int(options.get("workers", 0))
+    if workers and backend == "mmap":
+        raise ValueError("the mmap backend cannot be shared by worker processes")
+    # "threads" for a blocking receive loop plus the BPDU thread, or "asyncio"
+    runtime = options.get("runtime", "threads")
+    if runtime == "asyncio" and (workers or backend == "mmap"):
+        raise ValueError("the asyncio runtime does not support worker processes or the mmap backend")
+
+    # Log levels, e.g. "debug" or "fwd:debug,stp:info"
+    switch_log.setup(options.get("log", "info"))
+    if "trace" in options:
+        trace = TraceRing(int(options["trace"] or 4096))
+    # Per-stage latency histograms, timed by the forwarding processes
+    if "latency" in options:
+        latency = Latency_recorder()
+    if trace is not None or latency is not None:
+        signal.signal(signal.SIGUSR1, dump_diagnostics(switch_id))
+    # Sampling profiles on SIGUSR2, always available
+    profile_seconds = float(options.get("profile-seconds", profile_seconds))
+    profile_hz = float(options.get("profile-hz", profile_hz))
+    signal.signal(signal.SIGUSR2, start_profile(switch_id))
+    # Config reload, see reload_config()
+    signal.signal(signal.SIGHUP, request_reload)
+
+    # CAM table size and entry lifetime in seconds
+    cam.capacity = int(options.get("cam-size", cam.capacity))
+    cam.aging_time = float(options.get("cam-aging", cam.aging_time))
+    # "dict" or the "compact" array-backed table (see compact_cam.py)
+    if options.get("cam", "dict") == "compact":
+        cam = Compact_CAM_table(cam.capacity, cam.aging_time)
+        cam.interfaces = interfaces
+    # "legacy" STP or the "rapid" RSTP-like mode, and the seconds between hellos
+    stp_mode = options.get("stp", "legacy")
+    hello_interval = float(options.get("hello", hello_interval))
+    # Header classifier of the received batches: "numpy" classifies a whole
+    # batch with array operations, "python" frame by frame and "auto" uses
+    # NumPy for large batches when it is installed (see classify.py)
+    classify_batch = get_classifier(options.get("classify", "auto"))
+
+    num_interfaces = wrapper.init(interface_names, backend)
+    interfaces_count = range(0, num_interfaces)
+    switch_mac = get_switch_mac()
 
-        cam.table[src_mac] = interfaces[interface_id]
-        forward_frame(interface_id, data, length, dest_mac, recv_vlan_id)
+    parse_switch_info(switch_id)
+    init_stp(stp_mode)
+    update_forwarding_tables()
+
+    # Counters in shared memory, read with: python3 counters.py <SWITCH_ID>.
+    # One block for the main thread, one for the BPDU thread and one per worker.
+    if "counters" in options:
+        counters = Counters.create(segment_name(switch_id),
+                                   [interfaces[i].name for i in range(len(interfaces))], 2 + workers)
+
+    # The workers are forked before any other thread is started
+    if workers:
+        worker_processes.extend(start_workers(switch_id, workers, batch_size, zero_copy))
+    if counters is not None:
+        counts = counters.bind(0)
+
+    # Warm restart state, saved every state-interval seconds and on SIGTERM,
+    # and loaded back with --warm-start (see warm_state.py)
+    if "state-file" in options or "warm-start" in options:
+        state_file = State_file(options.get("state-file") or f"state-{switch_id}.bin",
+                                len(interfaces), cam.capacity)
+        state_interval = float(options.get("state-interval", state_interval))
+        if "warm-start" in options:
+            load_state()
+    # The state is saved, the counters removed and the workers stopped on
+    # the way out
+    if state_file is not None or counters is not None or worker_processes:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        if runtime == "asyncio":
+            run_asyncio(batch_size)
+            return
+
+        # Create and start a new thread that deals with sending BDPU. Signals are
+        # blocked in it, so they interrupt the receive calls of the main thread.
+        t = threading.Thread(target=send_bdpu_every_sec, name="bpdu", daemon=True)
+        bpdu_thread = t
+        signal.pthread_sigmask(signal.SIG_BLOCK, HANDLED_SIGNALS)
+        t.start()
+        if counters is not None:
+            counters.start_publisher()
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, HANDLED_SIGNALS)
+
+        if workers:
+            run_coordinator()
+        else:
+            run_forwarding(batch_size, zero_copy)
+    finally:
+        if worker_processes:
+            stop_workers()
+        if state_file is not None:
+            save_state()
+            state_file.flush()
+        if counters is not None:
+            counters.unlink()
+        if worker_processes:
+            # The workers are gone, nothing maps the shared CAM anymore
+            cam.close(unlink=True)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
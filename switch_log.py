@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+# Logging for the switch, on top of the standard logging module. Messages are
+# formatted lazily ("%s" arguments) and the hot path additionally checks the
+# module flags below before calling the logger, so a disabled message costs
+# one attribute lookup.
+#
+# Subsystems: "fwd" (frame forwarding), "stp" (BPDUs and port states) and
+# "io" (link setup, states and errors, frames dropped by full TX queues).
+# Levels are set per subsystem, e.g. "stp:debug,fwd:off".
+#
+# Running this file decodes a dumped trace ring:
+#   python3 switch_log.py trace-0.bin
+import logging
+import struct
+import sys
+import time
+
+SUBSYSTEMS = ("fwd", "stp", "io")
+LEVELS = {"debug": logging.DEBUG, "info": logging.INFO, "warning": logging.WARNING,
+          "error": logging.ERROR, "off": logging.CRITICAL + 1}
+
+fwd = logging.getLogger("switch.fwd")
+stp = logging.getLogger("switch.stp")
+io = logging.getLogger("switch.io")
+
+# Whether debug messages of each subsystem are enabled, refreshed by setup()
+fwd_debug = False
+stp_debug = False
+io_debug = False
+
+def setup(spec="info", stream=sys.stdout):
+    global fwd_debug, stp_debug, io_debug
+
+    root = logging.getLogger("switch")
+    if not root.handlers:
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(logging.Formatter("[%(name)s] %(message)s"))
+        root.addHandler(handler)
+        root.propagate = False
+
+    for item in spec.split(","):
+        name, _, level = item.rpartition(":")
+        if level not in LEVELS:
+            raise ValueError(f"unknown log level {level!r}")
+        if name and name not in SUBSYSTEMS:
+            raise ValueError(f"unknown log subsystem {name!r}")
+        logging.getLogger("switch." + name if name else "switch").setLevel(LEVELS[level])
+
+    fwd_debug = fwd.isEnabledFor(logging.DEBUG)
+    stp_debug = stp.isEnabledFor(logging.DEBUG)
+    io_debug = io.isEnabledFor(logging.DEBUG)
+
+# Forwarding decisions recorded in the trace ring
+DECISION_UNICAST = 1
+DECISION_FLOOD = 2
+DECISION_DROP = 3
+DECISION_BPDU = 4
+DECISION_NAMES = {DECISION_UNICAST: "unicast", DECISION_FLOOD: "flood",
+                  DECISION_DROP: "drop", DECISION_BPDU: "bpdu"}
+
+# In-memory ring of the last frames handled, as fixed-size binary records:
+# timestamp (ns), ingress port, VLAN, egress port (-1 if none), decision,
+# destination MAC, source MAC. Recording a frame is one struct.pack_into,
+# and the ring is only decoded when dumped.
+class TraceRing:
+    RECORD = struct.Struct("<QhhhB6s6s5x")
+    HEADER = struct.Struct("<4sII")      # magic, record count, next record
+    MAGIC = b"SWTR"
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * self.RECORD.size)
+        self.next = 0
+        self.count = 0
+
+    def record(self, ingress, vlan, egress, decision, dest_mac, src_mac):
+        self.RECORD.pack_into(self.buffer, self.next * self.RECORD.size, time.perf_counter_ns(),
+                              ingress, vlan, egress, decision, dest_mac, src_mac)
+        self.next = (self.next + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    # Writes the raw ring to path, to be decoded with records() later
+    def dump(self, path):
+        with open(path, "wb") as file:
+            file.write(self.HEADER.pack(self.MAGIC, self.count, self.next))
+            file.write(self.buffer[:self.count * self.RECORD.size])
+
+    # Returns the records, oldest first, from the ring or from a dump file
+    def records(self):
+        return self.decode(self.buffer, self.count, self.next)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as file:
+            data = file.read()
+        magic, count, next = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC:
+            raise ValueError(f"{path} is not a trace ring dump")
+        return cls.decode(data[cls.HEADER.size:], count, next)
+
+    @classmethod
+    def decode(cls, buffer, count, next):
+        records = [cls.RECORD.unpack_from(buffer, i * cls.RECORD.size) for i in range(count)]
+        if count == len(buffer) // cls.RECORD.size:
+            records = records[next:] + records[:next]
+        return records
+
+def format_record(record):
+    timestamp, ingress, vlan, egress, decision, dest_mac, src_mac = record
+    return (f"{timestamp} in={ingress} vlan={vlan} {src_mac.hex(':')} -> {dest_mac.hex(':')} "
+            f"{DECISION_NAMES.get(decision, decision)} out={egress}")
+
+if __name__ == "__main__":
+    for record in TraceRing.load(sys.argv[1]):
+        print(format_record(record))
@@ -0,0 +1,153 @@
+# Warm restart state (--state-file, --warm-start). The switch periodically
+# saves its CAM entries and STP state (root bid, root path cost and, per port,
+# the state, role and last BPDU information) to a fixed-size file mapped with
+# mmap, and once more when it is terminated. A switch started with
+# --warm-start loads it back, so it forwards known unicast and keeps its port
+# roles from the start instead of claiming the root and flooding until every
+# MAC is relearned. STP revalidates the restored state with the BPDUs it then
+# receives (see STP.restore()).
+#
+# The file holds a HEADER, one PORT record per interface and up to the CAM
+# capacity of ENTRY records. The magic is cleared while a new state is
+# written, so a switch killed in the middle leaves a file that is ignored.
+import mmap
+import os
+import struct
+import time
+
+import switch_log
+from data_structs import Port_state
+
+MAGIC = b"SWSTATE1"
+# magic, ports, CAM entries, saved at (wall clock), own bid, root bid,
+# root path cost
+HEADER = struct.Struct("<8sIIdQQI")
+# state, role (NO_ROLE for none), INFO_* flags, VLAN, then the root bid, root
+# path cost and sender bid of the last BPDU received
+PORT = struct.Struct("<BBBHQIQ")
+# BPDU information present, and sent by a switch in the legacy mode
+INFO_PRESENT = 0x01
+INFO_LEGACY = 0x02
+# MAC, VLAN, port id, seconds since last seen
+ENTRY = struct.Struct("<QHhf")
+NO_ROLE = 0xFF
+
+class State_file:
+    def __init__(self, path: str, ports: int, capacity: int):
+        self.path = path
+        self.ports = ports
+        self.capacity = capacity
+        self.size = HEADER.size + ports * PORT.size + capacity * ENTRY.size
+        self.map = None
+
+    # Maps the file, created or resized to this switch's size on first use
+    def open(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != self.size:
+                os.ftruncate(fd, self.size)
+            self.map = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+
+    def save(self, stp, cam, interfaces: dict, now: float):
+        if self.map is None:
+            self.open()
+        buf = self.map
+        buf[:len(MAGIC)] = bytes(len(MAGIC))
+
+        snapshot = stp.snapshot
+        roles = getattr(stp, "roles", {})
+        port_info = getattr(stp, "port_info", {})
+        offset = HEADER.size
+        for port_id in range(self.ports):
+            info = port_info.get(port_id)
+            role = roles.get(port_id)
+            flags = 0 if info is None else INFO_PRESENT | (INFO_LEGACY if info[4] else 0)
+            PORT.pack_into(buf, offset, snapshot.states[port_id], NO_ROLE if role is None else role,
+                           flags, interfaces[port_id].vlan,
+                           *(info[:3] if info is not None else (0, 0, 0)))
+            offset += PORT.size
+
+        # The most recently seen entries if the CAM outgrew the file
+        entries = sorted(cam.export(), key=lambda entry: entry[3], reverse=True)[:self.capacity]
+        for vlan, mac, port_id, last_seen in entries:
+            ENTRY.pack_into(buf, offset, mac, vlan, port_id, now - last_seen)
+            offset += ENTRY.size
+
+        HEADER.pack_into(buf, 0, MAGIC, self.ports, len(entries), time.time(),
+                         snapshot.own_bid, snapshot.root_bid, snapshot.root_path_cost)
+        return len(entries)
+
+    def flush(self):
+        if self.map is not None:
+            self.map.flush()
+
+    # Returns the saved state as a dict, or None if there is no usable one
+    def load(self):
+        try:
+            with open(self.path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return None
+        if len(data) < HEADER.size:
+            return None
+        magic, ports, count, saved_at, own_bid, root_bid, root_path_cost = HEADER.unpack_from(data)
+        if magic != MAGIC or ports != self.ports or len(data) < HEADER.size + ports * PORT.size + count * ENTRY.size:
+            return None
+
+        states = []
+        roles = {}
+        port_info = {}
+        vlans = []
+        offset = HEADER.size
+        for port_id in range(ports):
+            state, role, flags, vlan, info_root_bid, cost, bid = PORT.unpack_from(data, offset)
+            states.append(Port_state(state))
+            if role != NO_ROLE:
+                roles[port_id] = Port_state(role)
+            if flags & INFO_PRESENT:
+                port_info[port_id] = (info_root_bid, cost, bid, bool(flags & INFO_LEGACY))
+            vlans.append(vlan)
+            offset += PORT.size
+        # Entries age with the time the switch was down
+        downtime = max(0.0, time.time() - saved_at)
+        entries = []
+        for mac, vlan, port_id, age in ENTRY.iter_unpack(data[offset:offset + count * ENTRY.size]):
+            entries.append((vlan, mac, port_id, age + downtime))
+        return {"own_bid": own_bid, "root_bid": root_bid, "root_path_cost": root_path_cost,
+                "states": states, "roles": roles, "port_info": port_info, "vlans": vlans,
+                "entries": entries, "downtime": downtime}
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+# Loads a saved state into the switch's STP and CAM. Only the parts that still
+# match the configuration are used: nothing if the priority changed, no STP
+# state if a port became or stopped being a trunk, and no CAM entry of a port
+# whose VLAN changed. confirm_by is when the BPDUs must have confirmed the
+# restored root. Returns the number of CAM entries restored.
+def restore(state, stp, cam, interfaces: dict, now: float, confirm_by: float):
+    if state["own_bid"] != stp.own_bid:
+        switch_log.stp.warning("Not restoring the saved state, the priority changed")
+        return 0
+    changed = {port_id for port_id, vlan in enumerate(state["vlans"]) if interfaces[port_id].vlan != vlan}
+    if any(interfaces[port_id].is_trunk != (state["vlans"][port_id] == 0) for port_id in changed):
+        # The saved port states may unblock a loop through a new trunk
+        switch_log.stp.warning("Not restoring the saved STP state, trunk ports changed")
+    else:
+        stp.restore(state["root_bid"], state["root_path_cost"], state["states"],
+                    state["port_info"], confirm_by)
+
+    # Oldest first, so the CAM's recency order is kept
+    restored = 0
+    for vlan, mac, port_id, age in sorted(state["entries"], key=lambda entry: entry[3], reverse=True):
+        if port_id in changed or port_id not in interfaces or age > cam.aging_time:
+            continue
+        cam.now = now - age
+        cam.learn(vlan, mac, interfaces[port_id])
+        restored += 1
+    cam.tick(now)
+    return restored
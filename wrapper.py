@@ -1,10 +1,13 @@
 import ctypes
+import os
+import struct
 import sys
-from ctypes import create_string_buffer
+
+import switch_log
 
 # dlink.so este biblioteca C pe care o folosim pentru a trimite cadre de nivel
 # data link, aceasta se gaseste in directorul lib
-lib = ctypes.CDLL('./dlink.so')
+lib = ctypes.CDLL('./dlink.so', use_errno=True)
 
 # Aici specificam semnatura functiilor pe care vrem sa le folosim din biblioteca dlink.
 # De exemplu in C, functia recv_from_any_link arata astfel:
@@ -13,9 +16,44 @@ lib = ctypes.CDLL('./dlink.so')
 lib.recv_from_any_link.argtypes = (ctypes.c_char_p, ctypes.POINTER(ctypes.c_size_t))
 lib.recv_from_any_link.restype = ctypes.c_int
 
+lib.recv_batch.argtypes = (ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_size_t),
+                           ctypes.POINTER(ctypes.c_int), ctypes.c_int)
+lib.recv_batch.restype = ctypes.c_int
+
 lib.send_to_link.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t)
 lib.send_to_link.restype = ctypes.c_int
 
+lib.send_to_links.argtypes = (ctypes.POINTER(ctypes.c_int), ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t)
+lib.send_to_links.restype = ctypes.c_int
+
+lib.ring_setup.argtypes = (ctypes.c_int, ctypes.c_uint, ctypes.c_uint, ctypes.c_uint, ctypes.c_uint)
+lib.ring_setup.restype = ctypes.c_int
+
+lib.ring_rx_map.argtypes = (ctypes.c_int, ctypes.POINTER(ctypes.c_uint), ctypes.POINTER(ctypes.c_uint))
+lib.ring_rx_map.restype = ctypes.c_void_p
+
+lib.ring_rx_next.argtypes = [ctypes.c_int]
+lib.ring_rx_next.restype = ctypes.c_int
+
+lib.ring_rx_release.argtypes = [ctypes.c_int]
+lib.ring_rx_release.restype = None
+
+lib.ring_wait.argtypes = [ctypes.c_int]
+lib.ring_wait.restype = ctypes.c_int
+
+lib.ring_flush.argtypes = ()
+lib.ring_flush.restype = ctypes.c_int
+
+lib.recv_batch_from.argtypes = (ctypes.c_int, ctypes.POINTER(ctypes.c_void_p),
+                                ctypes.POINTER(ctypes.c_size_t), ctypes.c_int)
+lib.recv_batch_from.restype = ctypes.c_int
+
+lib.get_interface_fd.argtypes = [ctypes.c_int]
+lib.get_interface_fd.restype = ctypes.c_int
+
+lib.rx_select.argtypes = (ctypes.POINTER(ctypes.c_int), ctypes.c_int)
+lib.rx_select.restype = ctypes.c_int
+
 lib.init.argtypes = (ctypes.c_int, ctypes.POINTER(ctypes.c_char_p))
 lib.init.restype = ctypes.c_int
 
@@ -25,11 +63,125 @@ lib.get_interface_mac.restype = None
 lib.get_interface_name.argtypes = [ctypes.c_int]
 lib.get_interface_name.restype = ctypes.c_char_p
 
+MAX_PACKET_LEN = 1600
+MAX_BATCH = 64 # same as MAX_BATCH in lib.h
+
+# Buffers reused by every recv_batch() call: MAX_BATCH slots of MAX_PACKET_LEN
+# bytes each, plus the per-slot lengths and receiving interfaces
+_batch_buffer = (ctypes.c_char * (MAX_BATCH * MAX_PACKET_LEN))()
+_batch_frames = (ctypes.c_void_p * MAX_BATCH)(
+    *[ctypes.addressof(_batch_buffer) + i * MAX_PACKET_LEN for i in range(MAX_BATCH)])
+_batch_lengths = (ctypes.c_size_t * MAX_BATCH)()
+_batch_ifaces = (ctypes.c_int * MAX_BATCH)()
+
+# A pool of MAX_PACKET_LEN slots that frames are received into without any
+# copies. Frames are handed out as memoryviews over their slot and a slot is
+# only reused after release() has been called for it.
+class FramePool:
+    def __init__(self, size=4 * MAX_BATCH):
+        self.buffer = (ctypes.c_char * (size * MAX_PACKET_LEN))()
+        base = ctypes.addressof(self.buffer)
+        self.addresses = [base + i * MAX_PACKET_LEN for i in range(size)]
+        view = memoryview(self.buffer).cast('B')
+        self.views = [view[i * MAX_PACKET_LEN:(i + 1) * MAX_PACKET_LEN] for i in range(size)]
+        self.free = list(range(size))
+
+        # Arguments of the native recv_batch() call
+        self.frames = (ctypes.c_void_p * MAX_BATCH)()
+        self.lengths = (ctypes.c_size_t * MAX_BATCH)()
+        self.ifaces = (ctypes.c_int * MAX_BATCH)()
+
+    def release(self, slot):
+        self.free.append(slot)
+
+# PACKET_MMAP (TPACKET_V3) receive side. The kernel fills the RX ring of each
+# interface block by block; the blocks are walked here through memoryviews over
+# the mapping, so received frames are never copied. Frames are valid until
+# flush(), which gives the read blocks back to the kernel and kicks the TX rings.
+class Ring:
+    # Offsets inside struct tpacket_block_desc and struct tpacket3_hdr
+    BLOCK_HEADER = struct.Struct("<II")       # num_pkts, offset_to_first_pkt
+    BLOCK_HEADER_OFFSET = 12
+    PACKET_NEXT = struct.Struct("<I")         # tp_next_offset
+    PACKET_SNAPLEN = struct.Struct("<I")      # tp_snaplen
+    PACKET_SNAPLEN_OFFSET = 12
+    PACKET_MAC = struct.Struct("<H")          # tp_mac
+    PACKET_MAC_OFFSET = 24
+
+    def __init__(self, num_interfaces, block_size=1 << 16, block_nr=64,
+                 frame_size=2048, block_timeout=1):
+        self.blocks = []
+        for i in range(num_interfaces):
+            if lib.ring_setup(i, block_size, block_nr, frame_size, block_timeout) == -1:
+                errno = ctypes.get_errno()
+                switch_log.io.error("Cannot set up the rings of interface %d: %s", i, os.strerror(errno))
+                raise OSError(errno, f"cannot set up the rings of interface {i}")
+
+            size = ctypes.c_uint()
+            count = ctypes.c_uint()
+            base = lib.ring_rx_map(i, ctypes.byref(size), ctypes.byref(count))
+            mapping = (ctypes.c_char * (size.value * count.value)).from_address(base)
+            view = memoryview(mapping).cast('B')
+            self.blocks.append([view[j * size.value:(j + 1) * size.value]
+                                for j in range(count.value)])
+            if switch_log.io_debug:
+                switch_log.io.debug("Interface %d: RX ring of %d blocks of %d bytes", i, count.value, size.value)
+
+        # Interfaces whose current RX block was handed out and not released yet
+        self.held = []
+
+    # Blocks until at least one RX block is ready, then returns the
+    # (interface, frame) pairs of ready blocks, stopping once max_frames is
+    # reached. The batch is empty if the wait was interrupted by a signal.
+    def recv_batch(self, max_frames=MAX_BATCH):
+        batch = []
+        interface = lib.ring_wait(-1)
+        while interface != -1:
+            block = self.blocks[interface][lib.ring_rx_next(interface)]
+            self.held.append(interface)
+
+            num_pkts, offset = self.BLOCK_HEADER.unpack_from(block, self.BLOCK_HEADER_OFFSET)
+            for _ in range(num_pkts):
+                snaplen, = self.PACKET_SNAPLEN.unpack_from(block, offset + self.PACKET_SNAPLEN_OFFSET)
+                mac, = self.PACKET_MAC.unpack_from(block, offset + self.PACKET_MAC_OFFSET)
+                batch.append((interface, block[offset + mac:offset + mac + snaplen]))
+                offset += self.PACKET_NEXT.unpack_from(block, offset)[0]
+
+            if len(batch) >= max_frames:
+                break
+            interface = lib.ring_wait(0)
+        return batch
+
+    def flush(self):
+        for interface in self.held:
+            lib.ring_rx_release(interface)
+        self.held.clear()
+        lib.ring_flush()
+
+# Set by init() when the mmap backend is selected
+ring = None
+# Frames the TX rings had no room for
+tx_dropped = 0
+# Set by init() when the loopback backend is selected, the functions below
+# then hand over to it
+links = None
+
 # Peste functiile de mai sus, definim urmatoarele functii in python pe care
 # urmeaza sa le folosim implementarea noastra
-def init(argv_p):
+# backend is "socket" for plain read()/write() on the packet sockets, "mmap"
+# for TPACKET_V3 rings, in which case frames are read through wrapper.ring and
+# the frames sent are only transmitted by flush_links(), or "loopback" for Unix
+# datagram sockets given as "name:fd" arguments (see loopback.py)
+def init(argv_p, backend="socket"):
+    global ring, links
     # Get the command-line arguments using sys.argv
     print("Initializing the switch")
+    if backend == "loopback":
+        from loopback import Loopback_links
+        links = Loopback_links(argv_p)
+        switch_log.io.info("%d interfaces, %s backend", len(argv_p), backend)
+        return len(argv_p)
+
     argv = [arg.encode('utf-8') for arg in argv_p]  # Convert each argument to bytes
 
     # Convert the list to a ctypes array
@@ -37,36 +189,161 @@ def init(argv_p):
     argv_array = (ctypes.c_char_p * argc)(*argv)
     # Call the hub init function
     num_int = lib.init(argc, argv_array)
+
+    if backend == "mmap":
+        ring = Ring(num_int)
+    elif backend != "socket":
+        raise ValueError(f"unknown link backend {backend!r}")
+    switch_log.io.info("%d interfaces, %s backend", num_int, backend)
     return num_int
 
 def recv_from_any_link():
     # Create a buffer for the data to be written into
+    if links is not None:
+        return links.recv_from_any_link()
     buffer_size = 1600 # MAX_PACKET_LEN
 
     buffer = ctypes.create_string_buffer(buffer_size)
     # Create a ctypes variable for the length
     length = ctypes.c_size_t()
 
-    # Call the C function
+    # Call the C function, -1 means it was interrupted by a signal, whose
+    # handler runs before the call is retried
     result = lib.recv_from_any_link(buffer, ctypes.byref(length))
+    while result == -1:
+        result = lib.recv_from_any_link(buffer, ctypes.byref(length))
 
     return result, bytes(buffer.raw[:length.value]), length.value
 
+# Blocks until at least one frame is available, then returns up to max_frames
+# (interface, frame) pairs read from all the ready interfaces in one native call.
+# The batch is empty if the wait was interrupted by a signal.
+def recv_batch(max_frames=MAX_BATCH):
+    if links is not None:
+        return links.recv_batch(max_frames)
+    count = lib.recv_batch(_batch_frames, _batch_lengths, _batch_ifaces,
+                           min(max_frames, MAX_BATCH))
+
+    batch = []
+    for i in range(count):
+        start = i * MAX_PACKET_LEN
+        batch.append((_batch_ifaces[i], _batch_buffer[start:start + _batch_lengths[i]]))
+    return batch
+
+# Returns up to max_frames frames waiting on one interface, without blocking
+def recv_batch_from(interface, max_frames=MAX_BATCH):
+    if links is not None:
+        return links.recv_batch_from(interface, max_frames)
+    count = lib.recv_batch_from(interface, _batch_frames, _batch_lengths,
+                                min(max_frames, MAX_BATCH))
+
+    frames = []
+    for i in range(count):
+        start = i * MAX_PACKET_LEN
+        frames.append(_batch_buffer[start:start + _batch_lengths[i]])
+    return frames
+
+# File descriptor of an interface's socket, for event loops
+def interface_fd(interface):
+    if links is not None:
+        return links.interface_fd(interface)
+    return lib.get_interface_fd(interface)
+
+# Same as recv_batch(), but the frames are received straight into free slots
+# of pool. Returns (interface, slot, frame) tuples, where frame is a memoryview
+# that stays valid until pool.release(slot)
+def recv_batch_into(pool, max_frames=MAX_BATCH):
+    if links is not None:
+        return links.recv_batch_into(pool, max_frames)
+    count = min(max_frames, MAX_BATCH, len(pool.free))
+    assert count > 0, "no free slots left in the frame pool"
+
+    slots = [pool.free.pop() for _ in range(count)]
+    for i, slot in enumerate(slots):
+        pool.frames[i] = pool.addresses[slot]
+
+    count = lib.recv_batch(pool.frames, pool.lengths, pool.ifaces, count)
+    pool.free.extend(slots[count:])
+
+    return [(pool.ifaces[i], slots[i], pool.views[slots[i]][:pool.lengths[i]])
+            for i in range(count)]
+
+# bytes are handed to C as they are, while other buffers (bytearrays, memoryviews
+# over FramePool slots) are wrapped without being copied
+def _c_buffer(buffer):
+    if isinstance(buffer, bytes):
+        return buffer
+    return (ctypes.c_char * len(buffer)).from_buffer(buffer)
+
 # Receives an interface, a byte array and a length.
 def send_to_link(interface, length, buffer):
     # Create a buffer for the data to be written into
     buffer_size = length
     # Make sure buffer is smaller than MAX_PACKET_LEN
     assert(buffer_size < 1600)
-    
-    c_buf = create_string_buffer(buffer)
-    c_len = ctypes.c_size_t(buffer_size)
+    if links is not None:
+        return links.send_to_link(interface, length, buffer)
+
+    # Call the C function, -1 means the TX ring of the interface is full
+    result = lib.send_to_link(interface, _c_buffer(buffer), buffer_size)
+    if result == -1:
+        tx_full(interface)
+
+# A frame dropped by a full TX ring. The first drop and every 1000th after it
+# are logged, a congested port would otherwise flood the log.
+def tx_full(interface):
+    global tx_dropped
+    tx_dropped += 1
+    if tx_dropped % 1000 == 1:
+        switch_log.io.warning("TX ring of interface %d full, %d frames dropped so far", interface, tx_dropped)
+
+# Sends the same frame on all the given interfaces with one native call
+def send_to_links(interfaces, buffer):
+    assert(len(buffer) < 1600)
+    if links is not None:
+        return links.send_to_links(interfaces, buffer)
+
+    # The ids of the interfaces whose TX ring is full come back as -1
+    ids = (ctypes.c_int * len(interfaces))(*interfaces)
+    if lib.send_to_links(ids, len(interfaces), _c_buffer(buffer), len(buffer)):
+        for interface, sent_id in zip(interfaces, ids):
+            if sent_id == -1:
+                tx_full(interface)
+
+# Only receive from the given interfaces in this process from now on, used by
+# the forwarding workers, which each own a subset of the ingress interfaces
+def select_interfaces(interfaces):
+    if links is not None:
+        return links.select(interfaces)
+    ids = (ctypes.c_int * len(interfaces))(*interfaces)
+    if lib.rx_select(ids, len(interfaces)) == -1:
+        errno = ctypes.get_errno()
+        switch_log.io.error("Cannot select the receive interfaces %s: %s", interfaces, os.strerror(errno))
+        raise OSError(errno, "cannot select the receive interfaces")
+
+# Transmits the frames queued in the TX rings, a no-op for the socket backend
+def flush_links():
+    if links is None:
+        lib.ring_flush()
+
+# Operational states of a network interface without a working link
+LINK_DOWN = ("down", "lowerlayerdown", "notpresent")
 
-    # Call the C function
-    result = lib.send_to_link(interface, c_buf, c_len)
+# Whether the link of the interface called name is up, from its operational
+# state in sysfs. Links without one (loopback sockets) are always up.
+def link_up(name):
+    if links is not None:
+        return True
+    try:
+        with open(f"/sys/class/net/{name}/operstate") as file:
+            return file.read().strip() not in LINK_DOWN
+    except OSError:
+        return True
 
 def get_switch_mac():
     # Create a buffer for the MAC address
+    if links is not None:
+        return links.get_switch_mac()
     mac_buffer = (ctypes.c_uint8 * 6)()
     
     # Call the get_inferface mac function.
@@ -78,5 +355,7 @@ def get_switch_mac():
 
 # Returns the name of an interface, used for the VLAN subtask
 def get_interface_name(interface):
+    if links is not None:
+        return links.get_interface_name(interface)
 
     return lib.get_interface_name(interface).decode('utf-8')